@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+""" Microbenchmarks of the functions comparing the desired state of the
+modules with the current one, with large synthetic inputs.
+
+Every function is called in a loop for at least --min-time seconds, --repeat
+times, and the best time per call is reported. The results can be saved as a
+JSON baseline, and later runs compared against it, failing when a function
+got slower than --max-slowdown times its baseline:
+
+    $ python benchmarks/diff_functions.py --save-baseline diff-baseline.json
+    $ python benchmarks/diff_functions.py --baseline diff-baseline.json --max-slowdown 1.3
+
+The baseline is only meaningful on the machine and interpreter it was saved
+with.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import ansible.module_utils
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ansible.module_utils.__path__.append(os.path.join(ROOT, 'module_utils'))
+sys.path.insert(0, os.path.join(ROOT, 'library'))
+
+from manageiq_alert import ManageIQAlert  # noqa: E402
+from manageiq_provider import ManageIQProvider  # noqa: E402
+from manageiq_tag_assignment import ManageIQTagAssignment  # noqa: E402
+
+
+CERTIFICATE = '-----BEGIN CERTIFICATE-----\n{0}\n-----END CERTIFICATE-----\n'.format('MIIB' * 300)
+
+
+def provider_endpoints(count, hostname='provider.example.com'):
+    """ Returns the desired endpoints of a provider with count roles, and the
+    endpoints as read from the API
+    """
+    desired = [{'endpoint': {'role': 'role{0}'.format(i), 'hostname': hostname, 'port': 8443 + i,
+                             'verify_ssl': True, 'certificate_authority': CERTIFICATE,
+                             'security_protocol': 'ssl-with-validation-custom-ca'},
+                'authentication': {'authtype': 'role{0}'.format(i), 'auth_key': 'token'}}
+               for i in range(count)]
+    existing = [dict(config['endpoint'], id=str(i), certificate_authority=CERTIFICATE.replace('\n', '\r\n'))
+                for i, config in enumerate(desired)]
+    return desired, existing
+
+
+def alert_options(count):
+    """ Returns large alert options, with None values the API adds, and the
+    same options as passed to the module
+    """
+    existing = {'notifications': {'delay_next_evaluation': 600, 'evm_event': {}}}
+    for i in range(count):
+        existing['option{0}'.format(i)] = None if i % 3 == 0 else {'value': i, 'unit': 'seconds'}
+    desired = dict((key, value) for key, value in existing.items() if value is not None)
+    return existing, desired
+
+
+def benchmarks(options):
+    """ Returns the benchmarked functions by name, each called without
+    arguments
+    """
+    provider = object.__new__(ManageIQProvider)
+    desired, existing = provider_endpoints(options.endpoints)
+    existing_config = {'zone_id': '1', 'endpoints': existing}
+    changed, _ = provider_endpoints(options.endpoints, hostname='other.example.com')
+    changed = changed[:options.endpoints // 2] + desired[options.endpoints // 2:-1]
+    configs = [dict(config, endpoint=dict(config['endpoint'], certificate_authority=None)) for config in desired]
+    existing_without_ca = [dict((k, v) for k, v in e.items() if k != 'certificate_authority') for e in existing]
+
+    def filter_unsupported_fields():
+        # the function removes the fields in place, every call gets a copy
+        copies = [{'endpoint': dict(config['endpoint'])} for config in configs]
+        provider.filter_unsupported_fields_from_config(copies, existing_without_ca, {'certificate_authority'})
+
+    existing_options, desired_options = alert_options(options.options)
+    expression = dict(('field{0}'.format(i), 'value') for i in range(options.options))
+    alert = {'expression': {'exp': dict(expression, ignored=None), 'context_type': None},
+             'options': existing_options, 'db': 'ContainerNode', 'enabled': True}
+    changed_options = dict(desired_options, notifications={'delay_next_evaluation': 60})
+
+    tags = [{'category': 'category{0}'.format(i % 50), 'name': 'tag{0}'.format(i)} for i in range(options.tags)]
+    assigned = set(ManageIQTagAssignment.full_tag_name(tag) for tag in tags[::2])
+
+    return {
+        'provider_required_updates_unchanged': lambda: provider.required_updates(
+            '1', desired, '1', None, existing_config),
+        'provider_required_updates_changed': lambda: provider.required_updates(
+            '1', changed, '2', 'region', existing_config),
+        'provider_filter_unsupported_fields': filter_unsupported_fields,
+        'alert_updates_unchanged': lambda: ManageIQAlert.alert_updates(
+            alert, 'miq_expression', expression, 'miq_expression', 'ContainerNode', desired_options, True),
+        'alert_updates_changed': lambda: ManageIQAlert.alert_updates(
+            alert, 'miq_expression', expression, 'miq_expression', 'ContainerNode', changed_options, True),
+        'tags_to_assign': lambda: ManageIQTagAssignment.tags_to_execute(tags, assigned, 'present'),
+        'tags_to_unassign': lambda: ManageIQTagAssignment.tags_to_execute(tags, assigned, 'absent'),
+    }
+
+
+def measure(function, min_time, repeat):
+    """ Returns the best time per call of function in microseconds, of repeat
+    loops of at least min_time seconds each
+    """
+    loops = 1
+    while True:
+        start = time.time()
+        for _ in range(loops):
+            function()
+        if time.time() - start >= min_time:
+            break
+        loops *= 2
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(loops):
+            function()
+        per_call = (time.time() - start) / loops
+        best = per_call if best is None else min(best, per_call)
+    return round(best * 1000000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0].strip())
+    parser.add_argument('--endpoints', type=int, default=50, help='number of endpoints of the provider')
+    parser.add_argument('--options', type=int, default=1000, help='number of keys of the alert options and expression')
+    parser.add_argument('--tags', type=int, default=5000, help='number of tags assigned and unassigned')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimal seconds of each measuring loop')
+    parser.add_argument('--repeat', type=int, default=5, help='number of measuring loops of each function')
+    parser.add_argument('--baseline', default=None, help='compare the results with this baseline file')
+    parser.add_argument('--max-slowdown', type=float, default=1.5,
+                        help='fail if a function is this many times slower than its baseline')
+    parser.add_argument('--save-baseline', default=None, help='save the results as a baseline to this file')
+    parser.add_argument('names', nargs='*', help='names of the benchmarks run, all by default')
+    options = parser.parse_args()
+
+    functions = benchmarks(options)
+    names = options.names or sorted(functions)
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if any(baseline.get('inputs', {}).get(key) != getattr(options, key) for key in ('endpoints', 'options', 'tags')):
+            parser.error('the baseline was measured with other inputs: {0}'.format(baseline.get('inputs')))
+
+    results = {'inputs': {'endpoints': options.endpoints, 'options': options.options, 'tags': options.tags},
+               'python': sys.version.split()[0], 'us_per_call': {}}
+    failed = False
+    for name in names:
+        us = measure(functions[name], options.min_time, options.repeat)
+        results['us_per_call'][name] = us
+        line = '{name:40} {us:12.2f} us'.format(name=name, us=us)
+        previous = baseline.get('us_per_call', {}).get(name)
+        if previous:
+            ratio = us / previous
+            line += '  {ratio:6.2f}x baseline'.format(ratio=ratio)
+            if ratio > options.max_slowdown:
+                line += '  slower than {0}x'.format(options.max_slowdown)
+                failed = True
+        print(line)
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+""" A fake ManageIQ appliance answering the API requests of the modules from
+memory, for the benchmarks.
+
+It serves the entry point, the collections passed (with paging and
+expand=resources), their resources and the subcollections of the resources
+(e.g. tags), gzip'ing the responses when the client accepts it, and answers
+every POST with a successful action. Each response can be delayed, to
+simulate the latency of a loaded appliance.
+
+    appliance = FakeAppliance({'alert_definitions': alert_definitions(5000)})
+    appliance.start()
+    client = ManageIQClient(appliance.api_url, ('admin', 'smartvm'))
+    ...
+    appliance.stop()
+"""
+
+import gzip
+import io
+import json
+import random
+import threading
+import time
+
+from ansible.module_utils.six.moves import BaseHTTPServer, socketserver
+from ansible.module_utils.six.moves.urllib.parse import parse_qs, urlparse
+
+
+def alert_definitions(count):
+    """ Returns count alert definitions, as read with expand=resources
+    """
+    return [{
+        'id': str(index),
+        'href': '/api/alert_definitions/{0}'.format(index),
+        'guid': '4ebca44e-190a-11e7-be91-{0:012d}'.format(index),
+        'description': 'Alert {0}'.format(index),
+        'db': 'ContainerNode',
+        'enabled': True,
+        'created_on': '2017-04-04T07:42:51Z',
+        'updated_on': '2017-04-04T07:42:51Z',
+        'expression': {'exp': {'eval_method': 'dwh_generic', 'mode': 'internal', 'options': {}},
+                       'context_type': None},
+        'options': {'notifications': {'delay_next_evaluation': 600, 'evm_event': {}}},
+    } for index in range(count)]
+
+
+def gzip_bytes(data):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+        gzip_file.write(data)
+    return buffer.getvalue()
+
+
+class FakeApplianceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # the headers and the body are written separately, with Nagle's algorithm
+    # the body waits for the client's delayed ACK of the headers
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.server.appliance.count(self.command, len(body))
+        self.server.appliance.delay()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip_bytes(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        path = url.path.rstrip('/').split('/')[2:]
+        collections = self.server.appliance.collections
+        if not path:
+            self.respond(dict(self.server.appliance.entry_point, collections=[
+                {'name': name, 'href': self.server.appliance.api_url + '/' + name, 'description': name}
+                for name in collections]))
+        elif path[0] not in collections:
+            self.respond({'error': {'klass': 'NotFound', 'message': 'Invalid resource {0}'.format(path[0])}}, 404)
+        elif len(path) == 1:
+            resources = collections[path[0]]
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', len(resources)))
+            page = resources[offset:offset + limit]
+            if 'resources' not in query.get('expand', ''):
+                page = [{'href': resource['href']} for resource in page]
+            self.respond({'name': path[0], 'count': len(resources), 'subcount': len(page), 'resources': page})
+        else:
+            resource = next((r for r in collections[path[0]] if r['id'] == path[1]), None)
+            if resource is None:
+                self.respond({'error': {'klass': 'NotFound', 'message': "Couldn't find resource"}}, 404)
+            elif len(path) > 2:
+                resources = resource.get(path[2], [])
+                self.respond({'name': path[2], 'count': len(resources), 'subcount': len(resources),
+                              'resources': resources})
+            else:
+                self.respond(resource)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        resources = payload.get('resources') or [payload.get('resource', {})]
+        self.respond({'success': True, 'message': '{0} done'.format(payload.get('action', 'create')),
+                      'results': [dict(resource, id=str(index + 1), success=True)
+                                  for index, resource in enumerate(resources)]})
+
+
+class FakeApplianceServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class FakeAppliance(object):
+    """ The fake appliance, listening on a random local port once started.
+
+    collections - the resources of each collection served, by collection name
+    version     - the API version returned by the entry point
+    latency     - seconds every response is delayed by
+    jitter      - at most this many more seconds, drawn uniformly, every
+                  response is delayed by
+    """
+
+    def __init__(self, collections, version='3.0.0', latency=0.0, jitter=0.0):
+        self.collections = collections
+        self.latency     = latency
+        self.jitter      = jitter
+        self.entry_point = {'name': 'API', 'version': version,
+                            'server_info': {'version': 'master', 'appliance': 'fake'}}
+        self.requests    = {}
+        self.sent_bytes  = 0
+        self.lock        = threading.Lock()
+        self.server      = FakeApplianceServer(('127.0.0.1', 0), FakeApplianceHandler)
+        self.server.appliance = self
+        self.api_url     = 'http://127.0.0.1:{0}/api'.format(self.server.server_address[1])
+        self.thread      = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def count(self, method, size):
+        """ Counts a request, and the size of its response before compression
+        """
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            self.sent_bytes += size
+
+    def delay(self):
+        """ Simulates the time the appliance takes to answer a request
+        """
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+""" Measures the bytes saved by gzip'd responses and the JSON decoding time of
+a large read, e.g. alert_definitions?expand=resources, against a fake
+appliance.
+
+The same collection is read with and without gzip, reporting the bytes
+received, and its content is decoded with each JSON backend available,
+reporting the decoding time alone and the time of the whole client read.
+
+    $ python benchmarks/json_decode.py --resources 5000 --runs 10
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+import ansible.module_utils
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ansible.module_utils.__path__.append(os.path.join(ROOT, 'module_utils'))
+
+from ansible.module_utils import manageiq_transport  # noqa: E402
+from fake_appliance import FakeAppliance, alert_definitions  # noqa: E402
+
+
+def stdlib_loads(content):
+    return json.loads(content.decode('utf-8'))
+
+
+def json_backends():
+    """ Returns the decode function of each JSON backend installed, by name
+    """
+    backends = {'json': stdlib_loads}
+    for name in ('simplejson', 'ujson', 'orjson'):
+        try:
+            backend = importlib.import_module(name)
+        except ImportError:
+            continue
+        backends[name] = backend.loads
+    return backends
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def timed(function, runs):
+    """ Returns the median wall time of function in milliseconds
+    """
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return round(median(times) * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0].strip())
+    parser.add_argument('--resources', type=int, default=5000, help='number of alert definitions read')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs of each measure')
+    parser.add_argument('--json', dest='json_path', default=None, help='write the results to this file')
+    options = parser.parse_args()
+
+    appliance = FakeAppliance({'alert_definitions': alert_definitions(options.resources)}).start()
+    results = {'resources': options.resources, 'default_backend': manageiq_transport.JSON_BACKEND}
+    try:
+        client = manageiq_transport.ManageIQClient(appliance.api_url, ('admin', 'smartvm'), retries=0)
+        url = appliance.api_url + '/alert_definitions?expand=resources'
+
+        for encoding in ('identity', 'gzip'):
+            client._session.headers['Accept-Encoding'] = encoding
+            stats = dict(client.stats)
+            client.get(url)
+            results[encoding] = dict((key, client.stats[key] - stats[key])
+                                     for key in ('received_bytes', 'response_bytes'))
+        results['bytes_saved'] = results['identity']['received_bytes'] - results['gzip']['received_bytes']
+        print('{0:>10} bytes received without gzip'.format(results['identity']['received_bytes']))
+        print('{0:>10} bytes received with gzip, {1} bytes ({2:.0%}) saved'.format(
+            results['gzip']['received_bytes'], results['bytes_saved'],
+            float(results['bytes_saved']) / results['identity']['received_bytes']))
+
+        content = client._session.get(url).content
+        default_loads = manageiq_transport.json_loads
+        results['backends'] = {}
+        for name, loads in sorted(json_backends().items()):
+            manageiq_transport.json_loads = loads
+            result = {'decode_ms': timed(lambda: loads(content), options.runs),
+                      'get_ms': timed(lambda: client.get(url), options.runs)}
+            results['backends'][name] = result
+            print('{name:>10} decode {decode_ms:8.2f} ms  get {get_ms:8.2f} ms'.format(name=name, **result))
+        manageiq_transport.json_loads = default_loads
+    finally:
+        appliance.stop()
+
+    if options.json_path:
+        with open(options.json_path, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
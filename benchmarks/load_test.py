@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+""" Measures how the manageiq modules behave as the number of concurrent
+module runs, e.g. Ansible forks, rises, against a fake appliance.
+
+For each concurrency level, the scenarios are run as many times as --runs,
+by as many concurrent processes as the level, every module run the way
+Ansible runs it. The fake appliance delays every response by --latency-ms,
+plus up to --jitter-ms, to simulate the appliance answering under load. The
+throughput of module runs, the percentiles of their duration, their error
+rate and the API requests they sent are reported for each level.
+
+The scenarios are:
+
+    tag      - assigns a tag already assigned to a provider
+    provider - a provider update with no changes
+    user     - updates the e-mail of a user
+
+Module options, e.g. miq_max_concurrency or miq_worker, can be added to every
+module run with --module-arg, to measure the limiter, the worker or the bulk
+options under load:
+
+    $ python benchmarks/load_test.py --concurrency 1,4,16,32 --runs 64 --latency-ms 50
+    $ python benchmarks/load_test.py --module-arg miq_max_concurrency=8 --json load.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_appliance import FakeAppliance
+from startup_time import ROOT, RUNNER
+
+
+PROVIDER_HOSTNAME = 'openshift.example.com'
+
+SCENARIOS = {
+    'tag': ('manageiq_tag_assignment', {
+        'resource': 'provider', 'resource_name': 'openshift01', 'state': 'present',
+        'tags': [{'category': 'environment', 'name': 'prod'}]}),
+    'provider': ('manageiq_provider', {
+        'name': 'openshift01', 'provider_type': 'openshift-origin', 'state': 'present',
+        'provider_api_hostname': PROVIDER_HOSTNAME, 'provider_api_port': 8443,
+        'provider_api_auth_token': 'token', 'provider_verify_ssl': False}),
+    'user': ('manageiq_user', {
+        'name': 'bob', 'fullname': 'Bob', 'password': 'smartvm', 'group': 'EvmGroup-user', 'state': 'present',
+        'email': 'bob@new.example.com'}),
+}
+
+
+def appliance_collections():
+    """ Returns the collections the scenarios read from the fake appliance
+    """
+    def resource(collection, resource_id, **attributes):
+        return dict(attributes, id=str(resource_id), href='/api/{0}/{1}'.format(collection, resource_id))
+    return {
+        'zones': [resource('zones', 1, name='default')],
+        'providers': [resource('providers', 1, name='openshift01', zone_id='1', endpoints=[
+            {'role': 'default', 'hostname': PROVIDER_HOSTNAME, 'port': 8443, 'verify_ssl': False,
+             'certificate_authority': None, 'security_protocol': 'ssl-without-validation'}],
+            tags=[{'id': '1', 'name': '/managed/environment/prod'}])],
+        'groups': [resource('groups', 1, description='EvmGroup-user')],
+        'users': [resource('users', 1, userid='bob', name='Bob', email='bob@example.com', current_group_id='1')],
+    }
+
+
+def parse_module_arg(value):
+    """ Parses a name=value module option, the value as JSON if it is valid JSON
+    """
+    name, _, value = value.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_module(module, args_path):
+    """ Runs the module the way Ansible runs it.
+
+    Returns:
+        the module run wall time in seconds, and its result, None if the
+        module didn't return one
+    """
+    code = RUNNER.format(module_utils=os.path.join(ROOT, 'module_utils'), args_path=args_path,
+                         module_path=os.path.join(ROOT, 'library', module + '.py'))
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    elapsed = time.time() - start
+    try:
+        result = json.loads(stdout.decode('utf-8').strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return elapsed, None
+    if process.returncode:
+        result['failed'] = True
+    return elapsed, result
+
+
+def run_level(concurrency, runs, scenarios):
+    """ Runs the scenarios, runs times in all, by concurrency processes at once.
+
+    scenarios - the (module, args path) of each scenario, run in turn
+
+    Returns:
+        the wall time of all the runs, and the (duration, result) of each
+    """
+    runs_left = list(range(runs))
+    outcomes = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not runs_left:
+                    return
+                run = runs_left.pop()
+            outcome = run_module(*scenarios[run % len(scenarios)])
+            with lock:
+                outcomes.append(outcome)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, outcomes
+
+
+def level_report(concurrency, elapsed, outcomes, server_requests):
+    durations = [duration for duration, _ in outcomes]
+    results = [result for _, result in outcomes]
+    errors = [result for result in results if not result or result.get('failed')]
+    stats = [result.get('api_stats', {}) for result in results if result]
+    return {
+        'concurrency': concurrency,
+        'runs': len(outcomes),
+        'throughput_per_s': round(len(outcomes) / elapsed, 2),
+        'p50_ms': round(percentile(durations, 0.5) * 1000, 1),
+        'p90_ms': round(percentile(durations, 0.9) * 1000, 1),
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 1),
+        'max_ms': round(max(durations) * 1000, 1),
+        'error_rate': round(float(len(errors)) / len(outcomes), 3),
+        'errors': sorted(set((result or {}).get('msg', 'no module result') for result in errors))[:5],
+        'server_requests': server_requests,
+        'requests_per_run': round(float(server_requests) / len(outcomes), 2),
+        'concurrency_wait_seconds': round(sum(s.get('concurrency_wait_seconds', 0) for s in stats), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0].strip())
+    parser.add_argument('--concurrency', default='1,2,4,8,16',
+                        help='comma separated numbers of concurrent module runs')
+    parser.add_argument('--runs', type=int, default=32, help='number of module runs at each concurrency level')
+    parser.add_argument('--scenarios', default=','.join(sorted(SCENARIOS)),
+                        help='comma separated scenarios, run in turn, of ' + ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='delay of every response of the appliance')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='additional random delay of every response')
+    parser.add_argument('--module-arg', action='append', default=[], type=parse_module_arg,
+                        help='name=value module option added to every module run, can be repeated')
+    parser.add_argument('--json', dest='json_path', default=None, help='write the results to this file')
+    options = parser.parse_args()
+
+    names = [name.strip() for name in options.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(unknown))
+    levels = [int(level) for level in options.concurrency.split(',')]
+
+    appliance = FakeAppliance(appliance_collections(), latency=options.latency_ms / 1000.0,
+                              jitter=options.jitter_ms / 1000.0).start()
+    work_dir = tempfile.mkdtemp(prefix='manageiq-load-')
+    results = {'scenarios': names, 'latency_ms': options.latency_ms, 'jitter_ms': options.jitter_ms,
+               'module_args': dict(options.module_arg), 'levels': []}
+    try:
+        scenarios = []
+        for name in names:
+            module, args = SCENARIOS[name]
+            args = dict(args, miq_url=appliance.api_url[:-len('/api')], miq_username='admin',
+                        miq_password='smartvm', miq_verify_ssl=False, miq_lock_dir=os.path.join(work_dir, 'locks'))
+            args.update(options.module_arg)
+            args_path = os.path.join(work_dir, name + '.json')
+            with open(args_path, 'w') as args_file:
+                json.dump({'ANSIBLE_MODULE_ARGS': args}, args_file)
+            scenarios.append((module, args_path))
+
+        print('{0:>11} {1:>5} {2:>10} {3:>9} {4:>9} {5:>9} {6:>7} {7:>9} {8:>9}'.format(
+            'concurrency', 'runs', 'runs/s', 'p50 ms', 'p90 ms', 'p99 ms', 'errors', 'req/run', 'wait s'))
+        for concurrency in levels:
+            requests = dict(appliance.requests)
+            elapsed, outcomes = run_level(concurrency, options.runs, scenarios)
+            server_requests = sum(appliance.requests.values()) - sum(requests.values())
+            report = level_report(concurrency, elapsed, outcomes, server_requests)
+            results['levels'].append(report)
+            print('{concurrency:>11} {runs:>5} {throughput_per_s:>10} {p50_ms:>9} {p90_ms:>9} {p99_ms:>9} '
+                  '{error_rate:>7.1%} {requests_per_run:>9} {concurrency_wait_seconds:>9}'.format(**report))
+            for error in report['errors']:
+                print('{0:>11} {1}'.format('', error))
+    finally:
+        appliance.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if options.json_path:
+        with open(options.json_path, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    return 1 if any(level['error_rate'] for level in results['levels']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
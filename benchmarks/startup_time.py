@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+""" Measures the startup time of the manageiq modules.
+
+Every module is run the way Ansible runs it, with module arguments that fail
+argument validation, so the measured time is the cost of starting the
+interpreter and importing the module and its module_utils. On Python 3.7 and
+later, the run is repeated with `python -X importtime` to report the import
+time of the top level packages and to check the ManageIQ client and requests,
+which the modules import only once they create a client, aren't imported.
+
+    $ python benchmarks/startup_time.py --runs 10 --max-ms 300
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the packages which should only be imported once a client is created
+HEAVY_PACKAGES = ('manageiq_client', 'requests', 'urllib3')
+
+RUNNER = '''
+import runpy, sys
+import ansible.module_utils
+ansible.module_utils.__path__.append({module_utils!r})
+sys.argv = ['module', {args_path!r}]
+runpy.run_path({module_path!r}, run_name='__main__')
+'''
+
+
+def run_module(module_path, args_path, importtime=False):
+    """ Runs the module and returns its wall time in seconds, and its stderr.
+    Without a module_path, runs an empty interpreter.
+    """
+    code = 'pass'
+    if module_path:
+        code = RUNNER.format(module_utils=os.path.join(ROOT, 'module_utils'),
+                             args_path=args_path, module_path=module_path)
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    return time.time() - start, stderr.decode('utf-8', 'replace')
+
+
+def parse_importtime(stderr):
+    """ Returns the cumulative import time in microseconds of each top level
+    package, from the output of python -X importtime
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        if not cumulative.isdigit():
+            continue
+        top_level = name.split('.')[0]
+        if name == top_level:
+            packages[top_level] = packages.get(top_level, 0) + int(cumulative)
+        else:
+            packages.setdefault(top_level, 0)
+    return packages
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0].strip())
+    parser.add_argument('--runs', type=int, default=5, help='number of runs of each module')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='fail if the median startup time of a module, over the startup time '
+                             'of an empty interpreter, exceeds it')
+    parser.add_argument('--json', dest='json_path', default=None, help='write the results to this file')
+    parser.add_argument('modules', nargs='*', help='module names, all the modules by default')
+    options = parser.parse_args()
+
+    modules = options.modules or sorted(os.path.basename(path)[:-3] for path in
+                                        glob.glob(os.path.join(ROOT, 'library', 'manageiq_*.py')))
+    fd, args_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as args_file:
+        json.dump({'ANSIBLE_MODULE_ARGS': {}}, args_file)
+
+    results = {}
+    failed = False
+    try:
+        baseline = median([run_module(None, None)[0] for _ in range(options.runs)])
+        results['interpreter_ms'] = round(baseline * 1000, 1)
+        print('{0:32} median {1:7.1f} ms'.format('(empty interpreter)', results['interpreter_ms']))
+        baseline_packages = {}
+        if sys.version_info >= (3, 7):
+            baseline_packages = parse_importtime(run_module(None, None, importtime=True)[1])
+        for module in modules:
+            module_path = os.path.join(ROOT, 'library', module + '.py')
+            times = [run_module(module_path, args_path)[0] for _ in range(options.runs)]
+            result = {'median_ms': round(median(times) * 1000, 1), 'min_ms': round(min(times) * 1000, 1),
+                      'overhead_ms': round((median(times) - baseline) * 1000, 1)}
+            if sys.version_info >= (3, 7):
+                packages = parse_importtime(run_module(module_path, args_path, importtime=True)[1])
+                # the packages imported by the module, besides the ones the
+                # interpreter imports on its own (e.g. from .pth files)
+                result['import_ms'] = dict((name, round(us / 1000.0, 1)) for name, us in packages.items()
+                                           if us >= 1000 and name not in baseline_packages)
+                result['heavy_imports'] = sorted(p for p in HEAVY_PACKAGES if p in packages)
+            results[module] = result
+
+            line = '{module:32} median {median_ms:7.1f} ms  min {min_ms:7.1f} ms  overhead {overhead_ms:7.1f} ms'.format(
+                module=module, **result)
+            if result.get('heavy_imports'):
+                line += '  imports ' + ', '.join(result['heavy_imports'])
+                failed = True
+            if options.max_ms is not None and result['overhead_ms'] > options.max_ms:
+                line += '  over {0} ms'.format(options.max_ms)
+                failed = True
+            print(line)
+    finally:
+        os.remove(args_path)
+
+    if options.json_path:
+        with open(options.json_path, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: manageiq
+    plugin_type: inventory
+    short_description: ManageIQ inventory source
+    requirements: [ ManageIQ/manageiq-api-client-python ]
+    author: Daniel Korn (@dkorn)
+    description:
+        - Reads VMs, hosts and container nodes from ManageIQ, and groups them by
+          their collection, provider and tags.
+        - Collections are read a page at a time, with only the attributes used by
+          the inventory, and the result can be kept in the Ansible inventory cache.
+        - Uses a YAML configuration file that ends with manageiq.yml or manageiq.yaml.
+    extends_documentation_fragment:
+        - constructed
+        - inventory_cache
+    options:
+        plugin:
+            description: token that ensures this is a source file for the 'manageiq' plugin.
+            required: true
+            choices: ['manageiq']
+        miq_url:
+            description: the manageiq environment url
+            required: true
+            env:
+                - name: MIQ_URL
+        miq_username:
+            description: manageiq username
+            required: true
+            env:
+                - name: MIQ_USERNAME
+        miq_password:
+            description: manageiq password
+            required: true
+            env:
+                - name: MIQ_PASSWORD
+        miq_verify_ssl:
+            description: whether SSL certificates should be verified for HTTPS requests
+            type: bool
+            default: true
+        ca_bundle_path:
+            description: the path to a CA_BUNDLE file or directory with certificates
+            default: null
+        collections:
+            description: the manageiq collections to read hosts from
+            type: list
+            default: ['vms', 'hosts', 'container_nodes']
+        page_size:
+            description: the number of resources read in a single request
+            type: int
+            default: 500
+        group_by_providers:
+            description: whether to create a group for each provider
+            type: bool
+            default: true
+        group_by_tags:
+            description: whether to create a group for each assigned tag
+            type: bool
+            default: true
+'''
+
+EXAMPLES = '''
+# manageiq.yml
+plugin: manageiq
+miq_url: 'http://localhost:3000'
+miq_username: 'admin'
+miq_password: '******'
+collections:
+  - vms
+  - container_nodes
+cache: true
+cache_timeout: 600
+keyed_groups:
+  - key: manageiq_power_state
+    prefix: power
+'''
+
+import os  # noqa: E402
+
+import ansible.module_utils  # noqa: E402
+from ansible.errors import AnsibleError  # noqa: E402
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable, Constructable  # noqa: E402
+
+# the inventory runs on the controller, where the module_utils directory of
+# this repository is not on the import path of ansible.module_utils
+ansible.module_utils.__path__.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils'))
+
+from ansible.module_utils.manageiq_utils import ManageIQClient, query_collection  # noqa: E402
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
+    """ Host inventory from the vms, hosts and container nodes of ManageIQ
+    """
+
+    NAME = 'manageiq'
+
+    # the attributes read for each collection, and the attribute used as the
+    # ansible_host of its resources
+    COLLECTIONS = {
+        'vms': (['name', 'ems_id', 'ipaddresses', 'power_state', 'vendor', 'guid'], 'ipaddresses'),
+        'hosts': (['name', 'ems_id', 'ipaddress', 'power_state', 'vmm_vendor', 'guid'], 'ipaddress'),
+        'container_nodes': (['name', 'ems_id', 'ready_condition_status'], 'name'),
+    }
+
+    def verify_file(self, path):
+        """ Returns True if the path is a manageiq inventory configuration file
+        """
+        if not super(InventoryModule, self).verify_file(path):
+            return False
+        return path.endswith(('manageiq.yml', 'manageiq.yaml'))
+
+    def fetch_inventory(self):
+        """ Reads the providers and the hosts of the configured collections.
+
+        Returns:
+            a compact dictionary of the provider names by id, and the hosts of
+            each collection with their ansible_host, provider id, tags and
+            attributes.
+        """
+        api_url = self.get_option('miq_url') + '/api'
+        page_size = self.get_option('page_size')
+        try:
+            client = ManageIQClient(api_url, (self.get_option('miq_username'), self.get_option('miq_password')),
+                                    verify_ssl=self.get_option('miq_verify_ssl'),
+                                    ca_bundle_path=self.get_option('ca_bundle_path'))
+            providers = dict((str(p['id']), p['name']) for p in
+                             query_collection(client, api_url, 'providers', 'expand=resources&attributes=id,name', page_size))
+            hosts = {}
+            for collection in self.get_option('collections'):
+                if collection not in InventoryModule.COLLECTIONS:
+                    raise AnsibleError("Unsupported manageiq collection {}".format(collection))
+                attributes, host_attribute = InventoryModule.COLLECTIONS[collection]
+                query = 'expand=resources,tags&attributes={}'.format(','.join(['id'] + attributes))
+                hosts[collection] = [self.compact_host(r, attributes, host_attribute)
+                                     for r in query_collection(client, api_url, collection, query, page_size)]
+        except AnsibleError:
+            raise
+        except Exception as e:
+            raise AnsibleError("Failed to read the inventory from manageiq: {}".format(e))
+        return {'providers': providers, 'hosts': hosts}
+
+    @staticmethod
+    def compact_host(resource, attributes, host_attribute):
+        """ Returns the parts of the resource used by the inventory
+        """
+        ansible_host = resource.get(host_attribute)
+        if isinstance(ansible_host, list):
+            ansible_host = ansible_host[0] if ansible_host else None
+        return {'id': str(resource['id']),
+                'ansible_host': ansible_host,
+                'provider_id': str(resource['ems_id']) if resource.get('ems_id') else None,
+                'tags': [tag['name'] for tag in resource.get('tags', [])],
+                'vars': dict((a, resource.get(a)) for a in attributes if a != 'ems_id')}
+
+    def populate(self, inventory_data):
+        """ Adds the hosts to the inventory and to their groups
+        """
+        strict = self.get_option('strict')
+        providers = inventory_data['providers']
+        for collection, hosts in inventory_data['hosts'].items():
+            collection_group = self.inventory.add_group(self._sanitize_group_name('manageiq_' + collection))
+            for host in hosts:
+                host_name = host['vars']['name'] or host['id']
+                self.inventory.add_host(host_name, group=collection_group)
+                if host['ansible_host']:
+                    self.inventory.set_variable(host_name, 'ansible_host', host['ansible_host'])
+                host_vars = dict(('manageiq_' + k, v) for k, v in host['vars'].items())
+                host_vars.update(manageiq_id=host['id'], manageiq_collection=collection,
+                                 manageiq_provider=providers.get(host['provider_id']),
+                                 manageiq_tags=host['tags'])
+                for k, v in host_vars.items():
+                    self.inventory.set_variable(host_name, k, v)
+
+                if self.get_option('group_by_providers') and host_vars['manageiq_provider']:
+                    group = self.inventory.add_group(self._sanitize_group_name('manageiq_provider_' + host_vars['manageiq_provider']))
+                    self.inventory.add_child(group, host_name)
+                if self.get_option('group_by_tags'):
+                    for tag in host['tags']:
+                        # /managed/environment/prod -> manageiq_tag_environment_prod
+                        group = self.inventory.add_group(self._sanitize_group_name(
+                            'manageiq_tag_' + '_'.join(tag.split('/')[2:])))
+                        self.inventory.add_child(group, host_name)
+
+                self._set_composite_vars(self.get_option('compose'), host_vars, host_name, strict=strict)
+                self._add_host_to_composed_groups(self.get_option('groups'), host_vars, host_name, strict=strict)
+                self._add_host_to_keyed_groups(self.get_option('keyed_groups'), host_vars, host_name, strict=strict)
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+
+        cache_key = self.get_cache_key(path)
+        # cache is the user's request to use the cache, the cache option
+        # whether the cache is enabled at all
+        use_cache = self.get_option('cache') and cache
+        update_cache = self.get_option('cache') and not cache
+
+        inventory_data = None
+        if use_cache:
+            try:
+                inventory_data = self._cache[cache_key]
+            except KeyError:
+                update_cache = True
+        if inventory_data is None:
+            inventory_data = self.fetch_inventory()
+        if update_cache:
+            self._cache[cache_key] = inventory_data
+
+        self.populate(inventory_data)
@@ -38,6 +38,21 @@ options:
         used to match alert definitions, therefor always required
     required: true
     default: null
+  resource_id:
+    description:
+      - the id of the alert definition in manageiq, used instead of looking up
+        the alert definition by its description. on absent, the alert
+        definition is checked to exist with a single request
+    required: false
+    default: null
+    aliases: ['alert_id']
+  href:
+    description:
+      - the href of the alert definition in manageiq, used instead of looking up
+        the alert definition by its description
+      - see the manageiq_resolve lookup plugin for resolving many names at once
+    required: false
+    default: null
   entity:
     description:
       - the entity to base the alert on in manageiq
@@ -74,6 +89,35 @@ options:
     required: false
     choices: ['present', 'absent']
     default: 'present'
+  snapshot_path:
+    description:
+      - path to a snapshot written by the manageiq_snapshot module, used instead
+        of manageiq as the source of the current state. can only be used in
+        check mode
+    required: false
+    default: null
+  fingerprint_dir:
+    description:
+      - directory of a local store of the fingerprints of the desired state last
+        applied to each alert. when the fingerprint of the desired state matches,
+        the alert current state is not read and compared, only its existence is
+        verified. the MIQ_FINGERPRINT_DIR env var is used if set
+    required: false
+    default: null
+  full_check_every:
+    description:
+      - when fingerprint_dir is used, the number of runs after which the alert
+        current state is read and compared even if the fingerprint matches
+    required: false
+    default: 10
+  result_detail:
+    description:
+      - how much of a change is returned. minimal returns the alert id, href
+        and the names of the changed fields, normal their values as well, and
+        full the API response as well
+    required: false
+    choices: ['minimal', 'normal', 'full']
+    default: minimal
 '''
 
 EXAMPLES = '''
@@ -98,7 +142,7 @@ EXAMPLES = '''
 '''
 
 import os
-from manageiq_client.api import ManageIQClient as MiqApi
+from ansible.module_utils.manageiq_utils import Capabilities, FingerprintStore, ManageIQClient as MiqApi, diff_result, fingerprint, load_snapshot, manageiq_client_argument_spec, manageiq_appliances_argument_spec, manageiq_client_options, manageiq_resource_argument_spec, manageiq_result_argument_spec, profiled, resource_exists, resource_id_from_params, result_details, run_on_appliances, traced
 
 
 class ManageIQAlert(object):
@@ -109,6 +153,9 @@ class ManageIQAlert(object):
     password       - the user password in manageiq
     miq_verify_ssl - whether SSL certificates should be verified for HTTPS requests
     ca_bundle_path - the path to a CA_BUNDLE file or directory with certificates
+    snapshot       - a Snapshot used instead of manageiq as the source of the current state
+    fingerprints   - a FingerprintStore of the desired states last applied to alerts
+    result_detail  - how much of a change is returned, see result_details
     """
 
     supported_entities = {
@@ -117,20 +164,29 @@ class ManageIQAlert(object):
         'miq_server': 'MiqServer', 'middleware_server': 'MiddlewareServer'
     }
 
-    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path):
+    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path, client_options=None, snapshot=None, fingerprints=None,
+                 result_detail='minimal'):
         self.module        = module
         self.api_url       = url + '/api'
         self.user          = user
         self.password      = password
-        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path)
+        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path, **(client_options or {}))
         self.changed       = False
+        self.snapshot      = snapshot
+        self.fingerprints  = fingerprints
+        self.result_detail = result_detail
+        self.capabilities  = Capabilities(self.client, self.api_url, (client_options or {}).get('lock_dir'))
 
+    @traced
     def find_alert_by_description(self, description):
         """ Searches the alert description in ManageIQ.
 
         Returns:
             the alert id if it exists in manageiq, None otherwise.
         """
+        if self.snapshot:
+            alert = self.snapshot.find('alert_definitions', description=description)
+            return alert and alert['id']
         try:
             response = self.client.get('{api_url}/alert_definitions?expand=resources'.format(api_url=self.api_url))
         except Exception as e:
@@ -138,17 +194,47 @@ class ManageIQAlert(object):
         alerts = response.get('resources', [])
         return next((alert['id'] for alert in alerts if alert['description'] == description), None)
 
-    def delete_alert(self, description):
-        """Deletes the alert from manageiq.
+    @traced
+    def alert_exists(self, alert_id):
+        """ Returns True if the alert with the id passed exists in manageiq,
+        False otherwise. Reads only the alert id.
+        """
+        try:
+            return resource_exists(self.client, self.api_url, 'alert_definitions', alert_id, self.snapshot)
+        except Exception as e:
+            self.module.fail_json(msg="Failed to query alert {alert_id}: {error}".format(alert_id=alert_id, error=e))
+
+    def record_fingerprint(self, description, desired_fingerprint, alert_id):
+        """ Stores the fingerprint of the desired state the alert converged to
+        """
+        if self.fingerprints:
+            self.fingerprints.record('alert', description, desired_fingerprint, alert_id)
+
+    @traced
+    def delete_alert(self, description, alert_id=None):
+        """Deletes the alert, given by its id or by its description, from manageiq.
 
         Returns:
             a short message describing the operation executed.
         """
-        alert_id = self.find_alert_by_description(description)
+        if alert_id:
+            # check the alert given by its id exists with a single small request
+            if not self.alert_exists(alert_id):
+                alert_id = None
+        else:
+            alert_id = self.find_alert_by_description(description)
         if not alert_id:  # alert doesn't exist
             return dict(
                 changed=self.changed,
                 msg="Alert {description} does not exist in manageiq".format(description=description))
+        if self.fingerprints:
+            self.fingerprints.forget('alert', description)
+        if self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                changed=self.changed,
+                msg="Alert {description} would be deleted".format(description=description)),
+                before={'description': description}, after={})
         try:
             url = '{api_url}/alert_definitions/{alert_id}'.format(api_url=self.api_url, alert_id=alert_id)
             result = self.client.post(url, action='delete')
@@ -157,41 +243,75 @@ class ManageIQAlert(object):
         self.changed = True
         return dict(changed=self.changed, msg=result['message'])
 
+    @traced
     def alert_update_required(self, alert_id, description, expression, expression_type, miq_entity, options, enabled):
-        """ Returns true if the expression, miq_entity, options, or enabled passed for
-            the alert differ from the alert's existing ones, False otherwise.
+        """ Checks whether the expression, miq_entity, options, or enabled passed for
+            the alert differ from the alert's existing ones.
+
+        Returns:
+            Empty Hash - If all the attributes passed equal the alert's current values
+            Hash of Changes - mapping each differing attribute to a (current, desired)
+                              tuple of its values
         """
         url = "{api_url}/alert_definitions/{alert_id}".format(api_url=self.api_url, alert_id=alert_id)
-        try:
-            result = self.client.get(url)
-        except Exception as e:
-            self.module.fail_json(msg="Failed to get alert {description} details. Error: {error}".format(description=description, error=e))
+        if self.snapshot:
+            result = self.snapshot.get('alert_definitions', alert_id)
+        else:
+            try:
+                result = self.client.get(url)
+            except Exception as e:
+                self.module.fail_json(msg="Failed to get alert {description} details. Error: {error}".format(description=description, error=e))
+
+        # appliances returning the expression_type tell how to read the
+        # expression, older ones are assumed to use the one passed
+        current_expression_type = expression_type
+        if self.capabilities.supports('alert_expression_type'):
+            current_expression_type = result.get('expression_type') or expression_type
+        return self.alert_updates(result, current_expression_type, expression, expression_type, miq_entity, options, enabled)
 
+    @staticmethod
+    def alert_updates(alert, current_expression_type, expression, expression_type, miq_entity, options, enabled):
+        """ Compares the alert, as returned by the API, with the attributes passed.
+
+        Returns:
+            a dictionary mapping each differing attribute to a (current, desired)
+            tuple of its values
+        """
         # remove None values from expression and options dicts, if needed
-        # TODO (dkorn): use the expression_type from the response, once supported
-        if expression_type == 'miq_expression':
-            current_expression = {k: v for k, v in result['expression']['exp'].items() if v is not None}
+        if current_expression_type == 'miq_expression':
+            current_expression = {k: v for k, v in alert['expression']['exp'].items() if v is not None}
         else:
-            current_expression = result['expression']
-        current_options = {k: v for k, v in result['options'].items() if v is not None}
+            current_expression = alert['expression']
+        current_options = {k: v for k, v in alert['options'].items() if v is not None}
 
-        attributes_tuples = [(current_expression, expression), (result['db'], miq_entity), (current_options, options), (result['enabled'], enabled)]
-        for (current, desired) in attributes_tuples:
-            if desired is not None and current != desired:
-                return True
-        return False
+        attributes_tuples = [('expression', current_expression, expression),
+                             ('expression_type', current_expression_type, expression_type),
+                             ('db', alert['db'], miq_entity),
+                             ('options', current_options, options), ('enabled', alert['enabled'], enabled)]
+        return {attribute: (current, desired) for (attribute, current, desired) in attributes_tuples
+                if desired is not None and current != desired}
 
-    def update_alert_if_required(self, alert_id, description, expression, expression_type, miq_entity, options, enabled):
+    @traced
+    def update_alert_if_required(self, alert_id, description, expression, expression_type, miq_entity, options, enabled, desired_fingerprint=None):
         """Updates the alert in manageiq.
 
         Returns:
             Whether or not a change took place and a message describing the
             operation executed.
         """
-        if not self.alert_update_required(alert_id, description, expression, expression_type, miq_entity, options, enabled):
+        updates = self.alert_update_required(alert_id, description, expression, expression_type, miq_entity, options, enabled)
+        if not updates:
+            self.record_fingerprint(description, desired_fingerprint, alert_id)
             return dict(
                 changed=self.changed,
                 msg="Alert {description} already exist, no need for updates".format(description=description))
+        if self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                changed=self.changed,
+                msg="Alert {description} would be updated".format(description=description)),
+                before={attribute: current for attribute, (current, desired) in updates.items()},
+                after={attribute: desired for attribute, (current, desired) in updates.items()})
 
         url = '{api_url}/alert_definitions/{alert_id}'.format(api_url=self.api_url, alert_id=alert_id)
         resource = {'description': description, 'expression': expression,
@@ -202,11 +322,15 @@ class ManageIQAlert(object):
         except Exception as e:
             self.module.fail_json(msg="Failed to update alert {description}: {error}".format(description=description, error=e))
         self.changed = True
-        return dict(
-            changed=self.changed,
-            msg="Successfully updated alert {description}: {alert_details}".format(description=description, alert_details=result))
+        self.record_fingerprint(description, desired_fingerprint, alert_id)
+        return result_details(self.result_detail, dict(
+            alert_id=alert_id, href=url, changed=self.changed,
+            msg="Successfully updated alert {description}".format(description=description)),
+            changed_fields=updates, updates={attribute: desired for attribute, (current, desired) in updates.items()},
+            payload=result)
 
-    def create_alert(self, description, expression, expression_type, miq_entity, options, enabled):
+    @traced
+    def create_alert(self, description, expression, expression_type, miq_entity, options, enabled, desired_fingerprint=None):
         """Creates the alert in manageiq.
 
         Returns:
@@ -217,28 +341,49 @@ class ManageIQAlert(object):
         resource = {'description': description, 'expression': expression,
                     'expression_type': expression_type, 'db': miq_entity,
                     'options': options, 'enabled': enabled}
+        if self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                changed=self.changed,
+                msg="Alert {description} would be created".format(description=description)),
+                before={}, after=resource)
         try:
             result = self.client.post(url, action='create', resource=resource)
             self.changed = True
-            return dict(
-                changed=self.changed,
-                msg="Successfully created alert {description}: {alert_details}".format(description=description, alert_details=result['results']))
+            alert_id = result['results'][0]['id']
+            if self.fingerprints:
+                self.record_fingerprint(description, desired_fingerprint, alert_id)
+            return result_details(self.result_detail, dict(
+                alert_id=alert_id, href=url + str(alert_id), changed=self.changed,
+                msg="Successfully created alert {description}".format(description=description)),
+                payload=result['results'])
         except Exception as e:
             self.module.fail_json(msg="Failed to create alert {description}: {error}".format(description=description, error=e))
 
-    def create_or_update_alert(self, description, expression, expression_type, entity, options, enabled):
-        """ Create or update an alert in manageiq.
+    @traced
+    def create_or_update_alert(self, description, expression, expression_type, entity, options, enabled, alert_id=None):
+        """ Create or update an alert in manageiq. The alert is looked up by its
+        description, unless its id is given.
 
         Returns:
             Whether or not a change took place and a message describing the
             operation executed.
         """
         miq_entity = ManageIQAlert.supported_entities[entity]
-        alert_id = self.find_alert_by_description(description)
+        desired_fingerprint = None
+        if self.fingerprints:
+            desired_fingerprint = fingerprint([description, expression, expression_type, miq_entity, options, enabled])
+            fingerprint_id = self.fingerprints.lookup('alert', description, desired_fingerprint)
+            if fingerprint_id and self.alert_exists(fingerprint_id):
+                return dict(
+                    changed=self.changed,
+                    msg="Alert {description} already exist, no need for updates".format(description=description))
+
+        alert_id = alert_id or self.find_alert_by_description(description)
         if alert_id:  # alert already exist
-            return self.update_alert_if_required(alert_id, description, expression, expression_type, miq_entity, options, enabled)
+            return self.update_alert_if_required(alert_id, description, expression, expression_type, miq_entity, options, enabled, desired_fingerprint)
         else:
-            return self.create_alert(description, expression, expression_type, miq_entity, options, enabled)
+            return self.create_alert(description, expression, expression_type, miq_entity, options, enabled, desired_fingerprint)
 
 
 def main():
@@ -261,22 +406,23 @@ def main():
             miq_username=dict(default=os.environ.get('MIQ_USERNAME', None)),
             miq_password=dict(default=os.environ.get('MIQ_PASSWORD', None), no_log=True),
             miq_verify_ssl=dict(require=False, type='bool', default=True),
-            ca_bundle_path=dict(required=False, type='str', defualt=None)
+            ca_bundle_path=dict(required=False, type='str', defualt=None),
+            snapshot_path=dict(required=False, type='path'),
+            fingerprint_dir=dict(required=False, type='path',
+                                 default=os.environ.get('MIQ_FINGERPRINT_DIR', None)),
+            full_check_every=dict(required=False, type='int', default=10),
+            **dict(manageiq_client_argument_spec(), **dict(manageiq_resource_argument_spec('alert_id'),
+                                                           **dict(manageiq_appliances_argument_spec(),
+                                                                  **manageiq_result_argument_spec())))
         ),
+        mutually_exclusive=[['resource_id', 'href'], ['miq_appliances', 'resource_id'],
+                            ['miq_appliances', 'href'], ['miq_appliances', 'snapshot_path']],
         required_if=[
             ('state', 'present', ['expression', 'entity', 'options'])
         ],
+        supports_check_mode=True,
     )
 
-    for arg in ['miq_url', 'miq_username', 'miq_password']:
-        if module.params[arg] in (None, ''):
-            module.fail_json(msg="missing required argument: {}".format(arg))
-
-    miq_url         = module.params['miq_url']
-    miq_username    = module.params['miq_username']
-    miq_password    = module.params['miq_password']
-    miq_verify_ssl  = module.params['miq_verify_ssl']
-    ca_bundle_path  = module.params['ca_bundle_path']
     description     = module.params['description']
     entity          = module.params['entity']
     options         = module.params['options']
@@ -284,19 +430,33 @@ def main():
     expression_type = module.params['expression_type']
     enabled         = module.params['enabled']
     state           = module.params['state']
+    alert_id        = resource_id_from_params(module.params)
+
+    snapshot        = load_snapshot(module, ['alert_definitions'])
+
+    def apply(module, connection):
+        miq_url      = connection['miq_url']
+        fingerprints = None
+        if module.params['fingerprint_dir']:
+            fingerprints = FingerprintStore(miq_url, module.params['fingerprint_dir'], module.params['full_check_every'],
+                                            module.check_mode)
 
-    manageiq = ManageIQAlert(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path)
-    if state == "present":
-        res_args = manageiq.create_or_update_alert(description, expression,
-                                                   expression_type, entity,
-                                                   options, enabled,)
-    if state == "absent":
-        res_args = manageiq.delete_alert(description)
+        manageiq = ManageIQAlert(module, miq_url, connection['miq_username'], connection['miq_password'],
+                                 connection['miq_verify_ssl'], connection['ca_bundle_path'],
+                                 manageiq_client_options(module.params), snapshot, fingerprints,
+                                 module.params['result_detail'])
+        if state == "present":
+            res_args = manageiq.create_or_update_alert(description, expression,
+                                                       expression_type, entity,
+                                                       options, enabled, alert_id)
+        if state == "absent":
+            res_args = manageiq.delete_alert(description, alert_id)
+        return dict(api_stats=manageiq.client.stats, **res_args)
 
-    module.exit_json(**res_args)
+    module.exit_json(**run_on_appliances(module, apply))
 
 
 # Import module bits
-from ansible.module_utils.basic import *
+from ansible.module_utils.basic import AnsibleModule
 if __name__ == "__main__":
-    main()
+    profiled('manageiq_alert', main)()
@@ -0,0 +1,350 @@
+#!/usr/bin/python
+
+
+DOCUMENTATION = '''
+---
+module: manageiq_alert_profile
+description: The manageiq_alert_profile module supports adding, updating and deleting alert definition profiles in ManageIQ, and assigning and unassigning many alert definitions to a profile at once.
+short_description: management of alert profiles in ManageIQ
+requirements: [ ManageIQ/manageiq-api-client-python ]
+author: Daniel Korn (@dkorn)
+options:
+  miq_url:
+    description:
+      - the manageiq environment url
+    default: MIQ_URL env var if set. otherwise, it is required to pass it
+  miq_username:
+    description:
+      - manageiq username
+    default: MIQ_USERNAME env var if set. otherwise, it is required to pass it
+  miq_password:
+    description:
+      - manageiq password
+    default: MIQ_PASSWORD env var if set. otherwise, it is required to pass it
+  miq_verify_ssl:
+    description:
+      - whether SSL certificates should be verified for HTTPS requests
+    required: false
+    default: True
+    choices: ['True', 'False']
+  ca_bundle_path:
+    description:
+      - the path to a CA_BUNDLE file or directory with certificates
+    required: false
+    default: null
+  name:
+    description:
+      - the alert profile description in manageiq. this is the primary key
+        used to match alert profiles, therefor always required
+    required: true
+    default: null
+  entity:
+    description:
+      - the entity the alerts of the profile are based on, required when the
+        profile is created
+    required: false
+    choices: ['container_node', 'vm', 'host', 'storage', 'cluster', 'ems', 'miq_server', 'middleware_server']
+    default: null
+  alerts:
+    description:
+      - the descriptions of the alert definitions assigned to the profile. the
+        ones not assigned yet are looked up with a filtered query for every 100
+        of them, and assigned with a single request
+    required: false
+    default: []
+  purge_alerts:
+    description:
+      - whether the alert definitions assigned to the profile and not in alerts
+        are unassigned, with a single request
+    required: false
+    default: false
+  notes:
+    description:
+      - the notes of the alert profile
+    required: false
+    default: null
+  state:
+    description:
+      - On present, it will create the alert profile if it does not exist, update
+        its notes if they differ, and assign the alerts to it
+      - On absent, it will delete the alert profile if it exists
+    required: false
+    choices: ['present', 'absent']
+    default: 'present'
+'''
+
+EXAMPLES = '''
+# Assign the container node alerts to a profile in ManageIQ
+  manageiq_alert_profile:
+    name: OpenShift Node Alerts
+    entity: container_node
+    alerts: '{{ node_alerts | map(attribute="description") | list }}'
+    purge_alerts: true
+    notes: managed by ansible
+    state: present
+    miq_url: 'http://localhost:3000'
+    miq_username: 'admin'
+    miq_password: '******'
+    miq_verify_ssl: False
+'''
+
+import os
+from ansible.module_utils.manageiq_utils import METRICS, ManageIQClient as MiqApi, diff_result, manageiq_client_argument_spec, manageiq_appliances_argument_spec, manageiq_client_options, name_filter, profiled, resolve_names, run_on_appliances, traced
+
+
+class ManageIQAlertProfile(object):
+    """ ManageIQ object to execute alert profile management operations in manageiq
+
+    url            - manageiq environment url
+    user           - the username in manageiq
+    password       - the user password in manageiq
+    miq_verify_ssl - whether SSL certificates should be verified for HTTPS requests
+    ca_bundle_path - the path to a CA_BUNDLE file or directory with certificates
+    """
+
+    supported_entities = {
+        'container_node': 'ContainerNode', 'vm': 'Vm', 'miq_server': 'MiqServer', 'host': 'Host',
+        'storage': 'Storage', 'cluster': 'EmsCluster', 'ems': 'ExtManagementSystem',
+        'middleware_server': 'MiddlewareServer'
+    }
+
+    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path, client_options=None):
+        self.module   = module
+        self.api_url  = url + '/api'
+        self.user     = user
+        self.password = password
+        self.client   = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path, **(client_options or {}))
+        self.changed  = False
+
+    @traced
+    def find_profile_by_name(self, name):
+        """ Searches the alert profile description in ManageIQ, reading the
+        profile and the alert definitions assigned to it with a single query.
+
+        Returns:
+            the alert profile, with its alert_definitions, if it exists in
+            manageiq, None otherwise.
+        """
+        url = '{api_url}/alert_definition_profiles?expand=resources,alert_definitions&{filter}'.format(
+            api_url=self.api_url, filter=name_filter('description', [name]))
+        try:
+            response = self.client.get(url)
+        except Exception as e:
+            self.module.fail_json(msg="Failed to query alert profiles: {error}".format(error=e))
+        profiles = response.get('resources', [])
+        return next((profile for profile in profiles if profile['description'] == name), None)
+
+    @traced
+    def find_alerts_by_description(self, descriptions):
+        """ Searches the alert descriptions in ManageIQ, with a filtered query
+        for every 100 of them, failing the module if any of them doesn't exist.
+
+        Returns:
+            the hrefs of the alerts, by description.
+        """
+        if not descriptions:
+            return {}
+        try:
+            hrefs = resolve_names(self.client, self.api_url, 'alert_definitions', descriptions)
+        except Exception as e:
+            self.module.fail_json(msg="Failed to query alerts: {error}".format(error=e))
+        missing = [description for description in descriptions if description not in hrefs]
+        if missing:
+            self.module.fail_json(msg="Alerts {descriptions} do not exist in manageiq".format(descriptions=', '.join(missing)))
+        return hrefs
+
+    @staticmethod
+    def membership_changes(assigned_alerts, alerts, purge_alerts):
+        """ Compares the alert definitions assigned to the profile with the
+        descriptions of the alerts passed.
+
+        Returns:
+            the descriptions of the alerts to assign, and the alert definitions
+            to unassign, only when purge_alerts is set.
+        """
+        assigned = set(alert['description'] for alert in assigned_alerts)
+        desired = set(alerts)
+        # assign each alert once, in the order given
+        to_assign = []
+        seen = set()
+        for description in alerts:
+            if description not in assigned and description not in seen:
+                to_assign.append(description)
+            seen.add(description)
+        to_unassign = []
+        if purge_alerts:
+            to_unassign = [alert for alert in assigned_alerts if alert['description'] not in desired]
+        return to_assign, to_unassign
+
+    @traced
+    def execute_action(self, profile_id, hrefs, action):
+        """ Assigns or unassigns the alert definitions, given by their hrefs,
+        to the profile with a single request.
+        """
+        url = '{api_url}/alert_definition_profiles/{profile_id}/alert_definitions'.format(
+            api_url=self.api_url, profile_id=profile_id)
+        METRICS.observe('manageiq_bulk_batch_size', len(hrefs), operation='alerts_' + action,
+                        collection='alert_definition_profiles')
+        try:
+            response = self.client.post(url, action=action, resources=[{'href': href} for href in hrefs])
+        except Exception as e:
+            self.module.fail_json(msg="Failed to {action} alerts: {error}".format(action=action, error=e))
+        results = response.get('results', [])
+        if len(results) != len(hrefs):
+            self.module.fail_json(msg="Failed to {action} alerts: {count} of {total} alerts were {action}ed".format(
+                action=action, count=len(results), total=len(hrefs)))
+        for result in results:
+            if not result.get('success', True):
+                self.module.fail_json(msg="Failed to {action} alerts: {fail_message}".format(
+                    action=action, fail_message=result.get('message')))
+        self.changed = True
+
+    @traced
+    def create_profile(self, name, miq_entity, notes):
+        """ Creates the alert profile in manageiq.
+
+        Returns:
+            the id of the alert profile created.
+        """
+        resource = {'description': name, 'mode': miq_entity}
+        if notes is not None:
+            resource['set_data'] = {'notes': notes}
+        try:
+            result = self.client.post('{api_url}/alert_definition_profiles'.format(api_url=self.api_url),
+                                      action='create', resource=resource)
+        except Exception as e:
+            self.module.fail_json(msg="Failed to create alert profile {name}: {error}".format(name=name, error=e))
+        self.changed = True
+        return result['results'][0]['id']
+
+    @traced
+    def update_profile(self, profile_id, name, notes):
+        """ Updates the notes of the alert profile in manageiq.
+        """
+        url = '{api_url}/alert_definition_profiles/{profile_id}'.format(api_url=self.api_url, profile_id=profile_id)
+        try:
+            self.client.post(url, action='edit', resource={'set_data': {'notes': notes}})
+        except Exception as e:
+            self.module.fail_json(msg="Failed to update alert profile {name}: {error}".format(name=name, error=e))
+        self.changed = True
+
+    @traced
+    def delete_profile(self, name):
+        """ Deletes the alert profile from manageiq.
+
+        Returns:
+            a short message describing the operation executed.
+        """
+        profile = self.find_profile_by_name(name)
+        if not profile:  # profile doesn't exist
+            return dict(
+                changed=self.changed,
+                msg="Alert profile {name} does not exist in manageiq".format(name=name))
+        if self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                changed=self.changed,
+                msg="Alert profile {name} would be deleted".format(name=name)),
+                before={'name': name}, after={})
+        try:
+            url = '{api_url}/alert_definition_profiles/{profile_id}'.format(api_url=self.api_url, profile_id=profile['id'])
+            result = self.client.post(url, action='delete')
+        except Exception as e:
+            self.module.fail_json(msg="Failed to delete alert profile {name}: {error}".format(name=name, error=e))
+        self.changed = True
+        return dict(changed=self.changed, msg=result['message'])
+
+    @traced
+    def create_or_update_profile(self, name, entity, alerts, purge_alerts, notes):
+        """ Creates the alert profile in manageiq, or updates its notes, and
+        assigns the alerts to it, unassigning the others if purge_alerts is set.
+
+        Returns:
+            Whether or not a change took place, a message describing the
+            operation executed and the alerts assigned and unassigned.
+        """
+        profile = self.find_profile_by_name(name)
+        if not profile and not entity:
+            self.module.fail_json(msg="Failed to create alert profile {name}: entity is required".format(name=name))
+        assigned_alerts = profile.get('alert_definitions', []) if profile else []
+        to_assign, to_unassign = self.membership_changes(assigned_alerts, alerts, purge_alerts)
+        # only the alerts not assigned yet are looked up
+        hrefs = self.find_alerts_by_description(to_assign)
+        current_notes = ((profile or {}).get('set_data') or {}).get('notes')
+        update_notes = profile is not None and notes is not None and notes != current_notes
+
+        assigned = sorted(alert['description'] for alert in assigned_alerts)
+        after = sorted(set(assigned) - set(alert['description'] for alert in to_unassign) | set(to_assign))
+        result = dict(assigned=to_assign, unassigned=[alert['description'] for alert in to_unassign])
+        if profile and not (to_assign or to_unassign or update_notes):
+            return dict(result, changed=self.changed, profile_id=str(profile['id']),
+                        msg="Alert profile {name} already exist, no need for updates".format(name=name))
+        if self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                result, changed=self.changed,
+                msg="Alert profile {name} would be {action}".format(name=name, action='updated' if profile else 'created')),
+                before=dict(alerts=assigned, notes=current_notes) if profile else {},
+                after=dict(alerts=after, notes=notes if notes is not None else current_notes))
+
+        if profile:
+            profile_id = profile['id']
+            if update_notes:
+                self.update_profile(profile_id, name, notes)
+        else:
+            profile_id = self.create_profile(name, self.supported_entities[entity], notes)
+        if to_assign:
+            self.execute_action(profile_id, [hrefs[description] for description in to_assign], 'assign')
+        if to_unassign:
+            self.execute_action(profile_id, [alert['href'] for alert in to_unassign], 'unassign')
+        return dict(result, changed=self.changed, profile_id=str(profile_id),
+                    msg="Successfully {action} alert profile {name}".format(
+                        name=name, action='updated' if profile else 'created'))
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            name=dict(required=True, type='str'),
+            entity=dict(required=False, type='str',
+                        choices=['container_node', 'vm', 'host', 'storage', 'cluster',
+                                 'ems', 'miq_server', 'middleware_server']),
+            alerts=dict(required=False, type='list', default=[]),
+            purge_alerts=dict(required=False, type='bool', default=False),
+            notes=dict(required=False, type='str'),
+            state=dict(required=False, type='str',
+                       choices=['present', 'absent'], default='present'),
+            miq_url=dict(default=os.environ.get('MIQ_URL', None)),
+            miq_username=dict(default=os.environ.get('MIQ_USERNAME', None)),
+            miq_password=dict(default=os.environ.get('MIQ_PASSWORD', None), no_log=True),
+            miq_verify_ssl=dict(require=False, type='bool', default=True),
+            ca_bundle_path=dict(required=False, type='str', defualt=None),
+            **dict(manageiq_client_argument_spec(), **manageiq_appliances_argument_spec())
+        ),
+        supports_check_mode=True,
+    )
+
+    name         = module.params['name']
+    entity       = module.params['entity']
+    alerts       = module.params['alerts']
+    purge_alerts = module.params['purge_alerts']
+    notes        = module.params['notes']
+    state        = module.params['state']
+
+    def apply(module, connection):
+        manageiq = ManageIQAlertProfile(module, connection['miq_url'], connection['miq_username'],
+                                        connection['miq_password'], connection['miq_verify_ssl'],
+                                        connection['ca_bundle_path'], manageiq_client_options(module.params))
+        if state == "present":
+            res_args = manageiq.create_or_update_profile(name, entity, alerts, purge_alerts, notes)
+        if state == "absent":
+            res_args = manageiq.delete_profile(name)
+        return dict(api_stats=manageiq.client.stats, **res_args)
+
+    module.exit_json(**run_on_appliances(module, apply))
+
+
+# Import module bits
+from ansible.module_utils.basic import AnsibleModule
+if __name__ == "__main__":
+    profiled('manageiq_alert_profile', main)()
@@ -1,8 +1,9 @@
 #!/usr/bin/python
 
 import os
-from ansible.module_utils.basic import *
-from manageiq_client.api import ManageIQClient as MiqApi
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.six.moves.urllib.parse import quote
+from ansible.module_utils.manageiq_utils import METRICS, ManageIQClient as MiqApi, diff_result, manageiq_client_argument_spec, manageiq_client_options, manageiq_resource_argument_spec, name_filter, profiled, query_collection, resource_id_from_params, traced
 
 
 DOCUMENTATION = '''
@@ -28,8 +29,49 @@ options:
   entity_name:
     description:
       - the entity name in manageiq to which the custom attributes belongs
-    required: true
+      - required unless resource_id (entity_id) or href is given
+    required: false
+    default: null
+  resource_id:
+    description:
+      - the id of the entity in manageiq, used instead of looking up entity_name.
+        the custom attributes read of the entity also checks it exists
+    required: false
     default: null
+    aliases: ['entity_id']
+  href:
+    description:
+      - the href of the entity in manageiq, used instead of looking up entity_name
+      - see the manageiq_resolve lookup plugin for resolving many names at once
+    required: false
+    default: null
+  entities:
+    description:
+      - the names of many entities in manageiq the custom attributes are set on,
+        or deleted from, instead of entity_name. an item can also be a
+        dictionary with the entity name and its own custom_attributes, a list
+        or a dictionary of attribute names and values. each entity can only be
+        given once
+      - the entities and their custom attributes are read with a filtered query
+        for every 100 entities, and only the entities whose custom attributes
+        differ are written to
+    required: false
+    default: null
+  entity_filter:
+    description:
+      - manageiq filter expressions, e.g. ems_id=3, of the entities the custom
+        attributes are set on, or deleted from, instead of entity_name. the
+        entities and their custom attributes are read with a single query for
+        every 500 entities
+    required: false
+    default: null
+  concurrency:
+    description:
+      - the number of entities written to at once, with entities or
+        entity_filter. miq_max_concurrency still limits the requests sent to
+        the appliance by all the modules at once
+    required: false
+    default: 4
   entity_type:
     description:
       - the entity type in manageiq to which the custom attributes belongs
@@ -48,7 +90,8 @@ options:
   custom_attributes:
     description:
       - the custom attributes of the entity
-    required: true
+      - required unless every item of entities has its own custom_attributes
+    required: false
     default: null
   miq_verify_ssl:
     description:
@@ -77,6 +120,33 @@ EXAMPLES = '''
         value: "value 1"
       - name: "ca2"
         value: "value 2"
+
+# Set the cost center of many VMs, each its own
+  manageiq_custom_attributes:
+    entity_type: 'vm'
+    entities:
+      - name: 'vm01'
+        custom_attributes:
+          cost_center: '1001'
+      - name: 'vm02'
+        custom_attributes:
+          cost_center: '1002'
+    concurrency: 8
+    miq_url: 'http://localhost:3000'
+    miq_username: 'admin'
+    miq_password: '******'
+
+# Set the cost center of all the VMs of a provider
+  manageiq_custom_attributes:
+    entity_type: 'vm'
+    entity_filter:
+      - 'ems_id=3'
+    custom_attributes:
+      - name: 'cost_center'
+        value: '1001'
+    miq_url: 'http://localhost:3000'
+    miq_username: 'admin'
+    miq_password: '******'
 '''
 
 
@@ -92,15 +162,18 @@ class ManageIQCustomAttributes(object):
     """
 
     supported_entities = {'vm': 'vms', 'provider': 'providers'}
+    # the keys of the custom attributes changed by each action, in the results
+    changed_keys = {'add': 'added', 'edit': 'updated', 'delete': 'deleted'}
 
-    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path):
+    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path, client_options=None):
         self.module        = module
         self.api_url       = url + '/api'
         self.user          = user
         self.password      = password
-        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path)
+        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path, **(client_options or {}))
         self.changed       = False
 
+    @traced
     def find_entity_by_name(self, entity_type, entity_name):
         """ Searches the entity name in ManageIQ.
 
@@ -110,6 +183,7 @@ class ManageIQCustomAttributes(object):
         entities_list = getattr(self.client.collections, ManageIQCustomAttributes.supported_entities[entity_type])
         return next((e.id for e in entities_list if e.name == entity_name), None)
 
+    @traced
     def get_entity_custom_attributes(self, entity_type, entity_id):
         """ Returns the entity's custom attributes
         """
@@ -124,8 +198,14 @@ class ManageIQCustomAttributes(object):
             self.module.fail_json(msg="Failed to get {entity_type} custom attributes. Error: {error}".format(
                 entity_type=entity_type, error=e))
 
+    @traced
     def add_custom_attributes(self, entity_type, entity_id, custom_attributes):
         """ Returns the added custom attributes """
+        if self.module.check_mode:
+            self.changed = True
+            return custom_attributes
+        METRICS.observe('manageiq_bulk_batch_size', len(custom_attributes), operation='custom_attributes_add',
+                        collection=ManageIQCustomAttributes.supported_entities[entity_type])
         try:
             url = '{api_url}/{entity_type}/{id}/custom_attributes'.format(
                 api_url=self.api_url,
@@ -137,27 +217,229 @@ class ManageIQCustomAttributes(object):
         except Exception as e:
             self.module.fail_json(msg="Failed to add the custom attributes. Error: {}".format(e))
 
-    def update_custom_attribute(self, entity_type, entity_id, ca, ca_href):
-        """ Returns the updated custom attributes """
+    @traced
+    def update_custom_attributes(self, entity_type, entity_id, custom_attributes):
+        """ Returns the updated custom attributes, given with their href """
+        if self.module.check_mode:
+            self.changed = True
+            return custom_attributes
+        METRICS.observe('manageiq_bulk_batch_size', len(custom_attributes), operation='custom_attributes_edit',
+                        collection=ManageIQCustomAttributes.supported_entities[entity_type])
         try:
             url = '{api_url}/{entity_type}/{id}/custom_attributes'.format(
                 api_url=self.api_url,
                 entity_type=ManageIQCustomAttributes.supported_entities[entity_type],
                 id=entity_id)
-            ca_object = {'name': ca['name'], 'href': ca_href, 'value': ca['value']}
-            result = self.client.post(url, action='edit', resources=[ca_object])
+            result = self.client.post(url, action='edit', resources=custom_attributes)
             self.changed = True
             return result['results']
         except Exception as e:
-            self.module.fail_json(msg="Failed to update the custom attribute {ca_name}. Error: {error}".format(ca_name=ca['name'], error=e))
+            self.module.fail_json(msg="Failed to update the custom attributes {ca_names}. Error: {error}".format(
+                ca_names=', '.join(ca['name'] for ca in custom_attributes), error=e))
 
     @staticmethod
     def compare_custom_attributes(ca1, ca2):
         return (ca1['name'], ca1['section']) == (ca2['name'], ca2['section'])
 
-    def add_or_update_custom_attributes(self, entity_type, entity_name, custom_attributes):
-        """ Adds custom attributes to an entity in manageiq or updates the
-        attributes in case already exists
+    @staticmethod
+    def normalize_custom_attributes(custom_attributes):
+        """ Returns the custom attributes as a list of dictionaries with their
+        name, value and section, metadata unless given. custom_attributes is a
+        list of such dictionaries, or a dictionary of the values by name.
+        """
+        if isinstance(custom_attributes, dict):
+            custom_attributes = [{'name': name, 'value': value} for name, value in sorted(custom_attributes.items())]
+        return [dict(ca, section=ca.get('section', 'metadata')) for ca in custom_attributes]
+
+    @staticmethod
+    def custom_attributes_changes(entity_cas, custom_attributes):
+        """ Compares the custom attributes of an entity with the ones passed.
+
+        Returns:
+            the custom attributes to add, the ones to update, given with their
+            href, and the values before and after the changes by name
+        """
+        to_add, to_update = [], []
+        before, after = {}, {}
+        for new_ca in custom_attributes:
+            existing_ca = next((ca for ca in entity_cas
+                                if ManageIQCustomAttributes.compare_custom_attributes(ca, new_ca)), None)
+            if existing_ca:
+                if new_ca['value'] != existing_ca['value']:
+                    before[new_ca['name']] = existing_ca['value']
+                    after[new_ca['name']] = new_ca['value']
+                    to_update.append({'name': new_ca['name'], 'href': existing_ca['href'], 'value': new_ca['value']})
+            else:
+                after[new_ca['name']] = new_ca['value']
+                to_add.append(new_ca)
+        return to_add, to_update, before, after
+
+    @staticmethod
+    def custom_attributes_to_delete(entity_cas, custom_attributes):
+        """ Returns the custom attributes of an entity matching the ones passed,
+        given with their name and href, and their values by name
+        """
+        to_delete, before = [], {}
+        for ca in entity_cas:
+            if any(ManageIQCustomAttributes.compare_custom_attributes(ca, new_ca) for new_ca in custom_attributes):
+                before[ca['name']] = ca.get('value')
+                to_delete.append({'name': ca['name'], 'href': ca['href']})
+        return to_delete, before
+
+    @traced
+    def query_entities_custom_attributes(self, entity_type, names=None, filters=None, batch_size=100, page_size=500):
+        """ Reads the entities with the names passed, with a filtered query for
+        every batch_size names, or the entities matching all the manageiq
+        filter expressions passed, a page_size entities at a time, each with
+        its custom attributes.
+
+        Returns:
+            the entities read, with their id, name and custom_attributes
+        """
+        collection = ManageIQCustomAttributes.supported_entities[entity_type]
+        query = 'expand=resources,custom_attributes&attributes=name'
+        if names is not None:
+            names = sorted(set(names))
+            queries = []
+            for i in range(0, len(names), batch_size):
+                METRICS.observe('manageiq_bulk_batch_size', len(names[i:i + batch_size]),
+                                operation='custom_attributes_read', collection=collection)
+                queries.append(query + '&' + name_filter('name', names[i:i + batch_size]))
+        else:
+            queries = [query + ''.join('&filter[]=' + quote(f.encode('utf-8'), safe='') for f in filters)]
+        entities = []
+        try:
+            for query in queries:
+                entities.extend(query_collection(self.client, self.api_url, collection, query, page_size))
+        except Exception as e:
+            self.module.fail_json(msg="Failed to query {entity_type} custom attributes. Error: {error}".format(
+                entity_type=entity_type, error=e))
+        return entities
+
+    def write_entity_custom_attributes(self, entity_type, entity_id, changes):
+        """ Sends the changes of the custom attributes of an entity, a single
+        request for each action, raising an exception if any of them failed.
+
+        changes - the custom attributes of each action, add, edit or delete
+        """
+        url = '{api_url}/{entity_type}/{id}/custom_attributes'.format(
+            api_url=self.api_url,
+            entity_type=ManageIQCustomAttributes.supported_entities[entity_type],
+            id=entity_id)
+        for action in ('add', 'edit', 'delete'):
+            if not changes.get(action):
+                continue
+            METRICS.observe('manageiq_bulk_batch_size', len(changes[action]), operation='custom_attributes_' + action,
+                            collection=ManageIQCustomAttributes.supported_entities[entity_type])
+            result = self.client.post(url, action=action, resources=changes[action])
+            failed = [r for r in result.get('results', []) if not r.get('success', True)]
+            if failed:
+                raise Exception(failed[0].get('message'))
+
+    @traced
+    def set_entities_custom_attributes(self, entity_type, entities, entity_filter, custom_attributes, state, concurrency=4):
+        """ Sets the custom attributes of many entities, or deletes them when
+        state is absent. The entities are given by their names, each with its
+        own custom attributes, or by manageiq filter expressions, all with the
+        custom_attributes passed. Only the entities whose custom attributes
+        differ are written to, concurrency entities at once.
+
+        Returns:
+            whether or not a change took place, a short message describing the
+            operation executed and the changes of each entity changed
+        """
+        if entities is not None:
+            # the changes of an entity are planned from its state before the
+            # writes, an entity given twice would be written to twice at once
+            names = [e['name'] for e in entities]
+            duplicates = sorted(set(name for name in names if names.count(name) > 1))
+            if duplicates:
+                self.module.fail_json(
+                    msg="Failed to set the custom attributes. {entity_type} {names} are given more than once".format(
+                        entity_type=entity_type, names=', '.join(duplicates)))
+            found = {}
+            for entity in self.query_entities_custom_attributes(entity_type, names=[e['name'] for e in entities]):
+                # like entity_name, a name matching many entities stands for the first one
+                found.setdefault(entity['name'], entity)
+            missing = [e['name'] for e in entities if e['name'] not in found]
+            if missing:
+                self.module.fail_json(
+                    msg="Failed to set the custom attributes. {entity_type} {names} do not exist".format(
+                        entity_type=entity_type, names=', '.join(missing)))
+            targets = [(found[e['name']], e['custom_attributes']) for e in entities]
+        else:
+            targets = [(entity, custom_attributes)
+                       for entity in self.query_entities_custom_attributes(entity_type, filters=entity_filter)]
+
+        changes = []
+        before, after = {}, {}
+        for entity, entity_custom_attributes in targets:
+            entity_cas = entity.get('custom_attributes', [])
+            if state == 'present':
+                to_add, to_update, entity_before, entity_after = self.custom_attributes_changes(entity_cas, entity_custom_attributes)
+                entity_changes = {'add': to_add, 'edit': to_update}
+            else:
+                to_delete, entity_before = self.custom_attributes_to_delete(entity_cas, entity_custom_attributes)
+                entity_changes, entity_after = {'delete': to_delete}, {}
+            if any(entity_changes.values()):
+                changes.append((entity, entity_changes))
+                before[entity['name']] = entity_before
+                after[entity['name']] = entity_after
+
+        action = 'set on' if state == 'present' else 'deleted from'
+        if not changes:
+            return dict(changed=self.changed, entities=[],
+                        msg="The custom attributes are already {action} {count} {entity_type}s".format(
+                            action='set on' if state == 'present' else 'absent from', count=len(targets),
+                            entity_type=entity_type))
+        results = [dict(name=entity['name'], id=str(entity['id']),
+                        **dict((self.changed_keys[action_name], [ca['name'] for ca in cas])
+                               for action_name, cas in entity_changes.items() if cas))
+                   for entity, entity_changes in changes]
+        if self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                changed=self.changed, entities=results,
+                msg="The custom attributes would be {action} {count} of {total} {entity_type}s".format(
+                    action=action, count=len(changes), total=len(targets), entity_type=entity_type)),
+                before=before, after=after)
+
+        def write(change):
+            entity, entity_changes = change
+            try:
+                self.write_entity_custom_attributes(entity_type, entity['id'], entity_changes)
+                return None
+            except Exception as e:
+                return "{name}: {error}".format(name=entity['name'], error=e)
+
+        # imported here, as most runs set the custom attributes of a single entity
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, min(len(changes), concurrency or 1)))
+        try:
+            errors = pool.map(write, changes)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = [error for error in errors if error]
+        self.changed = len(failed) < len(changes)
+        results = [result for result, error in zip(results, errors) if not error]
+        if failed:
+            self.module.fail_json(
+                msg="Failed to set the custom attributes of {count} of {total} {entity_type}s: {errors}".format(
+                    count=len(failed), total=len(changes), entity_type=entity_type, errors='; '.join(failed[:10])),
+                changed=self.changed, entities=results)
+        return diff_result(self.module, dict(
+            changed=self.changed, entities=results,
+            msg="Successfully {action} the custom attributes of {count} of {total} {entity_type}s".format(
+                action='set' if state == 'present' else 'deleted', count=len(changes), total=len(targets),
+                entity_type=entity_type)),
+            before=before, after=after)
+
+    @traced
+    def add_or_update_custom_attributes(self, entity_type, entity_name, custom_attributes, entity_id=None):
+        """ Adds custom attributes to an entity in manageiq, given by its id or
+        by its name, or updates the attributes in case already exists
 
         Returns:
             the added or updated custom attributes, whether or not a change
@@ -166,86 +448,108 @@ class ManageIQCustomAttributes(object):
         added, updated = [], []
         message = ""
         # check if entity with the type and name passed exists in manageiq
-        entity_id = self.find_entity_by_name(entity_type, entity_name)
+        entity_id = entity_id or self.find_entity_by_name(entity_type, entity_name)
         if not entity_id:  # entity doesn't exist
             self.module.fail_json(
                 msg="Failed to set the custom attributes. {entity_type} {entity_name} does not exist".format(entity_type=entity_type, entity_name=entity_name))
+        entity_name = entity_name or entity_id
 
+        # the attributes to add and to update are sent in a single request each
         entity_cas = self.get_entity_custom_attributes(entity_type, entity_id)
-        for new_ca in custom_attributes:
-            existing_ca = next((ca for ca in entity_cas if self.compare_custom_attributes(ca, new_ca)), None)
-            if existing_ca:
-                if new_ca['value'] != existing_ca['value']:
-                    updated.extend(self.update_custom_attribute(entity_type, entity_id, new_ca, existing_ca['href']))
-            else:
-                added.extend(self.add_custom_attributes(entity_type, entity_id, [new_ca]))
-
-        if added or updated:
+        to_add, to_update, before, after = self.custom_attributes_changes(entity_cas, custom_attributes)
+        if to_add:
+            added = self.add_custom_attributes(entity_type, entity_id, to_add)
+        if to_update:
+            updated = self.update_custom_attributes(entity_type, entity_id, to_update)
+
+        if (added or updated) and self.module.check_mode:
+            message = "The custom attributes would be set to {entity_name} {entity_type}"
+        elif added or updated:
             message = "Successfully set the custom attributes to {entity_name} {entity_type}"
         else:
             message = "The custom attributes already exist on {entity_name} {entity_type}"
 
-        return dict(
+        return diff_result(self.module, dict(
             changed=self.changed,
             msg=message.format(entity_name=entity_name, entity_type=entity_type),
             updates={"Added": added, "Updated": updated}
-        )
+        ), before=before, after=after)
 
-    def delete_custom_attribute(self, ca, ca_href, entity_type, entity_id):
-        """ Returns the deleted custom attribute
-        """
+    @traced
+    def delete_entity_custom_attributes(self, entity_type, entity_id, custom_attributes):
+        """ Returns the deleted custom attributes, given with their href """
+        if self.module.check_mode:
+            self.changed = True
+            return custom_attributes
+        METRICS.observe('manageiq_bulk_batch_size', len(custom_attributes), operation='custom_attributes_delete',
+                        collection=ManageIQCustomAttributes.supported_entities[entity_type])
         try:
             url = '{api_url}/{entity_type}/{id}/custom_attributes'.format(
                 api_url=self.api_url,
                 entity_type=ManageIQCustomAttributes.supported_entities[entity_type],
                 id=entity_id)
-            ca_object = {'name': ca['name'], 'href': ca_href}
-            result = self.client.post(url, action='delete', resources=[ca_object])
+            result = self.client.post(url, action='delete', resources=custom_attributes)
             self.changed = True
             return result['results']
         except Exception as e:
-            self.module.fail_json(msg="Failed to delete the custom attribute {ca}. Error: {error}".format(ca=ca, error=e))
+            self.module.fail_json(msg="Failed to delete the custom attributes {ca_names}. Error: {error}".format(
+                ca_names=', '.join(ca['name'] for ca in custom_attributes), error=e))
 
-    def delete_custom_attributes(self, entity_type, entity_name, custom_attributes):
-        """ Deletes the custom attributes from the entity, if exist
+    @traced
+    def delete_custom_attributes(self, entity_type, entity_name, custom_attributes, entity_id=None):
+        """ Deletes the custom attributes from the entity, given by its id or by
+        its name, if exist
 
         Returns:
             whether or not a change took and a short message including the
             deleted custom attributes
         """
         deleted = []
-        entity_id = self.find_entity_by_name(entity_type, entity_name)
+        entity_id = entity_id or self.find_entity_by_name(entity_type, entity_name)
         if not entity_id:  # entity doesn't exist
             self.module.fail_json(
                 msg="Failed to delete the custom attributes. {entity_type} {entity_name} does not exist".format(entity_type=entity_type, entity_name=entity_name))
+        entity_name = entity_name or entity_id
 
+        # the attributes to delete are sent in a single request
         entity_cas = self.get_entity_custom_attributes(entity_type, entity_id)
-        for new_ca in custom_attributes:
-            ca_href = next((ca['href'] for ca in entity_cas if self.compare_custom_attributes(ca, new_ca)), None)
-            if ca_href:
-                deleted.extend(self.delete_custom_attribute(new_ca, ca_href, entity_type, entity_id))
+        to_delete, before = self.custom_attributes_to_delete(entity_cas, custom_attributes)
+        if to_delete:
+            deleted = self.delete_entity_custom_attributes(entity_type, entity_id, to_delete)
 
-        return dict(
-            msg="Successfully deleted the following custom attributes from {entity_name} {entity_type}: {deleted}".format(entity_name=entity_name, entity_type=entity_type, deleted=deleted),
+        if self.module.check_mode:
+            message = "The following custom attributes would be deleted from {entity_name} {entity_type}: {deleted}"
+        else:
+            message = "Successfully deleted the following custom attributes from {entity_name} {entity_type}: {deleted}"
+        return diff_result(self.module, dict(
+            msg=message.format(entity_name=entity_name, entity_type=entity_type, deleted=deleted),
             changed=self.changed
-        )
+        ), before=before, after={})
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            entity_name=dict(required=True, type='str'),
+            entity_name=dict(required=False, type='str'),
             entity_type=dict(required=True, type='str',
                              choices=['provider', 'vm']),
             state=dict(require=False, default='present',
                        choices=['present', 'absent']),
-            custom_attributes=dict(required=True, type='list'),
+            custom_attributes=dict(required=False, type='list'),
+            entities=dict(required=False, type='list'),
+            entity_filter=dict(required=False, type='list'),
+            concurrency=dict(required=False, type='int', default=4),
             miq_url=dict(default=os.environ.get('MIQ_URL', None)),
             miq_username=dict(default=os.environ.get('MIQ_USERNAME', None)),
             miq_password=dict(default=os.environ.get('MIQ_PASSWORD', None), no_log=True),
             miq_verify_ssl=dict(require=False, type='bool', default=True),
             ca_bundle_path=dict(required=False, type='str', defualt=None),
-        )
+            **dict(manageiq_client_argument_spec(), **manageiq_resource_argument_spec('entity_id'))
+        ),
+        required_one_of=[['entity_name', 'resource_id', 'href', 'entities', 'entity_filter']],
+        mutually_exclusive=[['resource_id', 'href'], ['entity_name', 'resource_id', 'entities', 'entity_filter'],
+                            ['href', 'entities', 'entity_filter']],
+        supports_check_mode=True,
     )
 
     for arg in ['miq_url', 'miq_username', 'miq_password']:
@@ -261,20 +565,34 @@ def main():
     custom_attributes = module.params['custom_attributes']
     miq_verify_ssl    = module.params['miq_verify_ssl']
     ca_bundle_path    = module.params['ca_bundle_path']
-
-    for ca in custom_attributes:
-        if 'section' not in ca:
-            ca['section'] = 'metadata'
-
-    manageiq = ManageIQCustomAttributes(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path)
-    if state == 'present':
+    entity_id         = resource_id_from_params(module.params)
+    entities          = module.params['entities']
+
+    if custom_attributes is not None:
+        custom_attributes = ManageIQCustomAttributes.normalize_custom_attributes(custom_attributes)
+    if entities is not None:
+        entities = [entity if isinstance(entity, dict) else {'name': entity} for entity in entities]
+        if any('name' not in entity for entity in entities):
+            module.fail_json(msg="entities items should be names, or dictionaries with a name")
+        entities = [dict(name=entity['name'], custom_attributes=ManageIQCustomAttributes.normalize_custom_attributes(
+            entity['custom_attributes']) if entity.get('custom_attributes') is not None else custom_attributes)
+            for entity in entities]
+    if custom_attributes is None and (entities is None or any(e['custom_attributes'] is None for e in entities)):
+        module.fail_json(msg="missing required argument: custom_attributes")
+
+    manageiq = ManageIQCustomAttributes(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path,
+                                        manageiq_client_options(module.params))
+    if entities is not None or module.params['entity_filter']:
+        res_args = manageiq.set_entities_custom_attributes(entity_type, entities, module.params['entity_filter'],
+                                                           custom_attributes, state, module.params['concurrency'])
+    elif state == 'present':
         res_args = manageiq.add_or_update_custom_attributes(entity_type, entity_name,
-                                                            custom_attributes)
+                                                            custom_attributes, entity_id)
     elif state == 'absent':
         res_args = manageiq.delete_custom_attributes(entity_type, entity_name,
-                                                     custom_attributes)
-    module.exit_json(**res_args)
+                                                     custom_attributes, entity_id)
+    module.exit_json(api_stats=manageiq.client.stats, **res_args)
 
 
 if __name__ == "__main__":
-    main()
+    profiled('manageiq_custom_attributes', main)()
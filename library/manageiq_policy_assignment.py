@@ -1,8 +1,8 @@
 #!/usr/bin/python
 
 import os
-from ansible.module_utils.basic import *
-from manageiq_client.api import ManageIQClient as MiqApi
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.manageiq_utils import ManageIQClient as MiqApi, diff_result, manageiq_client_argument_spec, manageiq_appliances_argument_spec, manageiq_client_options, manageiq_resource_argument_spec, profiled, resource_exists, resource_id_from_params, run_on_appliances, traced
 
 
 DOCUMENTATION = '''
@@ -33,7 +33,14 @@ options:
   entity_name:
     description:
       - the entity name in manageiq
-    required: true
+      - required unless entity_id is given
+    required: false
+    default: null
+  entity_id:
+    description:
+      - the entity id in manageiq, used instead of looking up entity_name.
+        the entity is checked to exist with a single request
+    required: false
     default: null
   resource:
     description:
@@ -44,7 +51,20 @@ options:
   resource_name:
     description:
       - the relevant resource name in manageiq
-    required: true
+      - required unless resource_id or href is given
+    required: false
+    default: null
+  resource_id:
+    description:
+      - the relevant resource id in manageiq, used instead of looking up resource_name.
+        the resource is checked to exist with a single request
+    required: false
+    default: null
+  href:
+    description:
+      - the relevant resource href in manageiq, used instead of looking up resource_name
+      - see the manageiq_resolve lookup plugin for resolving many names at once
+    required: false
     default: null
   state:
     description:
@@ -101,14 +121,15 @@ class ManageIQ(object):
         'present': 'assign', 'absent': 'unassign'
     }
 
-    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path):
+    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path, client_options=None):
         self.module        = module
         self.api_url       = url + '/api'
         self.user          = user
         self.password      = password
-        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path)
+        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path, **(client_options or {}))
         self.changed       = False
 
+    @traced
     def find_entity_by_name(self, entity_type, entity_name):
         """ Searches the entity name in ManageIQ.
 
@@ -118,6 +139,7 @@ class ManageIQ(object):
         entities_list = getattr(self.client.collections, entity_type)
         return next((e.id for e in entities_list if e.name == entity_name), None)
 
+    @traced
     def query_resource_policies_or_profiles(self, entity_type, resource_type, resource_id):
         """ Returns the policies or policy profiles assigned to the resource.
         """
@@ -132,8 +154,9 @@ class ManageIQ(object):
         """Return True if the action is needed on the resource, False otherwise.
         """
         assigned_entities = self.query_resource_policies_or_profiles(entity_type, resource_type, resource_id)
-        return any(ae['id'] == entity_id for ae in assigned_entities)
+        return any(str(ae['id']) == str(entity_id) for ae in assigned_entities)
 
+    @traced
     def execute_action(self, entity_type, entity_id, resource_type, resource_id, action):
         """Executes the action for the relevant entity on the resource.
 
@@ -152,12 +175,29 @@ class ManageIQ(object):
                     msg=result['results'][0]['message']
                 )
             else:
-                self.module.fail_json(msg="Failed to {action}: {fail_message}".format(action=action, entity=entity, fail_message=result['results'][0]['message']))
+                self.module.fail_json(msg="Failed to {action}: {fail_message}".format(action=action, fail_message=result['results'][0]['message']))
+        except Exception as e:
+            self.module.fail_json(msg="Failed to {action}: {error}".format(action=action, error=e))
+
+    @traced
+    def check_id_exists(self, kind, resource_id, entity, state):
+        """ Checks the policy, policy profile or resource given by its id exists
+        in manageiq, with a single small request.
+        """
+        try:
+            exists = resource_exists(self.client, self.api_url, self.manageiq_entities[kind], resource_id)
         except Exception as e:
-            self.module.fail_json(msg="Failed to {action}: {error}".format(action=action, entity=entity, error=e))
+            self.module.fail_json(msg="Failed to {action} {entity}: failed to query {kind} {resource_id}: {error}".format(
+                action=ManageIQ.policy_actions[state], entity=entity, kind=kind, resource_id=resource_id, error=e))
+        if not exists:
+            self.module.fail_json(
+                msg="Failed to {action} {entity}: {kind} {resource_id} does not exist in manageiq".format(
+                    action=ManageIQ.policy_actions[state], entity=entity, kind=kind, resource_id=resource_id))
 
-    def assign_or_unassign_entity(self, entity, entity_name, resource, resource_name, state):
-        """ Assign or unassign the entity on the manageiq resource.
+    @traced
+    def assign_or_unassign_entity(self, entity, entity_name, resource, resource_name, state, resource_id=None, entity_id=None):
+        """ Assign or unassign the entity on the manageiq resource, each given by
+        its id or by its name.
 
         Returns:
             Whether or not a change took place and a message describing the
@@ -165,26 +205,42 @@ class ManageIQ(object):
         """
         entity_type = self.manageiq_entities[entity]
         resource_type = self.manageiq_entities[resource]
-        entity_id = self.find_entity_by_name(entity_type, entity_name)
+        if entity_id:
+            self.check_id_exists(entity, entity_id, entity, state)
+        else:
+            entity_id = self.find_entity_by_name(entity_type, entity_name)
         if not entity_id:  # entity doesn't exist
             self.module.fail_json(
                 msg="Failed to {action} {entity}: {entity_name} does not exist in manageiq".format(action=ManageIQ.policy_actions[state], entity=entity, entity_name=entity_name))
 
-        resource_id = self.find_entity_by_name(resource_type, resource_name)
+        if resource_id:
+            self.check_id_exists(resource, resource_id, entity, state)
+        else:
+            resource_id = self.find_entity_by_name(resource_type, resource_name)
         if not resource_id:  # resource doesn't exist
             self.module.fail_json(
                 msg="Failed to {action} {entity}: {resource_name} {resource} does not exist in manageiq".format(action=ManageIQ.policy_actions[state], entity=entity, resource_name=resource_name, resource=resource))
 
         assigned = self.entity_assigned(entity_type, entity_id, resource_type, resource_id)
         if assigned and state == 'absent':
-            return self.execute_action(entity_type, entity_id, resource_type, resource_id, 'unassign')
-        if (not assigned) and state == 'present':
-            return self.execute_action(entity_type, entity_id, resource_type, resource_id, 'assign')
-
-        #  Default case is that there's nothing to change
-        return dict(
-            changed=self.changed,
-            msg="{entity_name} {entity} already {action}ed".format(entity_name=entity_name, entity=entity, action=ManageIQ.policy_actions[state]))
+            action = 'unassign'
+        elif (not assigned) and state == 'present':
+            action = 'assign'
+        else:
+            return dict(
+                changed=self.changed,
+                msg="{entity} {entity_name} already {action}ed, nothing to do".format(
+                    entity=entity, entity_name=entity_name or entity_id, action=ManageIQ.policy_actions[state]))
+        if self.module.check_mode:
+            self.changed = True
+            res_args = dict(
+                changed=self.changed,
+                msg="{entity} {entity_name} would be {action}ed".format(
+                    entity=entity, entity_name=entity_name or entity_id, action=action))
+        else:
+            res_args = self.execute_action(entity_type, entity_id, resource_type, resource_id, action)
+        return diff_result(self.module, res_args,
+                           before={'assigned': assigned}, after={'assigned': state == 'present'})
 
 
 def main():
@@ -192,8 +248,9 @@ def main():
         argument_spec=dict(
             entity=dict(required=True, type='str',
                         choices=['policy', 'policy profile']),
-            entity_name=dict(required=True, type='str'),
-            resource_name=dict(required=True, type='str'),
+            entity_name=dict(required=False, type='str'),
+            entity_id=dict(required=False, type='str'),
+            resource_name=dict(required=False, type='str'),
             resource=dict(required=True, type='str',
                           choices=['provider', 'host', 'vm', 'container node',
                                    'pod', 'replicator', 'container image']),
@@ -204,29 +261,32 @@ def main():
             miq_password=dict(default=os.environ.get('MIQ_PASSWORD', None), no_log=True),
             miq_verify_ssl=dict(require=False, type='bool', default=True),
             ca_bundle_path=dict(required=False, type='str', defualt=None),
-        )
+            **dict(manageiq_client_argument_spec(), **dict(manageiq_resource_argument_spec(),
+                                                           **manageiq_appliances_argument_spec()))
+        ),
+        required_one_of=[['entity_name', 'entity_id'], ['resource_name', 'resource_id', 'href']],
+        mutually_exclusive=[['resource_id', 'href'], ['miq_appliances', 'resource_id'], ['miq_appliances', 'href'],
+                            ['miq_appliances', 'entity_id']],
+        supports_check_mode=True,
     )
 
-    for arg in ['miq_url', 'miq_username', 'miq_password']:
-        if module.params[arg] in (None, ''):
-            module.fail_json(msg="missing required argument: {}".format(arg))
-
-    miq_url        = module.params['miq_url']
-    miq_username   = module.params['miq_username']
-    miq_password   = module.params['miq_password']
     entity         = module.params['entity']
     entity_name    = module.params['entity_name']
+    entity_id      = module.params['entity_id']
     resource       = module.params['resource']
     resource_name  = module.params['resource_name']
     state          = module.params['state']
-    miq_verify_ssl = module.params['miq_verify_ssl']
-    ca_bundle_path = module.params['ca_bundle_path']
 
-    manageiq = ManageIQ(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path)
-    res_args = manageiq.assign_or_unassign_entity(entity, entity_name, resource, resource_name, state)
+    def apply(module, connection):
+        manageiq = ManageIQ(module, connection['miq_url'], connection['miq_username'], connection['miq_password'],
+                            connection['miq_verify_ssl'], connection['ca_bundle_path'],
+                            manageiq_client_options(module.params))
+        res_args = manageiq.assign_or_unassign_entity(entity, entity_name, resource, resource_name, state,
+                                                      resource_id_from_params(module.params), entity_id)
+        return dict(api_stats=manageiq.client.stats, **res_args)
 
-    module.exit_json(**res_args)
+    module.exit_json(**run_on_appliances(module, apply))
 
 
 if __name__ == "__main__":
-    main()
+    profiled('manageiq_policy_assignment', main)()
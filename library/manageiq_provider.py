@@ -2,8 +2,8 @@
 
 import os
 import time
-from ansible.module_utils.basic import *
-from manageiq_client.api import ManageIQClient as MiqApi
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.manageiq_utils import Capabilities, FingerprintStore, METRICS, ManageIQClient as MiqApi, RefreshQueue, RefreshScheduler, certificate_fingerprint, diff_result, fingerprint, load_snapshot, manageiq_client_argument_spec, manageiq_client_options, manageiq_resource_argument_spec, manageiq_result_argument_spec, profiled, read_certificate, resource_exists, resource_id_from_params, result_details, traced
 
 
 DOCUMENTATION = '''
@@ -42,6 +42,21 @@ options:
       - the added provider name in manageiq
     required: true
     default: null
+  resource_id:
+    description:
+      - the id of the provider in manageiq, used instead of looking up the
+        provider by its name. on absent, the provider is checked to exist with
+        a single request
+    required: false
+    default: null
+    aliases: ['provider_id']
+  href:
+    description:
+      - the href of the provider in manageiq, used instead of looking up the
+        provider by its name
+      - see the manageiq_resolve lookup plugin for resolving many names at once
+    required: false
+    default: null
   provider_type:
     description:
       - the provider's type
@@ -87,6 +102,8 @@ options:
     description:
       - path to a file with certificate authoritie(s) to trust, in PEM format
       - to remove a previously defined ca pass null or omit
+      - the file is compared with the provider certificate authority by a fingerprint of its
+        content, ignoring line endings and trailing whitespace
     required: false
     default: null
   monitoring:
@@ -115,6 +132,55 @@ options:
       - disable the provider inventory refresh initiation
     required: false
     default: true
+  refresh_mode:
+    description:
+      - On immediate, the provider inventory refresh is initiated by the module
+      - On deferred, the provider is queued in miq_lock_dir, to be refreshed later by a single
+        manageiq_refresh task with from_queue, e.g. after changing many providers
+    required: false
+    choices: ['immediate', 'deferred']
+    default: immediate
+  refresh_concurrency:
+    description:
+      - maximal number of immediate refreshes running on the appliance at once, from all the
+        modules on the host. when set, the module waits for a free slot, and for the refresh task
+        to finish before releasing it, so that refreshes are spread out instead of queued at once
+    required: false
+    default: MIQ_REFRESH_CONCURRENCY env var if set, otherwise unlimited
+  refresh_timeout:
+    description:
+      - seconds to wait for the refresh task to finish when refresh_concurrency is set
+    required: false
+    default: 3600
+  snapshot_path:
+    description:
+      - path to a snapshot written by the manageiq_snapshot module, used instead
+        of manageiq as the source of the current state. can only be used in
+        check mode
+    required: false
+    default: null
+  fingerprint_dir:
+    description:
+      - directory of a local store of the fingerprints of the desired state last
+        applied to each provider. when the fingerprint of the desired state matches,
+        the provider current state is not read and compared, only its existence is
+        verified. the MIQ_FINGERPRINT_DIR env var is used if set
+    required: false
+    default: null
+  full_check_every:
+    description:
+      - when fingerprint_dir is used, the number of runs after which the provider
+        current state is read and compared even if the fingerprint matches
+    required: false
+    default: 10
+  result_detail:
+    description:
+      - how much of a change is returned. minimal returns the provider id, href
+        and the names of the changed fields, normal the changed endpoints as well,
+        and full the API response as well
+    required: false
+    choices: ['minimal', 'normal', 'full']
+    default: minimal
 '''
 
 EXAMPLES = '''
@@ -206,6 +272,8 @@ class ManageIQProvider(object):
     password       - the user password in manageiq
     miq_verify_ssl - whether SSL certificates should be verified for HTTPS requests
     ca_bundle_path - the path to a CA_BUNDLE file or directory with certificates
+    snapshot       - a Snapshot used instead of manageiq as the source of the current state
+    fingerprints   - a FingerprintStore of the desired states last applied to providers
     """
 
     OPENSHIFT_DEFAULT_PORT = '8443'
@@ -220,15 +288,33 @@ class ManageIQProvider(object):
     WAIT_TIME = 5
     ITERATIONS = 10
 
-    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path):
+    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path, client_options=None, snapshot=None, fingerprints=None,
+                 refresh_scheduler=None, refresh_queue=None, result_detail='minimal'):
         self.module        = module
         self.api_url       = url + '/api'
         self.user          = user
         self.password      = password
-        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path)
+        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path, **(client_options or {}))
         self.changed       = False
         self.providers_url = self.api_url + '/providers'
+        self.snapshot      = snapshot
+        self.fingerprints  = fingerprints
+        self.refresh_scheduler = refresh_scheduler
+        self.refresh_queue     = refresh_queue
+        self.result_detail     = result_detail
+        self.capabilities  = Capabilities(self.client, self.api_url, (client_options or {}).get('lock_dir'))
+
+    @traced
+    def provider_exists(self, provider_id):
+        """ Returns True if the provider with the id passed exists in manageiq,
+        False otherwise. Reads only the provider id.
+        """
+        try:
+            return resource_exists(self.client, self.api_url, 'providers', provider_id, self.snapshot)
+        except Exception as e:
+            self.module.fail_json(msg="Failed to query provider {provider_id}: {error}".format(provider_id=provider_id, error=e))
 
+    @traced
     def auths_validation_details(self, provider_id):
         try:
             result = self.client.get('{providers_url}/{id}/?attributes=authentications'.format(providers_url=self.providers_url, id=provider_id))
@@ -237,6 +323,7 @@ class ManageIQProvider(object):
         except Exception as e:
             self.module.fail_json(msg="Failed to get provider data. Error: {!r}".format(e))
 
+    @traced
     def verify_authenticaion_validation(self, provider_id, old_validation_details, authtypes_to_verify):
         """ Verifies that the provider's authentication validation passed.
         provider_id            - the provider's id manageiq
@@ -256,6 +343,7 @@ class ManageIQProvider(object):
             return ((old.get('last_valid_on'), old.get('last_invalid_on')) !=
                     (new.get('last_valid_on'), new.get('last_invalid_on')))
 
+        started = time.time()
         for i in range(ManageIQProvider.ITERATIONS):
             new_validation_details = self.auths_validation_details(provider_id)
 
@@ -274,19 +362,41 @@ class ManageIQProvider(object):
                         all_done_valid = "Invalid"
 
             if validations_done:
+                METRICS.observe('manageiq_provider_validation_wait_seconds', time.time() - started, result=all_done_valid)
                 return all_done_valid, details
             time.sleep(ManageIQProvider.WAIT_TIME)
 
+        METRICS.observe('manageiq_provider_validation_wait_seconds', time.time() - started, result="Timed out")
         return "Timed out", details
 
+    @traced
     def get_provider_config(self, provider_id):
         """ get the endpoint content of existing provider from manageiq API"""
+        if self.snapshot:
+            return self.snapshot.get('providers', provider_id)
         try:
             result = self.client.get('{providers_url}/{id}/?attributes=endpoints'.format(providers_url=self.providers_url, id=provider_id))
             return result
         except Exception as e:
             self.module.fail_json(msg="Failed to get provider data. Error: {!r}".format(e))
 
+    @staticmethod
+    def endpoint_attributes(endpoint):
+        """ Returns the endpoint attributes managed by the module, with the
+        certificate authority compared (and shown) by its fingerprint
+        """
+        return {'hostname': endpoint.get('hostname'),
+                'port': endpoint.get('port'),
+                'verify_ssl': endpoint.get('verify_ssl'),
+                'certificate_authority': certificate_fingerprint(endpoint.get('certificate_authority')),
+                'security_protocol': endpoint.get('security_protocol')}
+
+    @staticmethod
+    def provider_state(endpoints_by_role, zone_id, provider_region):
+        """ Returns the provider attributes managed by the module, as shown in diff mode
+        """
+        return {'endpoints': endpoints_by_role, 'zone_id': zone_id, 'provider_region': provider_region}
+
     def required_updates(self, provider_id, endpoints, zone_id, provider_region, existing_config):
         """ Checks whether an update is required for the provider
 
@@ -300,15 +410,8 @@ class ManageIQProvider(object):
                                 that will contain all the changed endpoints
                                 and their values.
         """
-        def host_port_ssl(endpoint):
-            return {'hostname': endpoint.get('hostname'),
-                    'port': endpoint.get('port'),
-                    'verify_ssl': endpoint.get('verify_ssl'),
-                    'certificate_authority': endpoint.get('certificate_authority'),
-                    'security_protocol': endpoint.get('security_protocol')}
-
-        desired_by_role = {e['endpoint']['role']: host_port_ssl(e['endpoint']) for e in endpoints}
-        existing_by_role = {e['role']: host_port_ssl(e) for e in existing_config['endpoints']}
+        desired_by_role = {e['endpoint']['role']: self.endpoint_attributes(e['endpoint']) for e in endpoints}
+        existing_by_role = {e['role']: self.endpoint_attributes(e) for e in existing_config['endpoints']}
         existing_provider_region = existing_config.get('provider_region') or None
         if existing_by_role == desired_by_role and existing_config['zone_id'] == zone_id and existing_provider_region == provider_region:
             return {}
@@ -326,34 +429,82 @@ class ManageIQProvider(object):
             updated['provider_region'] = provider_region
         return {"Updated": updated, "Added": added, "Removed": removed}
 
+    @staticmethod
+    def changed_fields(updates):
+        """ Returns the names of the fields changed by the required updates,
+        e.g. endpoints.default.hostname, endpoints.hawkular for an added or
+        removed endpoint, or zone_id
+        """
+        fields = ['endpoints.{role}'.format(role=role) for role in list(updates['Added']) + list(updates['Removed'])]
+        for key, value in updates['Updated'].items():
+            if key in ('zone_id', 'provider_region'):
+                fields.append(key)
+            else:
+                fields.extend('endpoints.{role}.{field}'.format(role=key, field=field) for field in value)
+        return fields
+
+    def provider_result(self, result, updates, payload=None):
+        """ Adds the details of the provider change to the result, see result_details
+        """
+        if result['provider_id']:
+            result['href'] = '{providers_url}/{id}'.format(providers_url=self.providers_url, id=result['provider_id'])
+        return result_details(self.result_detail, result,
+                              changed_fields=self.changed_fields(updates) if updates else None,
+                              updates=updates, payload=payload)
+
+    @traced
     def refresh_provider(self, provider_id):
-        """ Performs a refresh of provider's inventory
+        """ Performs a refresh of provider's inventory, or defers it to the
+        manageiq_refresh module when a refresh queue is used.
+
+        Returns:
+            a short message describing the refresh
         """
+        if self.refresh_queue:
+            self.refresh_queue.add(provider_id)
+            return "Provider inventory refresh deferred"
+        if self.refresh_scheduler:
+            refresh = self.refresh_scheduler.refresh(self.client, self.api_url, provider_id)
+            if refresh['state'] == 'Failed':
+                self.module.fail_json(msg="Failed to refresh provider. Error: {}".format(refresh['message']))
+            self.changed = True
+            if refresh['state'] == 'Timed out':
+                return "Provider inventory refresh timed out"
+            if refresh['state'] == 'Finished' and refresh['status'] != 'Ok':
+                return "Provider inventory refresh failed: {}".format(refresh['message'])
+            return "Refreshed provider inventory"
         try:
             self.client.post('{api_url}/providers/{id}'.format(api_url=self.api_url, id=provider_id),
                              action='refresh')
             self.changed = True
         except Exception as e:
             self.module.fail_json(msg="Failed to refresh provider. Error: {!r}".format(e))
+        return "Refreshing provider inventory"
 
+    @traced
     def update_provider(self, provider_id, provider_name, endpoints, zone_id, provider_region):
         """ Updates the existing provider with new parameters
+
+        Returns:
+            the API response
         """
         try:
-            self.client.post('{api_url}/providers/{id}'.format(api_url=self.api_url, id=provider_id),
-                             action='edit',
-                             zone={'id': zone_id},
-                             connection_configurations=endpoints,
-                             provider_region=provider_region)
+            result = self.client.post('{api_url}/providers/{id}'.format(api_url=self.api_url, id=provider_id),
+                                      action='edit',
+                                      zone={'id': zone_id},
+                                      connection_configurations=endpoints,
+                                      provider_region=provider_region)
             self.changed = True
         except Exception as e:
             self.module.fail_json(msg="Failed to update provider. Error: {!r}".format(e))
+        return result
 
+    @traced
     def add_new_provider(self, provider_name, provider_type, endpoints, zone_id, provider_region):
         """ Adds a provider to manageiq
 
         Returns:
-            the added provider id
+            the added provider, as returned by the API
         """
         try:
             result = self.client.post(self.providers_url, name=provider_name,
@@ -361,27 +512,35 @@ class ManageIQProvider(object):
                                       zone={'id': zone_id},
                                       connection_configurations=endpoints,
                                       provider_region=provider_region)
-            provider_id = result['results'][0]['id']
+            provider = result['results'][0]
             self.changed = True
         except Exception as e:
             self.module.fail_json(msg="Failed to add provider. Error: {!r}".format(e))
-        return provider_id
+        return provider
 
+    @traced
     def find_zone_by_name(self, zone_name):
         """ Searches the zone name in manageiq existing zones
 
         Returns:
             the zone id if it exists in manageiq, None otherwise
         """
+        if self.snapshot:
+            zone = self.snapshot.find('zones', name=zone_name)
+            return zone and zone['id']
         zones = self.client.collections.zones
         return next((z.id for z in zones if z.name == zone_name), None)
 
+    @traced
     def find_provider_by_name(self, provider_name):
         """ Searches the provider name in manageiq existing providers
 
         Returns:
             the provider id if it exists in manageiq, None otherwise
         """
+        if self.snapshot:
+            provider = self.snapshot.find('providers', name=provider_name)
+            return provider and provider['id']
         providers = self.client.collections.providers
         return next((p.id for p in providers if p.name == provider_name), None)
 
@@ -394,9 +553,8 @@ class ManageIQProvider(object):
                   'authentication': {'authtype': authtype, 'auth_key': token}}
 
         if provider_ca_path:
-            with open(provider_ca_path, 'r') as provider_ca_file:
-                provider_ca_content = provider_ca_file.read()
-                config['endpoint']['certificate_authority'] = provider_ca_content
+            # read once for all the endpoints sharing the file
+            config['endpoint']['certificate_authority'] = read_certificate(provider_ca_path)
         else:
             config['endpoint']['certificate_authority'] = None
 
@@ -418,15 +576,29 @@ class ManageIQProvider(object):
                 'authentication': {'authtype': authtype, 'userid': userid,
                                    'password': password}}
 
-    def delete_provider(self, provider_name):
-        """ Deletes the provider
+    @traced
+    def delete_provider(self, provider_name, provider_id=None):
+        """ Deletes the provider, given by its id or by its name
 
         Returns:
             the delete task id if a task was generated, whether or not
             a change took place and a short message describing the operation
             executed.
         """
-        provider_id = self.find_provider_by_name(provider_name)
+        if provider_id:
+            # check the provider given by its id exists with a single small request
+            if not self.provider_exists(provider_id):
+                provider_id = None
+        else:
+            provider_id = self.find_provider_by_name(provider_name)
+        if self.fingerprints:
+            self.fingerprints.forget('provider', provider_name)
+        if provider_id and self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                task_id=None, changed=self.changed,
+                msg="Provider {provider_name} would be deleted".format(provider_name=provider_name)),
+                before={'name': provider_name}, after={})
         if provider_id:
             try:
                 url = '{providers_url}/{id}'.format(providers_url=self.providers_url, id=provider_id)
@@ -441,6 +613,12 @@ class ManageIQProvider(object):
         else:
             return dict(task_id=None, changed=self.changed, msg="Provider {provider_name} doesn't exist".format(provider_name=provider_name))
 
+    def record_fingerprint(self, provider_name, desired_fingerprint, provider_id):
+        """ Stores the fingerprint of the desired state the provider converged to
+        """
+        if self.fingerprints:
+            self.fingerprints.record('provider', provider_name, desired_fingerprint, provider_id)
+
     def filter_unsupported_fields_from_config(self, configs, existing_endpoints, fields):
         """
         Only update fields that already exist in the endpoint with empty values.
@@ -455,47 +633,86 @@ class ManageIQProvider(object):
                     if field in endpoint and endpoint[field] is None:
                         del endpoint[field]
 
+    def filter_certificate_authority(self, configs, existing_endpoints):
+        """ ManageIQ Euwe / CFME 5.7 API and older versions don't support certificate
+        authority field in endpoint. Removes null/empty certificate_authority from
+        the endpoints unless the appliance version is known to support it. When the
+        version is unknown, a field that wasn't returned from the existing endpoints
+        is either unsupported or null, in both cases it can be removed.
+        """
+        supported = self.capabilities.supports('endpoint_certificate_authority')
+        if supported is None:
+            self.filter_unsupported_fields_from_config(configs, existing_endpoints, {'certificate_authority'})
+        elif not supported:
+            self.filter_unsupported_fields_from_config(configs, [{}], {'certificate_authority'})
+
+    @traced
     def add_or_update_provider(self, provider_name, provider_type, endpoints, zone, provider_region,
-            validate_provider_auth = True, initiate_refresh = True):
+                               validate_provider_auth=True, initiate_refresh=True, provider_id=None):
         """ Adds a provider to manageiq or update its attributes in case
-        a provider with the same name already exists
+        a provider with the same name, or the given id, already exists
 
         Returns:
             the added or updated provider id, whether or not a change took
             place and a short message describing the operation executed,
             including the authentication validation status
         """
+        desired_fingerprint = None
+        if self.fingerprints:
+            desired_fingerprint = fingerprint([provider_name, provider_type, endpoints, zone, provider_region])
+            fingerprint_id = self.fingerprints.lookup('provider', provider_name, desired_fingerprint)
+            if fingerprint_id and self.provider_exists(fingerprint_id):
+                return dict(changed=self.changed,
+                            msg="Provider %s already exists" % provider_name)
+
         zone_id = self.find_zone_by_name(zone or 'default')
+        desired_by_role = {e['endpoint']['role']: self.endpoint_attributes(e['endpoint']) for e in endpoints}
         # check if provider with the same name already exists
-        provider_id = self.find_provider_by_name(provider_name)
+        provider_id = provider_id or self.find_provider_by_name(provider_name)
         if provider_id:  # provider exists
             existing_config = self.get_provider_config(provider_id)
 
-            # ManageIQ Euwe / CFME 5.7 API and older versions don't support certificate authority field in endpoint.
-            # If it wasn't returned from existing provider configuration this means it is either unsupported or null,
-            # in both cases we can remove null/empty certificate_authority from endpoints we want to update.
-            self.filter_unsupported_fields_from_config(endpoints, existing_config['endpoints'], {'certificate_authority'})
+            self.filter_certificate_authority(endpoints, existing_config['endpoints'])
 
             updates = self.required_updates(provider_id, endpoints, zone_id, provider_region, existing_config)
 
             if not updates:
+                self.record_fingerprint(provider_name, desired_fingerprint, provider_id)
                 return dict(changed=self.changed,
                             msg="Provider %s already exists" % provider_name)
 
+            if self.module.check_mode:
+                self.changed = True
+                existing_by_role = {e['role']: self.endpoint_attributes(e) for e in existing_config['endpoints']}
+                return diff_result(self.module, self.provider_result(dict(
+                    provider_id=provider_id, changed=self.changed,
+                    msg="Provider %s would be updated" % provider_name), updates),
+                    before=self.provider_state(existing_by_role, existing_config['zone_id'],
+                                               existing_config.get('provider_region') or None),
+                    after=self.provider_state(desired_by_role, zone_id, provider_region))
+
             old_validation_details = self.auths_validation_details(provider_id)
             operation = "update"
-            self.update_provider(provider_id, provider_name, endpoints, zone_id, provider_region)
+            payload = self.update_provider(provider_id, provider_name, endpoints, zone_id, provider_region)
             roles_with_changes = set(updates["Added"]) | set(updates["Updated"])
         else:  # provider doesn't exists, adding it to manageiq
 
-            # ManageIQ Euwe / CFME 5.7 API and older versions don't support certificate authority field in endpoint.
-            # filter empty fields if none on creation - No existing endpoints for new provider
-            self.filter_unsupported_fields_from_config(endpoints, [{}], {'certificate_authority'})
+            # No existing endpoints for new provider
+            self.filter_certificate_authority(endpoints, [{}])
+
+            if self.module.check_mode:
+                self.changed = True
+                return diff_result(self.module, self.provider_result(dict(
+                    provider_id=None, changed=self.changed,
+                    msg="Provider %s would be added" % provider_name), None),
+                    before={}, after=self.provider_state(desired_by_role, zone_id, provider_region))
+
             updates = None
             old_validation_details = {}
             operation = "addition"
-            provider_id = self.add_new_provider(provider_name, provider_type,
-                                                endpoints, zone_id, provider_region)
+            payload = self.add_new_provider(provider_name, provider_type,
+                                            endpoints, zone_id, provider_region)
+            provider_id = payload['id']
             roles_with_changes = [e['endpoint']['role'] for e in endpoints]
 
         if validate_provider_auth:
@@ -513,19 +730,18 @@ class ManageIQProvider(object):
         if result == "Invalid":
             self.module.fail_json(msg="Failed to Validate provider authentication after {operation}. details: {details}".format(operation=operation, details=details))
         elif result == "Valid" or result == "Skipped Validation":
+            self.record_fingerprint(provider_name, desired_fingerprint, provider_id)
             if initiate_refresh:
-                self.refresh_provider(provider_id)
-                message = "Successful {operation} of {provider} provider. Authentication: {validation}. Refreshing provider inventory".format(operation=operation, provider=provider_name, validation=details)
+                refresh = self.refresh_provider(provider_id)
+                message = "Successful {operation} of {provider} provider. Authentication: {validation}. {refresh}".format(operation=operation, provider=provider_name, validation=details, refresh=refresh)
             else:
                 message = "Successful {operation} of {provider} provider. Authentication: {validation}.".format(operation=operation, provider=provider_name, validation=details)
         elif result == "Timed out":
             message = "Provider {provider} validation after {operation} timed out. Authentication: {validation}".format(operation=operation, provider=provider_name, validation=details)
-        return dict(
+        return self.provider_result(dict(
             provider_id=provider_id,
             changed=self.changed,
-            msg=message,
-            updates=updates
-        )
+            msg=message), updates, payload)
 
 
 def main():
@@ -556,8 +772,20 @@ def main():
             monitoring_hostname=dict(required=False),
             monitoring_port=dict(required=False),
             initiate_refresh=dict(required=False, type='bool', default=True),
-            validate_provider_auth=dict(required=False, type='bool', default=True)
+            refresh_mode=dict(required=False, type='str', default='immediate',
+                              choices=['immediate', 'deferred']),
+            refresh_concurrency=dict(required=False, type='int',
+                                     default=os.environ.get('MIQ_REFRESH_CONCURRENCY', None)),
+            refresh_timeout=dict(required=False, type='int', default=3600),
+            validate_provider_auth=dict(required=False, type='bool', default=True),
+            snapshot_path=dict(required=False, type='path'),
+            fingerprint_dir=dict(required=False, type='path',
+                                 default=os.environ.get('MIQ_FINGERPRINT_DIR', None)),
+            full_check_every=dict(required=False, type='int', default=10),
+            **dict(manageiq_client_argument_spec(), **dict(manageiq_resource_argument_spec('provider_id'),
+                                                           **manageiq_result_argument_spec()))
         ),
+        mutually_exclusive=[['resource_id', 'href']],
         required_if=[
             ('provider_type', 'openshift-origin', ['provider_api_hostname', 'provider_api_port', 'provider_api_auth_token']),
             ('provider_type', 'openshift-enterprise', ['provider_api_hostname', 'provider_api_port', 'provider_api_auth_token']),
@@ -566,6 +794,7 @@ def main():
             ('provider_type', 'amazon', ['access_key_id', 'secret_access_key', 'provider_region']),
             ('provider_type', 'hawkular-datawarehouse', ['provider_api_hostname', 'provider_api_port', 'provider_api_auth_token'])
         ],
+        supports_check_mode=True,
     )
 
     for arg in ['miq_url', 'miq_username', 'miq_password']:
@@ -592,8 +821,28 @@ def main():
     monitoring                  = module.params['monitoring']
     validate_provider_auth      = module.params['validate_provider_auth']
     initiate_refresh            = module.params['initiate_refresh']
-
-    manageiq = ManageIQProvider(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path)
+    provider_id                 = resource_id_from_params(module.params)
+
+    snapshot                    = load_snapshot(module, ['providers', 'zones'])
+    fingerprints                = None
+    if module.params['fingerprint_dir']:
+        fingerprints = FingerprintStore(miq_url, module.params['fingerprint_dir'], module.params['full_check_every'],
+                                        module.check_mode)
+
+    refresh_scheduler           = None
+    refresh_queue               = None
+    try:
+        if module.params['refresh_mode'] == 'deferred':
+            refresh_queue = RefreshQueue(miq_url, module.params['miq_lock_dir'])
+        elif module.params['refresh_concurrency']:
+            refresh_scheduler = RefreshScheduler(miq_url, module.params['refresh_concurrency'],
+                                                 module.params['miq_lock_dir'], module.params['refresh_timeout'])
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+
+    manageiq = ManageIQProvider(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path,
+                                manageiq_client_options(module.params), snapshot, fingerprints,
+                                refresh_scheduler, refresh_queue, module.params['result_detail'])
 
     if state == 'present':
         if provider_type in ("openshift-enterprise", "openshift-origin"):
@@ -634,12 +883,13 @@ def main():
                                                    zone,
                                                    provider_region,
                                                    validate_provider_auth,
-                                                   initiate_refresh)
+                                                   initiate_refresh,
+                                                   provider_id)
     elif state == 'absent':
-        res_args = manageiq.delete_provider(provider_name)
+        res_args = manageiq.delete_provider(provider_name, provider_id)
 
-    module.exit_json(**res_args)
+    module.exit_json(api_stats=manageiq.client.stats, **res_args)
 
 
 if __name__ == "__main__":
-    main()
+    profiled('manageiq_provider', main)()
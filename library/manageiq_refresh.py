@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+import os
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.manageiq_utils import ManageIQClient as MiqApi, RefreshQueue, RefreshScheduler, id_from_href, manageiq_client_argument_spec, manageiq_client_options, profiled, resolve_names, traced
+
+
+DOCUMENTATION = '''
+---
+module: manageiq_refresh
+description: The manageiq_refresh module refreshes the inventory of many ManageIQ providers, with a limited number of refreshes running at once, e.g. after changing many providers with manageiq_provider and refresh_mode deferred.
+short_description: refresh the inventory of ManageIQ providers
+requirements: [ ManageIQ/manageiq-api-client-python ]
+author: Daniel Korn (@dkorn)
+options:
+  miq_url:
+    description:
+      - the manageiq environment url
+    default: MIQ_URL env var if set. otherwise, it is required to pass it
+  miq_username:
+    description:
+      - manageiq username
+    default: MIQ_USERNAME env var if set. otherwise, it is required to pass it
+  miq_password:
+    description:
+      - manageiq password
+    default: MIQ_PASSWORD env var if set. otherwise, it is required to pass it
+  miq_verify_ssl:
+    description:
+      - whether SSL certificates should be verified for HTTPS requests
+    required: false
+    default: True
+    choices: ['True', 'False']
+  ca_bundle_path:
+    description:
+      - the path to a CA_BUNDLE file or directory with certificates
+    required: false
+    default: null
+  providers:
+    description:
+      - the names of the providers to refresh
+    required: false
+    default: null
+  provider_ids:
+    description:
+      - the ids of the providers to refresh
+    required: false
+    default: null
+  from_queue:
+    description:
+      - also refresh the providers queued by manageiq_provider with refresh_mode deferred.
+        they are removed from the queue once refreshed, failed and timed out refreshes stay queued
+    required: false
+    default: null
+  concurrency:
+    description:
+      - maximal number of refreshes running on the appliance at once, from all the modules on
+        the host. a refresh is only started once an earlier one finished
+    required: false
+    default: 2
+  timeout:
+    description:
+      - seconds to wait for a refresh to finish, after which the next refresh is started
+    required: false
+    default: 3600
+  poll_interval:
+    description:
+      - seconds to wait between reads of the running refresh tasks
+    required: false
+    default: 5
+'''
+
+EXAMPLES = '''
+# Update many providers, deferring their refreshes
+  manageiq_provider:
+    name: '{{ item.name }}'
+    provider_type: 'openshift-enterprise'
+    provider_api_hostname: '{{ item.hostname }}'
+    provider_api_auth_token: '******'
+    refresh_mode: deferred
+    miq_url: 'http://localhost:3000'
+    miq_username: 'admin'
+    miq_password: '******'
+  with_items: '{{ providers }}'
+
+# Refresh them, two at a time
+  manageiq_refresh:
+    from_queue: true
+    concurrency: 2
+    miq_url: 'http://localhost:3000'
+    miq_username: 'admin'
+    miq_password: '******'
+'''
+
+
+class ManageIQRefresh(object):
+    """ ManageIQ object to refresh the inventory of manageiq providers
+
+    url            - manageiq environment url
+    user           - the username in manageiq
+    password       - the user password in manageiq
+    miq_verify_ssl - whether SSL certificates should be verified for HTTPS requests
+    ca_bundle_path - the path to a CA_BUNDLE file or directory with certificates
+    """
+
+    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path, client_options=None):
+        self.module        = module
+        self.api_url       = url + '/api'
+        self.user          = user
+        self.password      = password
+        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path, **(client_options or {}))
+        self.changed       = False
+
+    @traced
+    def find_provider_ids(self, names):
+        """ Returns the ids of the providers with the names passed, read with a
+        single query, failing the module if any of them doesn't exist
+        """
+        if not names:
+            return []
+        try:
+            hrefs = resolve_names(self.client, self.api_url, 'providers', names)
+        except Exception as e:
+            self.module.fail_json(msg="Failed to query providers: {error}".format(error=e))
+        missing = [name for name in names if name not in hrefs]
+        if missing:
+            self.module.fail_json(msg="Providers {names} do not exist in manageiq".format(names=', '.join(missing)))
+        return [id_from_href(hrefs[name]) for name in names]
+
+    @traced
+    def refresh_providers(self, provider_ids, scheduler, queue=None):
+        """ Refreshes the providers and the ones in the queue, if any, with at
+        most the scheduler concurrency refreshes running at once.
+
+        Returns:
+            whether or not a change took place, a short message describing the
+            operation executed and the result of each refresh.
+        """
+        # the queued providers are only removed from the queue once refreshed,
+        # so that an error or a killed run doesn't lose them
+        queued = queue.peek() if queue else []
+        # refresh each provider once, in the order given
+        seen = set()
+        provider_ids = [p for p in [str(p) for p in provider_ids] + queued if not (p in seen or seen.add(p))]
+
+        if not provider_ids:
+            return dict(changed=self.changed, msg="No providers to refresh", refreshes=[])
+        if self.module.check_mode:
+            self.changed = True
+            return dict(changed=self.changed, msg="{count} providers would be refreshed".format(count=len(provider_ids)),
+                        refreshes=[dict(provider_id=provider_id) for provider_id in provider_ids])
+
+        try:
+            refreshes = scheduler.refresh_all(self.client, self.api_url, provider_ids)
+        except Exception as e:
+            self.module.fail_json(msg="Failed to refresh providers: {error}".format(error=e))
+        self.changed = any(r['state'] != 'Failed' for r in refreshes)
+        failed = [r for r in refreshes if r['state'] == 'Failed' or (r['state'] == 'Finished' and r['status'] != 'Ok')]
+        timed_out = [r for r in refreshes if r['state'] == 'Timed out']
+        if queue:
+            # keep the failed and timed out refreshes queued, so that they aren't lost
+            unfinished = set(r['provider_id'] for r in failed + timed_out)
+            queue.remove(provider_id for provider_id in queued if provider_id not in unfinished)
+            for refresh in failed + timed_out:
+                queue.add(refresh['provider_id'])
+        if failed:
+            self.module.fail_json(msg="Failed to refresh providers {ids}".format(ids=', '.join(r['provider_id'] for r in failed)),
+                                  changed=self.changed, refreshes=refreshes)
+        message = "Successfully refreshed {count} providers".format(count=len(refreshes) - len(timed_out))
+        if timed_out:
+            message += ", {count} timed out".format(count=len(timed_out))
+        return dict(changed=self.changed, msg=message, refreshes=refreshes)
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            providers=dict(required=False, type='list'),
+            provider_ids=dict(required=False, type='list'),
+            from_queue=dict(required=False, type='bool'),
+            concurrency=dict(required=False, type='int', default=2),
+            timeout=dict(required=False, type='int', default=3600),
+            poll_interval=dict(required=False, type='int', default=5),
+            miq_url=dict(default=os.environ.get('MIQ_URL', None)),
+            miq_username=dict(default=os.environ.get('MIQ_USERNAME', None)),
+            miq_password=dict(default=os.environ.get('MIQ_PASSWORD', None), no_log=True),
+            miq_verify_ssl=dict(require=False, type='bool', default=True),
+            ca_bundle_path=dict(required=False, type='str', defualt=None),
+            **manageiq_client_argument_spec()
+        ),
+        required_one_of=[['providers', 'provider_ids', 'from_queue']],
+        supports_check_mode=True,
+    )
+
+    for arg in ['miq_url', 'miq_username', 'miq_password']:
+        if module.params[arg] in (None, ''):
+            module.fail_json(msg="missing required argument: {}".format(arg))
+
+    # without defaults, required_one_of can tell the options which weren't passed
+    providers      = module.params['providers'] or []
+    provider_ids   = module.params['provider_ids'] or []
+
+    miq_url        = module.params['miq_url']
+    miq_username   = module.params['miq_username']
+    miq_password   = module.params['miq_password']
+    miq_verify_ssl = module.params['miq_verify_ssl']
+    ca_bundle_path = module.params['ca_bundle_path']
+    lock_dir       = module.params['miq_lock_dir']
+
+    try:
+        scheduler = RefreshScheduler(miq_url, module.params['concurrency'], lock_dir,
+                                     module.params['timeout'], module.params['poll_interval'])
+        queue = RefreshQueue(miq_url, lock_dir) if module.params['from_queue'] else None
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+
+    manageiq = ManageIQRefresh(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path,
+                               manageiq_client_options(module.params))
+    provider_ids = provider_ids + manageiq.find_provider_ids(providers)
+    res_args = manageiq.refresh_providers(provider_ids, scheduler, queue)
+
+    module.exit_json(api_stats=manageiq.client.stats, **res_args)
+
+
+if __name__ == "__main__":
+    profiled('manageiq_refresh', main)()
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+
+import gzip
+import json
+import os
+import tempfile
+import time
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.manageiq_utils import ManageIQClient as MiqApi, manageiq_client_argument_spec, manageiq_client_options, profiled, query_collection, traced
+
+
+DOCUMENTATION = '''
+---
+module: manageiq_snapshot
+description: The manageiq_snapshot module exports the state of ManageIQ resources to a local file, to be used by the other modules for computing plans offline in check mode.
+short_description: export ManageIQ state to a local snapshot file
+requirements: [ ManageIQ/manageiq-api-client-python ]
+author: Daniel Korn (@dkorn)
+options:
+  miq_url:
+    description:
+      - the manageiq environment url
+    default: MIQ_URL env var if set. otherwise, it is required to pass it
+  miq_username:
+    description:
+      - manageiq username
+    default: MIQ_USERNAME env var if set. otherwise, it is required to pass it
+  miq_password:
+    description:
+      - manageiq password
+    default: MIQ_PASSWORD env var if set. otherwise, it is required to pass it
+  miq_verify_ssl:
+    description:
+      - whether SSL certificates should be verified for HTTPS requests
+    required: false
+    default: True
+    choices: ['True', 'False']
+  ca_bundle_path:
+    description:
+      - the path to a CA_BUNDLE file or directory with certificates
+    required: false
+    default: null
+  path:
+    description:
+      - the path of the snapshot file to write, a gzip'd file of JSON lines
+    required: true
+    default: null
+  collections:
+    description:
+      - the collections to export. providers are exported with their endpoints,
+        tags, policies, policy profiles and custom attributes
+    required: false
+    choices: ['providers', 'zones', 'users', 'groups', 'alert_definitions', 'tags']
+    default: all of the choices
+  page_size:
+    description:
+      - the number of resources read in a single request
+    required: false
+    default: 500
+'''
+
+EXAMPLES = '''
+# Export the state of ManageIQ to a snapshot file
+  manageiq_snapshot:
+    path: '/var/tmp/manageiq.jsonl.gz'
+    miq_url: 'http://localhost:3000'
+    miq_username: 'admin'
+    miq_password: '******'
+
+# Plan provider updates against the snapshot
+  manageiq_provider:
+    name: 'Molecule'
+    provider_type: 'openshift-enterprise'
+    provider_api_hostname: 'oshift01.redhat.com'
+    provider_api_port: '8443'
+    provider_api_auth_token: '******'
+    snapshot_path: '/var/tmp/manageiq.jsonl.gz'
+    miq_url: 'http://localhost:3000'
+    miq_username: 'admin'
+    miq_password: '******'
+  check_mode: yes
+'''
+
+
+class ManageIQSnapshot(object):
+    """ ManageIQ object to export the state of manageiq resources
+
+    url            - manageiq environment url
+    user           - the username in manageiq
+    password       - the user password in manageiq
+    miq_verify_ssl - whether SSL certificates should be verified for HTTPS requests
+    ca_bundle_path - the path to a CA_BUNDLE file or directory with certificates
+    """
+
+    # the query parameters used to read each collection, besides paging
+    COLLECTIONS = {
+        'providers': 'expand=resources,tags,policies,policy_profiles,custom_attributes&attributes=endpoints',
+        'zones': 'expand=resources',
+        'users': 'expand=resources',
+        'groups': 'expand=resources',
+        'alert_definitions': 'expand=resources',
+        'tags': 'expand=resources',
+    }
+
+    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path, client_options=None):
+        self.module        = module
+        self.miq_url       = url
+        self.api_url       = url + '/api'
+        self.user          = user
+        self.password      = password
+        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path, **(client_options or {}))
+        self.changed       = False
+
+    def iter_collection(self, collection, page_size):
+        """ Yields the collection resources, reading them a page at a time
+        """
+        try:
+            for resource in query_collection(self.client, self.api_url, collection,
+                                             ManageIQSnapshot.COLLECTIONS[collection], page_size):
+                yield resource
+        except Exception as e:
+            self.module.fail_json(msg="Failed to query {collection}: {error}".format(collection=collection, error=e))
+
+    @traced
+    def export(self, path, collections, page_size):
+        """ Writes the collections resources to the snapshot file.
+
+        Returns:
+            whether or not a change took place, a short message describing the
+            operation executed and the number of resources exported from each
+            collection.
+        """
+        counts = dict((collection, 0) for collection in collections)
+        header = {'snapshot': {'miq_url': self.miq_url, 'collections': collections,
+                               'created_on': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}}
+
+        path = os.path.abspath(path)
+        # write to a temporary file first, so that a failed export doesn't
+        # leave a partial snapshot behind
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.manageiq_snapshot')
+        try:
+            with os.fdopen(fd, 'wb') as raw_file:
+                with gzip.GzipFile(fileobj=raw_file, mode='wb') as snapshot_file:
+                    snapshot_file.write(self.json_line(header))
+                    for collection in collections:
+                        for resource in self.iter_collection(collection, page_size):
+                            snapshot_file.write(self.json_line({'collection': collection, 'resource': resource}))
+                            counts[collection] += 1
+            if not self.module.check_mode:
+                os.rename(tmp_path, path)
+            self.changed = True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        if self.module.check_mode:
+            message = "Snapshot {path} would be written"
+        else:
+            message = "Successfully wrote snapshot {path}"
+        return dict(changed=self.changed, msg=message.format(path=path), path=path, counts=counts)
+
+    @staticmethod
+    def json_line(record):
+        return (json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            path=dict(required=True, type='path'),
+            collections=dict(required=False, type='list',
+                             choices=list(ManageIQSnapshot.COLLECTIONS),
+                             default=sorted(ManageIQSnapshot.COLLECTIONS)),
+            page_size=dict(required=False, type='int', default=500),
+            miq_url=dict(default=os.environ.get('MIQ_URL', None)),
+            miq_username=dict(default=os.environ.get('MIQ_USERNAME', None)),
+            miq_password=dict(default=os.environ.get('MIQ_PASSWORD', None), no_log=True),
+            miq_verify_ssl=dict(require=False, type='bool', default=True),
+            ca_bundle_path=dict(required=False, type='str', defualt=None),
+            **manageiq_client_argument_spec()
+        ),
+        supports_check_mode=True,
+    )
+
+    for arg in ['miq_url', 'miq_username', 'miq_password']:
+        if module.params[arg] in (None, ''):
+            module.fail_json(msg="missing required argument: {}".format(arg))
+
+    miq_url        = module.params['miq_url']
+    miq_username   = module.params['miq_username']
+    miq_password   = module.params['miq_password']
+    miq_verify_ssl = module.params['miq_verify_ssl']
+    ca_bundle_path = module.params['ca_bundle_path']
+    path           = module.params['path']
+    collections    = module.params['collections']
+    page_size      = module.params['page_size']
+
+    manageiq = ManageIQSnapshot(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path,
+                                manageiq_client_options(module.params))
+    res_args = manageiq.export(path, collections, page_size)
+
+    module.exit_json(api_stats=manageiq.client.stats, **res_args)
+
+
+if __name__ == "__main__":
+    profiled('manageiq_snapshot', main)()
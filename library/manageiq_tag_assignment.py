@@ -1,8 +1,8 @@
 #!/usr/bin/python
 
 import os
-from ansible.module_utils.basic import *
-from manageiq_client.api import ManageIQClient as MiqApi
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.manageiq_utils import METRICS, ManageIQClient as MiqApi, diff_result, manageiq_client_argument_spec, manageiq_appliances_argument_spec, manageiq_client_options, manageiq_resource_argument_spec, profiled, resource_exists, resource_id_from_params, run_on_appliances, traced
 
 
 DOCUMENTATION = '''
@@ -40,7 +40,20 @@ options:
   resource_name:
     description:
       - the relevant resource name in manageiq
-    required: true
+      - required unless resource_id or href is given
+    required: false
+    default: null
+  resource_id:
+    description:
+      - the relevant resource id in manageiq, used instead of looking up resource_name.
+        the resource is checked to exist with a single request
+    required: false
+    default: null
+  href:
+    description:
+      - the relevant resource href in manageiq, used instead of looking up resource_name
+      - see the manageiq_resolve lookup plugin for resolving many names at once
+    required: false
     default: null
   state:
     description:
@@ -76,6 +89,17 @@ EXAMPLES = '''
     miq_url: 'http://localhost:3000'
     miq_username: 'admin'
     miq_password: '******'
+
+# Assign tag on a provider given by its href
+  manageiq_tag_assignment:
+    tags:
+    - category: environment
+      name: prod
+    href: 'http://localhost:3000/api/providers/27'
+    resource: 'provider'
+    miq_url: 'http://localhost:3000'
+    miq_username: 'admin'
+    miq_password: '******'
 '''
 
 
@@ -98,14 +122,15 @@ class ManageIQTagAssignment(object):
     }
     actions = {'present': 'assign', 'absent': 'unassign'}
 
-    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path):
+    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path, client_options=None):
         self.module   = module
         self.api_url  = url + '/api'
         self.user     = user
         self.password = password
-        self.client   = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path)
+        self.client   = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path, **(client_options or {}))
         self.changed  = False
 
+    @traced
     def find_entity_by_name(self, entity_type, entity_name):
         """ Searches the entity name in ManageIQ.
 
@@ -115,6 +140,7 @@ class ManageIQTagAssignment(object):
         entities_list = getattr(self.client.collections, entity_type)
         return next((e.id for e in entities_list if e.name == entity_name), None)
 
+    @traced
     def query_resource_tags(self, resource_type, resource_id):
         """ Returns a set of the full tag names assigned to the resource
         """
@@ -127,10 +153,15 @@ class ManageIQTagAssignment(object):
         tags_set = set([tag['name'] for tag in tags])
         return tags_set
 
+    @traced
     def execute_action(self, resource_type, resource_id, tags, action):
         """Executes the action for the resource tag
         """
+        if self.module.check_mode:
+            self.changed = True
+            return
         url = '{api_url}/{resource_type}/{resource_id}/tags'.format(api_url=self.api_url, resource_type=resource_type, resource_id=resource_id)
+        METRICS.observe('manageiq_bulk_batch_size', len(tags), operation='tags_' + action, collection=resource_type)
         try:
             response = self.client.post(url, action=action, resources=tags)
         except Exception as e:
@@ -141,53 +172,80 @@ class ManageIQTagAssignment(object):
             else:
                 self.module.fail_json(msg="Failed to {action}: {fail_message}".format(action=action, fail_message=result['message']))
 
-    def full_tag_name(self, tag):
+    @staticmethod
+    def full_tag_name(tag):
         """ Returns the full tag name in manageiq
         """
         full_tag_name = '/managed/{category_name}/{tag_name}'.format(category_name=tag['category'], tag_name=tag['name'])
         return full_tag_name
 
-    def assign_or_unassign_tag(self, tags, resource, resource_name, state):
-        """ Assign or unassign the tag on a manageiq resource.
+    @staticmethod
+    def tags_to_execute(tags, assigned_tags, state):
+        """ Returns the tags to assign, those not in the set of full names of
+        the assigned tags, when state is present, and the tags to unassign
+        when it is absent
+        """
+        present = state == 'present'
+        return [tag for tag in tags if (ManageIQTagAssignment.full_tag_name(tag) in assigned_tags) != present]
+
+    @traced
+    def assign_or_unassign_tag(self, tags, resource, resource_name, state, resource_id=None):
+        """ Assign or unassign the tag on a manageiq resource, given by its id or
+        by its name.
 
         Returns:
             Whether or not a change took place and a message describing the
             operation executed.
         """
         resource_type = self.manageiq_entities[resource]
-        resource_id = self.find_entity_by_name(resource_type, resource_name)
+        if resource_id:
+            # check the resource given by its id exists with a single small request
+            try:
+                exists = resource_exists(self.client, self.api_url, resource_type, resource_id)
+            except Exception as e:
+                self.module.fail_json(msg="Failed to {action} tag: failed to query {resource} {resource_id}: {error}".format(
+                    action=ManageIQTagAssignment.actions[state], resource=resource, resource_id=resource_id, error=e))
+            if not exists:
+                self.module.fail_json(
+                    msg="Failed to {action} tag: {resource} {resource_id} does not exist in manageiq".format(
+                        action=ManageIQTagAssignment.actions[state],
+                        resource_id=resource_id, resource=resource))
+        else:
+            resource_id = self.find_entity_by_name(resource_type, resource_name)
         if not resource_id:  # resource doesn't exist
             self.module.fail_json(
                 msg="Failed to {action} tag: {resource_name} {resource} does not exist in manageiq".format(
                     action=ManageIQTagAssignment.actions[state],
                     resource_name=resource_name, resource=resource))
 
-        tags_to_execute = []
         assigned_tags = self.query_resource_tags(resource_type, resource_id)
-        for tag in tags:
-            assigned = self.full_tag_name(tag) in assigned_tags
-
-            if assigned and state == 'absent':
-                tags_to_execute.append(tag)
-            elif (not assigned) and state == 'present':
-                tags_to_execute.append(tag)
-
+        tags_to_execute = self.tags_to_execute(tags, assigned_tags, state)
         if not tags_to_execute:
             return dict(
                 changed=self.changed,
                 msg="Tags already {action}ed, nothing to do".format(action=ManageIQTagAssignment.actions[state]))
         else:
             self.execute_action(resource_type, resource_id, tags_to_execute, ManageIQTagAssignment.actions[state])
-            return dict(
+            executed_tags = set(self.full_tag_name(tag) for tag in tags_to_execute)
+            if state == 'present':
+                tags_after = assigned_tags | executed_tags
+            else:
+                tags_after = assigned_tags - executed_tags
+            if self.module.check_mode:
+                message = "Tags would be {action}ed"
+            else:
+                message = "Successfully {action}ed tags"
+            return diff_result(self.module, dict(
                 changed=self.changed,
-                msg="Successfully {action}ed tags".format(action=ManageIQTagAssignment.actions[state]))
+                msg=message.format(action=ManageIQTagAssignment.actions[state])),
+                before=sorted(assigned_tags), after=sorted(tags_after))
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             tags=dict(required=True, type='list'),
-            resource_name=dict(required=True, type='str'),
+            resource_name=dict(required=False, type='str'),
             resource=dict(required=True, type='str',
                           choices=['provider', 'host', 'vm', 'blueprint', 'category',
                                    'cluster', 'data store', 'group', 'resource pool',
@@ -200,28 +258,29 @@ def main():
             miq_password=dict(default=os.environ.get('MIQ_PASSWORD', None), no_log=True),
             miq_verify_ssl=dict(require=False, type='bool', default=True),
             ca_bundle_path=dict(required=False, type='str', defualt=None),
-        )
+            **dict(manageiq_client_argument_spec(), **dict(manageiq_resource_argument_spec(),
+                                                           **manageiq_appliances_argument_spec()))
+        ),
+        required_one_of=[['resource_name', 'resource_id', 'href']],
+        mutually_exclusive=[['resource_id', 'href'], ['miq_appliances', 'resource_id'], ['miq_appliances', 'href']],
+        supports_check_mode=True,
     )
 
-    for arg in ['miq_url', 'miq_username', 'miq_password']:
-        if module.params[arg] in (None, ''):
-            module.fail_json(msg="missing required argument: {}".format(arg))
-
-    miq_url        = module.params['miq_url']
-    miq_username   = module.params['miq_username']
-    miq_password   = module.params['miq_password']
     tags           = module.params['tags']
     resource       = module.params['resource']
     resource_name  = module.params['resource_name']
     state          = module.params['state']
-    miq_verify_ssl = module.params['miq_verify_ssl']
-    ca_bundle_path = module.params['ca_bundle_path']
 
-    manageiq = ManageIQTagAssignment(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path)
-    res_args = manageiq.assign_or_unassign_tag(tags, resource, resource_name, state)
+    def apply(module, connection):
+        manageiq = ManageIQTagAssignment(module, connection['miq_url'], connection['miq_username'],
+                                         connection['miq_password'], connection['miq_verify_ssl'],
+                                         connection['ca_bundle_path'], manageiq_client_options(module.params))
+        res_args = manageiq.assign_or_unassign_tag(tags, resource, resource_name, state,
+                                                   resource_id_from_params(module.params))
+        return dict(api_stats=manageiq.client.stats, **res_args)
 
-    module.exit_json(**res_args)
+    module.exit_json(**run_on_appliances(module, apply))
 
 
 if __name__ == "__main__":
-    main()
+    profiled('manageiq_tag_assignment', main)()
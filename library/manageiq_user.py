@@ -26,6 +26,19 @@ options:
       - the unique userid in manageiq, often mentioned as username
     required: true
     default: null
+  resource_id:
+    description:
+      - the id of the user in manageiq, used instead of looking up the user by its name.
+        on absent, the user is checked to exist with a single request
+    required: false
+    default: null
+    aliases: ['user_id']
+  href:
+    description:
+      - the href of the user in manageiq, used instead of looking up the user by its name
+      - see the manageiq_resolve lookup plugin for resolving many names at once
+    required: false
+    default: null
   fullname:
     description:
       - the users' full name
@@ -41,6 +54,12 @@ options:
       - the name of the group to which the user belongs
     required: false
     default: null
+  group_id:
+    description:
+      - the id of the group to which the user belongs, used instead of looking up
+        the group by its name. the group is checked to exist with a single request
+    required: false
+    default: null
   email:
     description:
       - the users' E-mail address
@@ -66,6 +85,21 @@ options:
       - the path to a CA_BUNDLE file or directory with certificates
     required: false
     default: null
+  snapshot_path:
+    description:
+      - path to a snapshot written by the manageiq_snapshot module, used instead
+        of manageiq as the source of the current state. can only be used in
+        check mode
+    required: false
+    default: null
+  result_detail:
+    description:
+      - how much of a change is returned. minimal returns the user id, href
+        and the names of the changed fields, normal their values as well, and
+        full the API response as well
+    required: false
+    choices: ['minimal', 'normal', 'full']
+    default: minimal
 '''
 
 EXAMPLES = '''
@@ -84,7 +118,7 @@ EXAMPLES = '''
 '''
 
 import os
-from manageiq_client.api import ManageIQClient as MiqApi
+from ansible.module_utils.manageiq_utils import ManageIQClient as MiqApi, diff_result, load_snapshot, manageiq_client_argument_spec, manageiq_appliances_argument_spec, manageiq_client_options, manageiq_resource_argument_spec, manageiq_result_argument_spec, profiled, resource_exists, resource_id_from_params, result_details, run_on_appliances, traced
 
 
 class ManageIQUser(object):
@@ -95,45 +129,73 @@ class ManageIQUser(object):
     password       - the user password in manageiq
     miq_verify_ssl - whether SSL certificates should be verified for HTTPS requests
     ca_bundle_path - the path to a CA_BUNDLE file or directory with certificates
+    snapshot       - a Snapshot used instead of manageiq as the source of the current state
+    result_detail  - how much of a change is returned, see result_details
     """
 
-    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path):
+    def __init__(self, module, url, user, password, miq_verify_ssl, ca_bundle_path, client_options=None, snapshot=None,
+                 result_detail='minimal'):
         self.module        = module
         self.api_url       = url + '/api'
         self.user          = user
         self.password      = password
-        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path)
+        self.client        = MiqApi(self.api_url, (self.user, self.password), verify_ssl=miq_verify_ssl, ca_bundle_path=ca_bundle_path, **(client_options or {}))
         self.changed       = False
+        self.snapshot      = snapshot
+        self.result_detail = result_detail
 
+    @traced
     def find_group_by_name(self, group_name):
         """ Searches the group name in ManageIQ.
 
         Returns:
             the group id if it exists in manageiq, None otherwise.
         """
+        if self.snapshot:
+            group = self.snapshot.find('groups', description=group_name)
+            return group and group['id']
         groups = self.client.collections.groups
         return next((group.id for group in groups if group.description == group_name), None)
 
+    @traced
     def find_user_by_userid(self, userid):
         """ Searches the userid in ManageIQ.
 
         Returns:
             the user's id if it exists in manageiq, None otherwise.
         """
+        if self.snapshot:
+            user = self.snapshot.find('users', userid=userid)
+            return user and user['id']
         users = self.client.collections.users
         return next((user.id for user in users if user.userid == userid), None)
 
-    def delete_user(self, userid):
-        """Deletes the user from manageiq.
+    @traced
+    def delete_user(self, userid, user_id=None):
+        """Deletes the user, given by its id or by its userid, from manageiq.
 
         Returns:
             a short message describing the operation executed.
         """
-        user_id = self.find_user_by_userid(userid)
+        if user_id:
+            # check the user given by its id exists with a single small request
+            try:
+                if not resource_exists(self.client, self.api_url, 'users', user_id, self.snapshot):
+                    user_id = None
+            except Exception as e:
+                self.module.fail_json(msg="Failed to query user {user_id}: {error}".format(user_id=user_id, error=e))
+        else:
+            user_id = self.find_user_by_userid(userid)
         if not user_id:  # user doesn't exist
             return dict(
                 changed=self.changed,
                 msg="User {userid} does not exist in manageiq".format(userid=userid))
+        if self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                changed=self.changed,
+                msg="User {userid} would be deleted".format(userid=userid)),
+                before={'userid': userid}, after={})
         try:
             url = '{api_url}/users/{user_id}'.format(api_url=self.api_url, user_id=user_id)
             result = self.client.post(url, action='delete')
@@ -142,17 +204,30 @@ class ManageIQUser(object):
         except Exception as e:
             self.module.fail_json(msg="Failed to delete user {userid}: {error}".format(userid=userid, error=e))
 
+    @traced
     def user_update_required(self, user_id, userid, username, group_id, email):
-        """ Returns true if the username, group id or email passed for the user
-            differ from the user's existing ones, False otherwise.
+        """ Checks whether the username, group id or email passed for the user
+            differ from the user's existing ones.
+
+        Returns:
+            Empty Hash - If all the attributes passed equal the user's current values
+            Hash of Changes - mapping each differing attribute to a (current, desired)
+                              tuple of its values
         """
         try:
-            url = "{api_url}/users/{user_id}".format(api_url=self.api_url, user_id=user_id)
-            result = self.client.get(url)
-            return result['name'] != username or result['current_group_id'] != group_id or result.get('email') != email
+            if self.snapshot:
+                result = self.snapshot.get('users', user_id)
+            else:
+                url = "{api_url}/users/{user_id}".format(api_url=self.api_url, user_id=user_id)
+                result = self.client.get(url)
+            attributes_tuples = [('name', result['name'], username), ('group_id', result['current_group_id'], group_id),
+                                 ('email', result.get('email'), email)]
+            return {attribute: (current, desired) for (attribute, current, desired) in attributes_tuples
+                    if current != desired}
         except Exception as e:
             self.module.fail_json(msg="Failed to get user {userid} details. Error: {error}".format(userid=userid, error=e))
 
+    @traced
     def update_user_if_required(self, user_id, userid, username, group_id, password, email):
         """Updates the user in manageiq.
 
@@ -160,22 +235,33 @@ class ManageIQUser(object):
             the created user id, name, created_on timestamp,
             updated_on timestamp, userid and current_group_id
         """
-        if not self.user_update_required(user_id, userid, username, group_id, email):
+        updates = self.user_update_required(user_id, userid, username, group_id, email)
+        if not updates:
             return dict(
                 changed=self.changed,
                 msg="User {userid} already exist, no need for updates".format(userid=userid))
+        if self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                changed=self.changed,
+                msg="User {userid} would be updated".format(userid=userid)),
+                before={attribute: current for attribute, (current, desired) in updates.items()},
+                after={attribute: desired for attribute, (current, desired) in updates.items()})
         try:
             url = '{api_url}/users/{user_id}'.format(api_url=self.api_url, user_id=user_id)
             resource = {'userid': userid, 'name': username, 'password': password,
                         'group': {'id': group_id}, 'email': email}
             result = self.client.post(url, action='edit', resource=resource)
             self.changed = True
-            return dict(
-                changed=self.changed,
-                msg="Successfully updated the user {userid}: {user_details}".format(userid=userid, user_details=result))
+            return result_details(self.result_detail, dict(
+                user_id=user_id, href=url, changed=self.changed,
+                msg="Successfully updated the user {userid}".format(userid=userid)),
+                changed_fields=updates, updates={attribute: desired for attribute, (current, desired) in updates.items()},
+                payload=result)
         except Exception as e:
             self.module.fail_json(msg="Failed to update user {userid}: {error}".format(userid=userid, error=e))
 
+    @traced
     def create_user(self, userid, username, group_id, password, email):
         """Creates the user in manageiq.
 
@@ -183,31 +269,51 @@ class ManageIQUser(object):
             the created user id, name, created_on timestamp,
             updated_on timestamp, userid and current_group_id
         """
+        if self.module.check_mode:
+            self.changed = True
+            return diff_result(self.module, dict(
+                changed=self.changed,
+                msg="User {userid} would be created".format(userid=userid)),
+                before={}, after={'userid': userid, 'name': username, 'group_id': group_id, 'email': email})
         try:
             url = '{api_url}/users'.format(api_url=self.api_url)
             resource = {'userid': userid, 'name': username, 'password': password,
                         'group': {'id': group_id}, 'email': email}
             result = self.client.post(url, action='create', resource=resource)
             self.changed = True
-            return dict(
-                changed=self.changed,
-                msg="Successfully created the user {userid}: {user_details}".format(userid=userid, user_details=result['results']))
+            user_id = result['results'][0]['id']
+            return result_details(self.result_detail, dict(
+                user_id=user_id, href='{url}/{user_id}'.format(url=url, user_id=user_id), changed=self.changed,
+                msg="Successfully created the user {userid}".format(userid=userid)),
+                payload=result['results'])
         except Exception as e:
             self.module.fail_json(msg="Failed to create user {userid}: {error}".format(userid=userid, error=e))
 
-    def create_or_update_user(self, userid, username, password, group, email):
-        """ Create or update a user in manageiq.
+    @traced
+    def create_or_update_user(self, userid, username, password, group, email, user_id=None, group_id=None):
+        """ Create or update a user in manageiq. The user and the group are looked
+        up by their names, unless their ids are given.
 
         Returns:
             Whether or not a change took place and a message describing the
             operation executed.
         """
-        group_id = self.find_group_by_name(group)
+        if group_id:
+            # check the group given by its id exists with a single small request
+            try:
+                group_exists = resource_exists(self.client, self.api_url, 'groups', group_id, self.snapshot)
+            except Exception as e:
+                self.module.fail_json(msg="Failed to query group {group_id}: {error}".format(group_id=group_id, error=e))
+            if not group_exists:
+                self.module.fail_json(
+                    msg="Failed to create user {userid}: group {group_id} does not exist in manageiq".format(userid=userid, group_id=group_id))
+        else:
+            group_id = self.find_group_by_name(group)
         if not group_id:  # group doesn't exist
             self.module.fail_json(
                 msg="Failed to create user {userid}: group {group_name} does not exist in manageiq".format(userid=userid, group_name=group))
 
-        user_id = self.find_user_by_userid(userid)
+        user_id = user_id or self.find_user_by_userid(userid)
         if user_id:  # user already exist
             return self.update_user_if_required(user_id, userid, username, group_id, password, email)
         else:
@@ -221,6 +327,7 @@ def main():
             fullname=dict(required=False, type='str'),
             password=dict(required=False, type='str', no_log=True),
             group=dict(required=False, type='str'),
+            group_id=dict(required=False, type='str'),
             email=dict(required=False, type='str'),
             state=dict(required=False, type='str',
                        choices=['present', 'absent'], defualt='present'),
@@ -228,40 +335,50 @@ def main():
             miq_username=dict(default=os.environ.get('MIQ_USERNAME', None)),
             miq_password=dict(default=os.environ.get('MIQ_PASSWORD', None), no_log=True),
             miq_verify_ssl=dict(require=False, type='bool', default=True),
-            ca_bundle_path=dict(required=False, type='str', defualt=None)
+            ca_bundle_path=dict(required=False, type='str', defualt=None),
+            snapshot_path=dict(required=False, type='path'),
+            **dict(manageiq_client_argument_spec(), **dict(manageiq_resource_argument_spec('user_id'),
+                                                           **dict(manageiq_appliances_argument_spec(),
+                                                                  **manageiq_result_argument_spec())))
         ),
+        mutually_exclusive=[['resource_id', 'href'], ['group', 'group_id'], ['miq_appliances', 'resource_id'],
+                            ['miq_appliances', 'href'], ['miq_appliances', 'group_id'],
+                            ['miq_appliances', 'snapshot_path']],
         required_if=[
-            ('state', 'present', ['fullname', 'group', 'password'])
+            ('state', 'present', ['fullname', 'password'])
         ],
+        supports_check_mode=True,
     )
 
-    for arg in ['miq_url', 'miq_username', 'miq_password']:
-        if module.params[arg] in (None, ''):
-            module.fail_json(msg="missing required argument: {}".format(arg))
-
-    miq_url        = module.params['miq_url']
-    miq_username   = module.params['miq_username']
-    miq_password   = module.params['miq_password']
-    miq_verify_ssl = module.params['miq_verify_ssl']
-    ca_bundle_path = module.params['ca_bundle_path']
     name           = module.params['name']
     fullname       = module.params['fullname']
     password       = module.params['password']
     group          = module.params['group']
     email          = module.params['email']
     state          = module.params['state']
+    user_id        = resource_id_from_params(module.params)
+    group_id       = module.params['group_id']
+
+    if state == 'present' and not (group or group_id):
+        module.fail_json(msg="state is present but any of the following are missing: group, group_id")
+
+    snapshot       = load_snapshot(module, ['users', 'groups'])
 
-    manageiq = ManageIQUser(module, miq_url, miq_username, miq_password, miq_verify_ssl, ca_bundle_path)
-    if state == "present":
-        res_args = manageiq.create_or_update_user(name, fullname, password,
-                                                  group, email)
-    if state == "absent":
-        res_args = manageiq.delete_user(name)
+    def apply(module, connection):
+        manageiq = ManageIQUser(module, connection['miq_url'], connection['miq_username'], connection['miq_password'],
+                                connection['miq_verify_ssl'], connection['ca_bundle_path'],
+                                manageiq_client_options(module.params), snapshot, module.params['result_detail'])
+        if state == "present":
+            res_args = manageiq.create_or_update_user(name, fullname, password,
+                                                      group, email, user_id, group_id)
+        if state == "absent":
+            res_args = manageiq.delete_user(name, user_id)
+        return dict(api_stats=manageiq.client.stats, **res_args)
 
-    module.exit_json(**res_args)
+    module.exit_json(**run_on_appliances(module, apply))
 
 
 # Import module bits
-from ansible.module_utils.basic import *
+from ansible.module_utils.basic import AnsibleModule
 if __name__ == "__main__":
-    main()
+    profiled('manageiq_user', main)()
@@ -0,0 +1,191 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    lookup: manageiq_resolve
+    short_description: resolve ManageIQ resource names to their hrefs
+    requirements: [ ManageIQ/manageiq-api-client-python ]
+    author: Daniel Korn (@dkorn)
+    description:
+        - Resolves the names of many ManageIQ resources to their hrefs (or ids),
+          to be passed to the href (or resource_id) option of the manageiq modules.
+        - The names are grouped by collection, and each collection is queried once,
+          with a filter matching any of its names.
+        - Resolved names are cached for cache_ttl seconds in a file of the lock
+          directory, per appliance and user, and are not queried again by the
+          following tasks and plays.
+    options:
+        _terms:
+            description:
+                - the resources to resolve, either as 'collection/name' strings or
+                  as dictionaries with 'collection' and 'name' keys.
+                - users are resolved by their userid, and alert definitions by their
+                  description.
+            required: true
+        miq_url:
+            description: the manageiq environment url
+            env:
+                - name: MIQ_URL
+        miq_username:
+            description: manageiq username
+            env:
+                - name: MIQ_USERNAME
+        miq_password:
+            description: manageiq password
+            env:
+                - name: MIQ_PASSWORD
+        miq_verify_ssl:
+            description: whether SSL certificates should be verified for HTTPS requests
+            type: bool
+            default: true
+        ca_bundle_path:
+            description: the path to a CA_BUNDLE file or directory with certificates
+            default: null
+        miq_lock_dir:
+            description: the directory the resolved names are cached in
+            env:
+                - name: MIQ_LOCK_DIR
+        cache_ttl:
+            description: the number of seconds resolved names are cached, 0 to not cache them
+            type: int
+            default: 3600
+        return:
+            description: whether to return the hrefs or the ids of the resources
+            choices: ['href', 'id']
+            default: href
+'''
+
+EXAMPLES = '''
+- name: Resolve the providers once
+  set_fact:
+    provider_hrefs: "{{ query('manageiq_resolve', 'providers/OpenShift01', 'providers/OpenShift02',
+                              miq_url='http://localhost:3000', miq_username='admin', miq_password='******') }}"
+
+- name: Assign a tag by href
+  manageiq_tag_assignment:
+    tags:
+    - category: environment
+      name: prod
+    resource: 'provider'
+    href: '{{ item }}'
+  with_items: '{{ provider_hrefs }}'
+'''
+
+RETURN = '''
+  _raw:
+    description: the href (or id) of each of the resources, in the order of the terms
+'''
+
+import json  # noqa: E402
+import os  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+
+import ansible.module_utils  # noqa: E402
+from ansible.errors import AnsibleError  # noqa: E402
+from ansible.module_utils.six import string_types  # noqa: E402
+from ansible.plugins.lookup import LookupBase  # noqa: E402
+
+# the lookup runs on the controller, where the module_utils directory of this
+# repository is not on the import path of ansible.module_utils
+ansible.module_utils.__path__.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils'))
+
+from ansible.module_utils.manageiq_utils import (DEFAULT_LOCK_DIR, ManageIQClient, appliance_key, id_from_href,  # noqa: E402
+                                                 makedirs, resolve_names)
+
+
+class LookupModule(LookupBase):
+
+    @staticmethod
+    def parse_term(term):
+        """ Returns the (collection, name) of a lookup term
+        """
+        if isinstance(term, string_types):
+            if '/' not in term:
+                raise AnsibleError("Invalid manageiq_resolve term {!r}, expected collection/name".format(term))
+            return tuple(term.split('/', 1))
+        try:
+            return term['collection'], term['name']
+        except (KeyError, TypeError):
+            raise AnsibleError("Invalid manageiq_resolve term {!r}, expected collection and name keys".format(term))
+
+    def cache_path(self, url):
+        # users see the resources their role allows, each has its own cache
+        key = appliance_key('{url}#{username}'.format(url=url, username=self.get_option('miq_username')))
+        return os.path.join(self.get_option('miq_lock_dir') or DEFAULT_LOCK_DIR, key + '.resolved')
+
+    def read_cache(self, path):
+        """ Returns the cached hrefs which didn't expire, by (collection, name)
+        """
+        ttl = self.get_option('cache_ttl')
+        if not ttl:
+            return {}
+        try:
+            with open(path) as cache_file:
+                entries = json.load(cache_file)
+            now = time.time()
+            return dict(((entry['collection'], entry['name']), entry) for entry in entries
+                        if now - entry['time'] < ttl)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def write_cache(self, path, cached):
+        # write and rename, so that concurrent readers never see a partial file
+        try:
+            makedirs(os.path.dirname(path), 0o700)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.resolved')
+            with os.fdopen(fd, 'w') as cache_file:
+                cache_file.write(json.dumps(list(cached.values())))
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass
+
+    def resolve(self, url, pairs):
+        """ Queries the names of the pairs which aren't cached, one query for
+        each collection, and caches their hrefs.
+
+        Returns:
+            the hrefs of the names which exist, by (collection, name).
+        """
+        path = self.cache_path(url)
+        cached = self.read_cache(path)
+        unresolved = {}
+        for collection, name in pairs:
+            if (collection, name) not in cached:
+                unresolved.setdefault(collection, set()).add(name)
+
+        if unresolved:
+            api_url = url + '/api'
+            try:
+                client = ManageIQClient(api_url, (self.get_option('miq_username'), self.get_option('miq_password')),
+                                        verify_ssl=self.get_option('miq_verify_ssl'),
+                                        ca_bundle_path=self.get_option('ca_bundle_path'))
+                now = time.time()
+                for collection, names in unresolved.items():
+                    for name, href in resolve_names(client, api_url, collection, names).items():
+                        cached[(collection, name)] = dict(collection=collection, name=name, href=href, time=now)
+            except Exception as e:
+                raise AnsibleError("Failed to resolve manageiq names: {}".format(e))
+            if self.get_option('cache_ttl'):
+                self.write_cache(path, cached)
+
+        return dict((key, entry['href']) for key, entry in cached.items())
+
+    def run(self, terms, variables=None, **kwargs):
+        self.set_options(var_options=variables, direct=kwargs)
+        url = self.get_option('miq_url')
+        for option in ('miq_url', 'miq_username', 'miq_password'):
+            if not self.get_option(option):
+                raise AnsibleError("missing required argument: {}".format(option))
+
+        pairs = [self.parse_term(term) for term in terms]
+        resolved = self.resolve(url, pairs)
+
+        results = []
+        for collection, name in pairs:
+            href = resolved.get((collection, name))
+            if href is None:
+                raise AnsibleError("{name} does not exist in manageiq {collection}".format(name=name, collection=collection))
+            results.append(id_from_href(href) if self.get_option('return') == 'id' else href)
+        return results
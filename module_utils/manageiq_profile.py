@@ -0,0 +1,104 @@
+""" Profiling of the manageiq_* module runs, enabled by the MIQ_PROFILE env
+var, see manageiq_utils.profiled.
+
+The CPU profile is taken with cProfile and written as pstats, to be read
+with the pstats module or tools like snakeviz. The memory profile is taken
+with tracemalloc, and the allocation sites holding the most memory at the
+end of the run are written as text.
+"""
+
+import cProfile
+import os
+import time
+
+try:
+    import tracemalloc
+    HAS_TRACEMALLOC = True
+except ImportError:
+    HAS_TRACEMALLOC = False
+
+from ansible.module_utils.manageiq_utils import makedirs
+
+
+PROFILE_MODES = ('cpu', 'memory')
+
+TOP_ALLOCATIONS = 25
+
+
+class ModuleProfiler(object):
+    """ Profiles a module run, and writes the profiles to files named after
+    the module, the time and the process id.
+
+    name      - the module name
+    modes     - the profiles taken, of PROFILE_MODES
+    directory - the directory the profiles are written to
+
+    Only the thread the profiler was started in is profiled by cProfile, e.g.
+    not the appliance threads of a module run with miq_appliances.
+    """
+
+    def __init__(self, name, modes, directory):
+        self.modes     = [mode for mode in PROFILE_MODES if mode in modes]
+        self.directory = directory
+        self.prefix    = os.path.join(directory, '{name}-{time}-{pid}'.format(
+            name=name, time=time.strftime('%Y%m%d%H%M%S'), pid=os.getpid()))
+        self.profile   = None
+        self.started   = None
+        self.summary   = None
+
+    def start(self):
+        makedirs(self.directory)
+        if 'memory' in self.modes and HAS_TRACEMALLOC:
+            tracemalloc.start()
+        if 'cpu' in self.modes:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.started = time.time()
+
+    def stop(self):
+        """ Stops profiling and writes the profiles, on the first call.
+
+        Returns:
+            a line summarizing the profiles and where they were written
+        """
+        if self.summary is not None:
+            return self.summary
+        elapsed = time.time() - self.started
+        if self.profile:
+            self.profile.disable()
+        # the allocations are read before writing the pstats, which allocates
+        # as much as a small module run
+        memory = None
+        if 'memory' in self.modes:
+            if HAS_TRACEMALLOC:
+                memory = self.write_allocations(self.prefix + '.allocations.txt')
+            else:
+                memory = "memory not profiled, tracemalloc is not available"
+        summary = []
+        if self.profile:
+            path = self.prefix + '.pstats'
+            self.profile.dump_stats(path)
+            calls = sum(stat[1] for stat in self.profile.getstats())
+            summary.append("cpu {elapsed:.3f} s, {calls} calls, pstats in {path}".format(
+                elapsed=elapsed, calls=calls, path=path))
+        if memory:
+            summary.append(memory)
+        self.summary = '; '.join(summary)
+        return self.summary
+
+    def write_allocations(self, path):
+        """ Writes the allocation sites holding the most memory, and stops
+        tracing allocations.
+
+        Returns:
+            a summary of the memory profile
+        """
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = snapshot.statistics('lineno')
+        with open(path, 'w') as allocations_file:
+            allocations_file.write("current {current} bytes, peak {peak} bytes\n".format(current=current, peak=peak))
+            for stat in stats[:TOP_ALLOCATIONS]:
+                allocations_file.write("{stat}\n".format(stat=stat))
+        return "memory peak {peak:.1f} MiB, top allocations in {path}".format(peak=peak / 1048576.0, path=path)
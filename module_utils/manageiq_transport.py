@@ -0,0 +1,402 @@
+""" The ManageIQ API client used by the manageiq_* modules, and the requests
+transport adapter applying the appliance-wide policies to all its requests.
+
+Importing this file imports the ManageIQ Python API client and requests, the
+modules create clients through manageiq_utils.ManageIQClient which imports it
+lazily.
+"""
+
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+from manageiq_client.api import ManageIQClient as MiqApi
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from ansible.module_utils.six.moves.urllib.parse import urlsplit, urlunsplit
+from ansible.module_utils.manageiq_utils import (DEFAULT_LOCK_DIR, HAS_FCNTL, METRICS, TRACER, ConcurrencyLimiter,
+                                                 RetryPolicy, appliance_key, makedirs, metrics_endpoint,
+                                                 new_client_stats)
+
+if HAS_FCNTL:
+    import fcntl
+
+# the fastest JSON decoder available, the responses of large reads such as
+# alert_definitions?expand=resources are mostly decoding time
+try:
+    import orjson
+    json_loads = orjson.loads
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+        JSON_BACKEND = 'ujson'
+    except ImportError:
+        def json_loads(content):
+            return json.loads(content.decode('utf-8'))
+        JSON_BACKEND = 'json'
+
+
+class CircuitOpenError(RequestException):
+    """ Raised instead of sending a request while the circuit breaker is open
+    """
+
+
+class CircuitBreaker(object):
+    """ Stops sending requests to an appliance that keeps failing.
+
+    The breaker state is kept in a file keyed by the appliance url, so all the
+    processes on the host share it. After threshold consecutive transient
+    failures the breaker opens, and requests fail immediately until cooldown
+    seconds have passed.
+
+    url       - the appliance url used as the state file key
+    threshold - consecutive failures that open the breaker
+    cooldown  - seconds the breaker stays open
+    lock_dir  - the directory holding the state file
+    """
+
+    def __init__(self, url, threshold, cooldown=60, lock_dir=DEFAULT_LOCK_DIR):
+        if not HAS_FCNTL:
+            raise ValueError("miq_circuit_breaker_threshold requires fcntl, which is not available on this platform")
+        self.threshold = threshold
+        self.cooldown  = cooldown
+        self.path      = os.path.join(lock_dir, appliance_key(url) + '.breaker')
+        makedirs(lock_dir, 0o700)
+
+    def _update(self, update):
+        """ Applies update on the breaker state under an exclusive lock, and
+        returns the new state.
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), 'r+') as state_file:
+                content = state_file.read()
+                try:
+                    state = json.loads(content) if content else {}
+                except ValueError:
+                    state = {}
+                new_state = update(dict(state))
+                if new_state != state:
+                    state_file.seek(0)
+                    state_file.truncate()
+                    state_file.write(json.dumps(new_state))
+            return new_state
+        finally:
+            os.close(fd)
+
+    def check(self):
+        """ Raises CircuitOpenError if the breaker is open
+        """
+        state = self._update(lambda state: state)
+        open_until = state.get('open_until', 0)
+        if open_until > time.time():
+            raise CircuitOpenError(
+                "Circuit breaker open after {failures} consecutive failures, "
+                "not sending requests to the appliance for {seconds:.0f} more seconds".format(
+                    failures=state.get('failures'), seconds=open_until - time.time()))
+
+    def record_success(self):
+        def reset(state):
+            return {} if state.get('failures') else state
+        self._update(reset)
+
+    def record_failure(self):
+        def count(state):
+            state['failures'] = state.get('failures', 0) + 1
+            if state['failures'] >= self.threshold:
+                state['open_until'] = time.time() + self.cooldown
+            return state
+        self._update(count)
+
+
+class CassetteError(RequestException):
+    """ Raised when a replayed request has no recorded response left
+    """
+
+
+SCRUBBED = '********'
+
+# the keys of the request and response bodies holding credentials
+SECRET_KEYS = re.compile(r'password|secret|token|auth_key', re.IGNORECASE)
+
+# the headers which aren't recorded, either holding credentials or describing
+# the response as sent rather than as recorded
+SKIPPED_HEADERS = ('authorization', 'x-auth-token', 'cookie', 'set-cookie',
+                   'content-encoding', 'content-length', 'transfer-encoding')
+
+
+def scrub(data):
+    """ Returns the JSON data with the values of the SECRET_KEYS replaced
+    """
+    if isinstance(data, dict):
+        return dict((key, SCRUBBED if SECRET_KEYS.search(key) and value is not None else scrub(value))
+                    for key, value in data.items())
+    if isinstance(data, list):
+        return [scrub(value) for value in data]
+    return data
+
+
+def scrub_body(body):
+    """ Returns the request or response body as text, scrubbed if it's JSON
+    """
+    if not body:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    try:
+        return json.dumps(scrub(json.loads(body)), sort_keys=True)
+    except ValueError:
+        return body
+
+
+def scrub_url(url):
+    """ Returns the url without the credentials it may hold
+    """
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc.rsplit('@', 1)[-1], parts.path, parts.query, parts.fragment))
+
+
+class Cassette(object):
+    """ The requests sent to the appliance and their responses, recorded to a
+    file to be replayed later without the appliance, e.g. to profile a slow
+    module run offline.
+
+    The cassette is a file of JSON lines, one per request, holding the request
+    method, url and body, the response status, headers and body, and the
+    seconds from sending the request to reading its whole response. The
+    credentials are scrubbed from the urls, the headers and the bodies.
+    Recorded requests are appended to the file.
+
+    Replayed requests are answered with the responses recorded for the same
+    method and url, in the order they were recorded.
+
+    path    - the cassette file path
+    replay  - whether to replay the cassette, rather than record it
+    latency - on replay, 'original' to answer after the recorded time, or
+              'none' to answer at once
+    """
+
+    def __init__(self, path, replay=False, latency='none'):
+        self.path    = path
+        self.replay  = replay
+        self.latency = latency
+        self.lock    = threading.Lock()
+        self.recorded = {}
+        if replay:
+            with open(path) as cassette_file:
+                for line in cassette_file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.recorded.setdefault((entry['method'], entry['url']), collections.deque()).append(entry)
+        elif os.path.dirname(path):
+            makedirs(os.path.dirname(path))
+
+    def record(self, request, response, elapsed):
+        """ Appends the request and its response to the cassette
+        """
+        entry = dict(method=request.method, url=scrub_url(request.url),
+                     request_body=scrub_body(request.body),
+                     status=response.status_code, reason=response.reason,
+                     headers=dict((name, value) for name, value in response.headers.items()
+                                  if name.lower() not in SKIPPED_HEADERS),
+                     body=scrub_body(response.content), elapsed=round(elapsed, 6))
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as cassette_file:
+                cassette_file.write(line)
+
+    def play(self, request):
+        """ Returns the next response recorded for the request
+        """
+        url = scrub_url(request.url)
+        with self.lock:
+            recorded = self.recorded.get((request.method, url))
+            if not recorded:
+                raise CassetteError("No recorded response left for {method} {url} in {path}".format(
+                    method=request.method, url=url, path=self.path))
+            entry = recorded.popleft()
+        if self.latency == 'original':
+            time.sleep(entry['elapsed'])
+        response = Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers.update(entry['headers'])
+        response._content = (entry['body'] or '').encode('utf-8')
+        response._content_consumed = True
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+
+class ManageIQAdapter(HTTPAdapter):
+    """ requests transport adapter applying the appliance-wide policies to every
+    request sent by the client, and collecting the request statistics.
+
+    stats        - the dictionary the statistics are accumulated into
+    limiter      - a ConcurrencyLimiter, or None to send requests without a limit
+    retry_policy - a RetryPolicy, or None to never retry requests
+    breaker      - a CircuitBreaker, or None to always send requests
+    cassette     - a Cassette the requests are recorded to, or replayed from
+                   instead of being sent, or None
+    """
+
+    def __init__(self, stats, limiter=None, retry_policy=None, breaker=None, cassette=None, **kwargs):
+        super(ManageIQAdapter, self).__init__(**kwargs)
+        self.stats        = stats
+        self.limiter      = limiter
+        self.retry_policy = retry_policy
+        self.breaker      = breaker
+        self.cassette     = cassette
+
+    def _send_http(self, request, **kwargs):
+        start = time.time()
+        response = super(ManageIQAdapter, self).send(request, **kwargs)
+        # the whole response is read by the session anyway, read it here so
+        # that the time it takes counts in the request span and cassette
+        response.content
+        if self.cassette is not None:
+            self.cassette.record(request, response, time.time() - start)
+        return response
+
+    def _send_once(self, request, **kwargs):
+        self.stats['requests'] += 1
+        METRICS.count_requests()
+        url = urlsplit(request.url or '')
+        start, waited = time.time(), 0
+        with TRACER.span('{method} {path}'.format(method=request.method, path=url.path),
+                         'http', url=request.url) as span:
+            if self.cassette and self.cassette.replay:
+                response = self.cassette.play(request)
+            elif self.limiter is None:
+                response = self._send_http(request, **kwargs)
+            else:
+                slot, waited = self.limiter.acquire()
+                self.stats['concurrency_wait_seconds'] += waited
+                span.args['concurrency_wait_seconds'] = waited
+                try:
+                    response = self._send_http(request, **kwargs)
+                finally:
+                    self.limiter.release(slot)
+            span.args['status'] = response.status_code
+            # the time waited for a concurrency slot is not the appliance's
+            METRICS.observe('manageiq_api_request_duration_seconds', time.time() - start - waited,
+                            appliance=url.netloc, method=request.method, endpoint=metrics_endpoint(url.path))
+            return response
+
+    def send(self, request, **kwargs):
+        retries = self.retry_policy.retries if self.retry_policy and self.retry_policy.allows(request) else 0
+        attempt = 0
+        while True:
+            if self.breaker:
+                self.breaker.check()
+            try:
+                response = self._send_once(request, **kwargs)
+            except (ConnectionError, Timeout):
+                if self.breaker:
+                    self.breaker.record_failure()
+                if attempt >= retries:
+                    raise
+                response = None
+            else:
+                if response.status_code not in RetryPolicy.RETRY_STATUSES:
+                    if self.breaker:
+                        self.breaker.record_success()
+                    return response
+                if self.breaker:
+                    self.breaker.record_failure()
+                if attempt >= retries:
+                    return response
+
+            delay = self.retry_policy.delay(attempt, response)
+            if response is not None:
+                response.close()
+            attempt += 1
+            self.stats['retries'] += 1
+            time.sleep(delay)
+
+
+class ManageIQClient(MiqApi):
+    """ ManageIQ API client sending all its requests through a ManageIQAdapter
+
+    entry_point               - the manageiq api url
+    auth                      - the authentication tuple or dictionary
+    verify_ssl                - whether SSL certificates should be verified for HTTPS requests
+    ca_bundle_path            - the path to a CA_BUNDLE file or directory with certificates
+    max_concurrency           - maximal number of requests in flight to the appliance from
+                                all the processes on this host, None for no limit
+    lock_dir                  - the directory holding the limiter and breaker files
+    retries                   - maximal number of retries of a request on transient errors
+    retry_backoff             - the delay in seconds before the first retry
+    circuit_breaker_threshold - consecutive transient errors after which requests
+                                fail fast, 0 to disable the circuit breaker
+    circuit_breaker_cooldown  - seconds requests fail fast once the breaker opened
+    record_cassette           - the path of a Cassette to record the requests to
+    replay_cassette           - the path of a Cassette to replay the requests from,
+                                instead of sending them to the appliance
+    replay_latency            - 'original' to replay the responses after their
+                                recorded time, 'none' to replay them at once
+
+    The responses are requested gzip'd, and decoded with the fastest JSON
+    backend available, see JSON_BACKEND.
+    """
+
+    def __init__(self, entry_point, auth, verify_ssl=True, ca_bundle_path=None,
+                 max_concurrency=None, lock_dir=DEFAULT_LOCK_DIR, retries=3, retry_backoff=1.0,
+                 circuit_breaker_threshold=0, circuit_breaker_cooldown=60,
+                 record_cassette=None, replay_cassette=None, replay_latency='none'):
+        if record_cassette and replay_cassette:
+            raise ValueError("miq_record_cassette and miq_replay_cassette are mutually exclusive")
+        self.stats = new_client_stats()
+        lock_dir = lock_dir or DEFAULT_LOCK_DIR
+        limiter = None
+        if max_concurrency:
+            limiter = ConcurrencyLimiter(entry_point, max_concurrency, lock_dir)
+        breaker = None
+        if circuit_breaker_threshold:
+            breaker = CircuitBreaker(entry_point, circuit_breaker_threshold, circuit_breaker_cooldown, lock_dir)
+        cassette = None
+        if record_cassette or replay_cassette:
+            cassette = Cassette(record_cassette or replay_cassette, bool(replay_cassette), replay_latency)
+        self._adapter = ManageIQAdapter(self.stats, limiter=limiter,
+                                        retry_policy=RetryPolicy(retries or 0, retry_backoff),
+                                        breaker=breaker, cassette=cassette)
+        super(ManageIQClient, self).__init__(entry_point, auth, verify_ssl=verify_ssl, ca_bundle_path=ca_bundle_path)
+
+    def _load_data(self):
+        # the session is created by the parent constructor, mount the adapter
+        # before the entry point is loaded so that it goes through it as well
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+        self._session.headers['Accept-Encoding'] = 'gzip'
+        super(ManageIQClient, self)._load_data()
+
+    def _result_processor(self, result):
+        content = result.content
+        self.stats['response_bytes'] += len(content)
+        # the bytes read off the connection, before decompression
+        raw = getattr(result, 'raw', None)
+        self.stats['received_bytes'] += raw.tell() if hasattr(raw, 'tell') else len(content)
+        decode = result.json
+
+        def fast_json(**kwargs):
+            with TRACER.span('decode json', 'json', bytes=len(content), backend=JSON_BACKEND):
+                try:
+                    return json_loads(content)
+                except ValueError:
+                    # reported by the parent, e.g. an empty response
+                    return decode(**kwargs)
+        result.json = fast_json
+        return super(ManageIQClient, self)._result_processor(result)
+
+    def _sending_request(self, func, retries=2):
+        # connection errors are already retried by the adapter, according to
+        # the retry policy
+        return func()
@@ -0,0 +1,1362 @@
+""" Shared ManageIQ client code used by the manageiq_* modules.
+
+The modules talk to ManageIQ through the ManageIQ Python API client, wrapped
+by manageiq_transport so that every HTTP request the modules send, including
+the initial entry point GET, goes through a single transport adapter where
+appliance-wide policies (like the concurrency limiter, the retry policy and the
+circuit breaker) are applied.
+
+This file only imports the standard library, so that a module failing its
+argument validation doesn't pay for importing the client and requests, which
+are imported when the first client is created.
+"""
+
+import errno
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+from ansible.module_utils.six import string_types
+from ansible.module_utils.six.moves.urllib.parse import quote
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+
+DEFAULT_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'manageiq-ansible')
+
+
+def new_client_stats():
+    """ Returns the initial statistics of a client, before any request was sent
+    """
+    return {'requests': 0, 'retries': 0, 'concurrency_wait_seconds': 0.0,
+            'received_bytes': 0, 'response_bytes': 0}
+
+
+def appliance_key(url):
+    """ Returns a file name safe key identifying the appliance url
+    """
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def manageiq_client_argument_spec():
+    """ Returns the argument spec of the options shared by all the modules
+    which control how the ManageIQ client talks to the appliance.
+    """
+    return dict(
+        miq_max_concurrency=dict(required=False, type='int',
+                                 default=os.environ.get('MIQ_MAX_CONCURRENCY', None)),
+        miq_lock_dir=dict(required=False, type='str',
+                          default=os.environ.get('MIQ_LOCK_DIR', DEFAULT_LOCK_DIR)),
+        miq_retries=dict(required=False, type='int',
+                         default=os.environ.get('MIQ_RETRIES', 3)),
+        miq_retry_backoff=dict(required=False, type='float',
+                               default=os.environ.get('MIQ_RETRY_BACKOFF', 1.0)),
+        miq_circuit_breaker_threshold=dict(required=False, type='int',
+                                           default=os.environ.get('MIQ_CIRCUIT_BREAKER_THRESHOLD', 0)),
+        miq_circuit_breaker_cooldown=dict(required=False, type='int',
+                                          default=os.environ.get('MIQ_CIRCUIT_BREAKER_COOLDOWN', 60)),
+        miq_worker=dict(required=False, type='bool',
+                        default=os.environ.get('MIQ_WORKER', False)),
+        miq_record_cassette=dict(required=False, type='path',
+                                 default=os.environ.get('MIQ_RECORD_CASSETTE', None)),
+        miq_replay_cassette=dict(required=False, type='path',
+                                 default=os.environ.get('MIQ_REPLAY_CASSETTE', None)),
+        miq_replay_latency=dict(required=False, type='str', choices=['original', 'none'],
+                                default=os.environ.get('MIQ_REPLAY_LATENCY', 'none')),
+        miq_metrics_dir=dict(required=False, type='path',
+                             default=os.environ.get('MIQ_METRICS_DIR', None)),
+    )
+
+
+def manageiq_client_options(params):
+    """ Returns the ManageIQClient keyword arguments matching the module params
+    """
+    return dict(max_concurrency=params['miq_max_concurrency'],
+                lock_dir=params['miq_lock_dir'],
+                retries=params['miq_retries'],
+                retry_backoff=params['miq_retry_backoff'],
+                circuit_breaker_threshold=params['miq_circuit_breaker_threshold'],
+                circuit_breaker_cooldown=params['miq_circuit_breaker_cooldown'],
+                worker=params['miq_worker'],
+                record_cassette=params['miq_record_cassette'],
+                replay_cassette=params['miq_replay_cassette'],
+                replay_latency=params['miq_replay_latency'],
+                metrics_dir=params['miq_metrics_dir'])
+
+
+def manageiq_resource_argument_spec(id_alias=None):
+    """ Returns the argument spec of the options identifying the resource a
+    module acts on by its id or href, instead of by its name.
+
+    id_alias - a name of the resource id option matching the module's own
+               naming, e.g. provider_id
+    """
+    return dict(
+        resource_id=dict(required=False, type='str', aliases=[id_alias] if id_alias else []),
+        href=dict(required=False, type='str'),
+    )
+
+
+def manageiq_appliances_argument_spec():
+    """ Returns the argument spec of the options applying the desired state of
+    a module to many appliances (e.g. the regions of a ManageIQ deployment) at
+    once, see run_on_appliances.
+    """
+    return dict(
+        # the passwords of the items are hidden by appliance_connections, a
+        # no_log list would hide the appliance names as well
+        miq_appliances=dict(required=False, type='list'),
+        miq_appliances_concurrency=dict(required=False, type='int', default=8),
+    )
+
+
+RESULT_DETAILS = ['minimal', 'normal', 'full']
+
+
+def manageiq_result_argument_spec():
+    """ Returns the argument spec of the option choosing how much of a change
+    the module returns, see result_details.
+    """
+    return dict(result_detail=dict(required=False, type='str', default='minimal', choices=RESULT_DETAILS))
+
+
+def result_details(result_detail, result, changed_fields=None, updates=None, payload=None):
+    """ Adds the details of a change to the module result, as many as the
+    result_detail option asks for. The API responses are only returned on
+    full, since with many loop items they make most of the task output.
+
+    result_detail  - minimal for the names of the changed fields, normal for
+                     their values as well, full for the API response as well
+    result         - the module result
+    changed_fields - the names of the fields the module changed
+    updates        - the changed fields and their values
+    payload        - the API response to the change
+
+    Returns:
+        the result
+    """
+    if changed_fields is not None:
+        result['changed_fields'] = sorted(changed_fields)
+    if result_detail != 'minimal' and updates is not None:
+        result['updates'] = updates
+    if result_detail == 'full' and payload is not None:
+        result['result'] = payload
+    return result
+
+
+# the keys of a miq_appliances item, besides name the ones default to the
+# module params of the same name
+APPLIANCE_KEYS = ('miq_url', 'miq_username', 'miq_password', 'miq_verify_ssl', 'ca_bundle_path')
+
+
+def appliance_connections(module):
+    """ Returns the connections to the appliances the module applies its
+    desired state to, dictionaries with the name of the appliance and the
+    APPLIANCE_KEYS, failing the module if any of them is missing.
+
+    Without miq_appliances, returns the single connection of the module params.
+    """
+    defaults = dict((key, module.params[key]) for key in APPLIANCE_KEYS)
+    connections = []
+    for appliance in module.params.get('miq_appliances') or [defaults]:
+        if not isinstance(appliance, dict):
+            module.fail_json(msg="miq_appliances items should be dictionaries, got {!r}".format(appliance))
+        unsupported = sorted(set(appliance) - set(APPLIANCE_KEYS + ('name',)))
+        if unsupported:
+            module.fail_json(msg="Unsupported miq_appliances keys: {}".format(', '.join(unsupported)))
+        connection = dict(defaults, **appliance)
+        if appliance.get('miq_password'):
+            module.no_log_values.add(appliance['miq_password'])
+        if isinstance(connection['miq_verify_ssl'], string_types):
+            connection['miq_verify_ssl'] = connection['miq_verify_ssl'].lower() in ('yes', 'on', '1', 'true', 'y')
+        for arg in ['miq_url', 'miq_username', 'miq_password']:
+            if connection[arg] in (None, ''):
+                module.fail_json(msg="missing required argument: {}".format(arg))
+        connection['name'] = appliance.get('name') or connection['miq_url']
+        connections.append(connection)
+
+    names = [connection['name'] for connection in connections]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        module.fail_json(msg="Duplicate miq_appliances: {}".format(', '.join(duplicates)))
+    return connections
+
+
+class ApplianceFailed(BaseException):
+    """ Raised by an ApplianceModule failing, with the failed result. Like the
+    SystemExit of AnsibleModule.fail_json, it isn't an Exception, so that the
+    modules catching their errors don't catch it and fail again.
+    """
+
+    def __init__(self, result):
+        super(ApplianceFailed, self).__init__(result.get('msg'))
+        self.result = result
+
+
+class ApplianceModule(object):
+    """ Stands for the AnsibleModule while its desired state is applied to one
+    of many appliances, so that failing one appliance doesn't exit the module
+    before the others are done.
+
+    module - the AnsibleModule
+    """
+
+    def __init__(self, module):
+        self._module = module
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+    def fail_json(self, **kwargs):
+        raise ApplianceFailed(kwargs)
+
+
+def run_on_appliances(module, apply):
+    """ Applies the desired state of the module to each of its appliances, in
+    parallel threads when miq_appliances is passed.
+
+    apply - called with the module and a connection (see appliance_connections)
+            to apply the desired state to a single appliance, returns its result
+
+    Returns:
+        the result of the single appliance if miq_appliances wasn't passed.
+        Otherwise, whether or not a change took place on any of the appliances,
+        a short message, the sum of their api_stats and their results by
+        appliance name, in regions. Fails the module if any appliance failed.
+    """
+    connections = appliance_connections(module)
+    if not module.params.get('miq_appliances'):
+        return apply(module, connections[0])
+
+    def apply_one(connection):
+        try:
+            return apply(ApplianceModule(module), connection)
+        except ApplianceFailed as e:
+            return dict(e.result, failed=True)
+        except Exception as e:
+            return dict(failed=True, changed=False, msg="Failed on {name}: {error}".format(name=connection['name'], error=e))
+
+    # imported here, as most runs are against a single appliance
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(len(connections), module.params['miq_appliances_concurrency'] or 1)))
+    try:
+        results = pool.map(apply_one, connections)
+    finally:
+        pool.close()
+        pool.join()
+
+    regions = dict((connection['name'], result) for connection, result in zip(connections, results))
+    api_stats = new_client_stats()
+    for result in results:
+        for key, value in result.get('api_stats', {}).items():
+            api_stats[key] = api_stats.get(key, 0) + value
+    changed = any(result.get('changed') for result in results)
+    failed = [connection['name'] for connection, result in zip(connections, results) if result.get('failed')]
+    if failed:
+        module.fail_json(msg="Failed on {count} of {total} appliances: {names}".format(
+            count=len(failed), total=len(connections), names=', '.join(failed)),
+            changed=changed, api_stats=api_stats, regions=regions)
+    return dict(changed=changed, msg="Applied to {total} appliances".format(total=len(connections)),
+                api_stats=api_stats, regions=regions)
+
+
+def id_from_href(href):
+    """ Returns the resource id of a manageiq href, e.g. 27 of
+    http://localhost:3000/api/providers/27
+    """
+    return href.rstrip('/').rsplit('/', 1)[-1]
+
+
+def resource_id_from_params(params):
+    """ Returns the resource id given by the resource_id or href module params,
+    None if neither was given
+    """
+    if params.get('resource_id'):
+        return str(params['resource_id'])
+    if params.get('href'):
+        return id_from_href(params['href'])
+    return None
+
+
+# the messages of the client errors of a 404 response, as raised by the client
+# or passed on by the worker
+NOT_FOUND_ERRORS = ('RecordNotFound', 'HTTP status 404')
+
+
+def is_not_found(client, error):
+    """ Returns True if the error raised by a request of the client is a 404
+    Not Found response, False for any other error, e.g. an authentication
+    error, a server error or a timeout.
+    """
+    response = getattr(client, 'response', None)
+    if type(error).__name__ == 'APIException' and getattr(response, 'status_code', None) == 404:
+        return True
+    return any(message in str(error) for message in NOT_FOUND_ERRORS)
+
+
+def resource_exists(client, api_url, collection, resource_id, snapshot=None):
+    """ Returns True if the resource of the collection with the id passed
+    exists in manageiq (or in the snapshot, if one is used), False if manageiq
+    answered it doesn't. Reads only the resource id.
+
+    Any other error of the request is raised, so that a failed request is never
+    taken for a resource that doesn't exist.
+    """
+    if snapshot:
+        return snapshot.get(collection, resource_id) is not None
+    try:
+        client.get('{api_url}/{collection}/{id}?attributes=id'.format(api_url=api_url, collection=collection, id=resource_id))
+        return True
+    except Exception as e:
+        if is_not_found(client, e):
+            return False
+        raise
+
+
+def diff_result(module, result, before, after):
+    """ Adds the state before and after the change to the module result, when
+    running in diff mode.
+
+    Returns:
+        the result
+    """
+    if module._diff:
+        result['diff'] = dict(before=before, after=after)
+    return result
+
+
+class Snapshot(object):
+    """ Appliance state exported by the manageiq_snapshot module, used by the
+    modules instead of the appliance as the source of the current state when
+    computing plans in check mode.
+
+    The snapshot is a gzip'd file of JSON lines. The first line is a header
+    describing the snapshot, each of the following lines holds a single
+    resource of one of the exported collections.
+
+    path - the snapshot file path
+    """
+
+    def __init__(self, path):
+        self.path        = path
+        self.header      = {}
+        self.collections = {}
+        self._indexes    = {}
+        with gzip.open(path, 'rb') as snapshot_file:
+            for line in snapshot_file:
+                record = json.loads(line.decode('utf-8'))
+                if 'snapshot' in record:
+                    self.header = record['snapshot']
+                else:
+                    self.collections.setdefault(record['collection'], []).append(record['resource'])
+
+    def require(self, collections):
+        """ Raises ValueError if any of the collections wasn't exported to the snapshot
+        """
+        missing = [c for c in collections if c not in self.header.get('collections', [])]
+        if missing:
+            raise ValueError("Snapshot {path} does not include the {collections} collection(s)".format(
+                path=self.path, collections=', '.join(missing)))
+
+    def resources(self, collection):
+        """ Returns the list of the collection resources
+        """
+        return self.collections.get(collection, [])
+
+    def find(self, collection, **attributes):
+        """ Returns the first resource of the collection with the attributes
+        values passed, None if there is no such resource.
+        """
+        return next((r for r in self.resources(collection)
+                     if all(r.get(k) == v for k, v in attributes.items())), None)
+
+    def get(self, collection, resource_id):
+        """ Returns the resource of the collection with the id passed, None if
+        there is no such resource.
+        """
+        if collection not in self._indexes:
+            self._indexes[collection] = {str(r['id']): r for r in self.resources(collection)}
+        return self._indexes[collection].get(str(resource_id))
+
+
+def query_collection(client, api_url, collection, query, page_size):
+    """ Yields the resources of the collection, reading them a page at a time
+
+    client    - the ManageIQ client
+    api_url   - the manageiq api url
+    query     - the query parameters used to read the collection, besides paging
+    page_size - the number of resources read in a single request
+    """
+    offset = 0
+    while True:
+        url = '{api_url}/{collection}?{query}&offset={offset}&limit={limit}'.format(
+            api_url=api_url, collection=collection, query=query, offset=offset, limit=page_size)
+        result = client.get(url)
+        resources = result.get('resources', [])
+        for resource in resources:
+            yield resource
+        offset += len(resources)
+        if len(resources) < page_size or offset >= result.get('subcount', result.get('count', 0)):
+            return
+
+
+# the attribute the resources of a collection are known by, when it isn't name
+NAME_ATTRIBUTES = {'users': 'userid', 'alert_definitions': 'description'}
+
+
+def name_filter(attribute, names):
+    """ Returns the query parameters of a manageiq filter matching any of the
+    names, e.g. filter[]=name='a'&filter[]=or name='b'
+    """
+    conditions = []
+    for name in names:
+        quote_char = '"' if "'" in name else "'"
+        condition = '{attribute}={quote}{name}{quote}'.format(attribute=attribute, quote=quote_char, name=name)
+        if conditions:
+            condition = 'or ' + condition
+        conditions.append('filter[]=' + quote(condition.encode('utf-8'), safe=''))
+    return '&'.join(conditions)
+
+
+def resolve_names(client, api_url, collection, names, attribute=None, batch_size=100, page_size=500):
+    """ Resolves the names of resources of a collection to their hrefs, with a
+    single filtered query for every batch_size names.
+
+    Returns:
+        a dictionary of the hrefs of the resources found, by name.
+    """
+    attribute = attribute or NAME_ATTRIBUTES.get(collection, 'name')
+    names = sorted(set(names))
+    hrefs = {}
+    for i in range(0, len(names), batch_size):
+        query = 'expand=resources&attributes={attribute}&{filter}'.format(
+            attribute=attribute, filter=name_filter(attribute, names[i:i + batch_size]))
+        METRICS.observe('manageiq_bulk_batch_size', len(names[i:i + batch_size]),
+                        operation='resolve_names', collection=collection)
+        for resource in query_collection(client, api_url, collection, query, page_size):
+            hrefs[resource[attribute]] = resource['href']
+    return hrefs
+
+
+def fingerprint(desired_state):
+    """ Returns a hash of the desired state, which should be JSON serializable
+    """
+    serialized = json.dumps(desired_state, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def normalize_certificate(content):
+    """ Returns the PEM content with unix line endings, no trailing whitespace
+    and a single final newline, or None if there's no content
+    """
+    if content is None:
+        return None
+    lines = content.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    normalized = '\n'.join(line.rstrip() for line in lines).strip('\n')
+    return normalized + '\n' if normalized else ''
+
+
+def certificate_fingerprint(content):
+    """ Returns a hash of the normalized PEM content, which compares equal for
+    the same certificates however their lines end, or None if there's no content
+    """
+    if content is None:
+        return None
+    return 'sha256:' + hashlib.sha256(normalize_certificate(content).encode('utf-8')).hexdigest()
+
+
+# normalized certificate files already read, by (path, mtime, size)
+CERTIFICATES = {}
+
+
+def read_certificate(path):
+    """ Returns the normalized content of the PEM file, reading it only once as
+    long as its modification time and size don't change
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+    if key not in CERTIFICATES:
+        with open(path, 'r') as certificate_file:
+            CERTIFICATES[key] = normalize_certificate(certificate_file.read())
+    return CERTIFICATES[key]
+
+
+class FingerprintStore(object):
+    """ Local store of the fingerprints of the desired state last applied to
+    manageiq resources, which lets the modules skip reading and comparing the
+    current state of resources that were already converged to the same state.
+
+    Each resource fingerprint is kept in its own file, so that processes
+    converging different resources don't contend over the store.
+
+    url              - the appliance url, so that each appliance has its own store
+    path             - the directory the store is kept in
+    full_check_every - the number of runs after which the full comparison is
+                       done even if the fingerprint matches
+    check_mode       - only read the store, without counting runs or storing
+                       fingerprints
+    """
+
+    def __init__(self, url, path, full_check_every=10, check_mode=False):
+        self.path             = os.path.join(path, appliance_key(url))
+        self.full_check_every = full_check_every
+        self.check_mode       = check_mode
+        if not check_mode:
+            makedirs(self.path)
+
+    def _record_path(self, kind, name):
+        return os.path.join(self.path, '{kind}-{key}.json'.format(kind=kind, key=appliance_key(name)))
+
+    def _write(self, kind, name, record):
+        if self.check_mode:
+            return
+        # write and rename, so that concurrent readers never see a partial record
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.fingerprint')
+        with os.fdopen(fd, 'w') as record_file:
+            record_file.write(json.dumps(record))
+        os.rename(tmp_path, self._record_path(kind, name))
+
+    def lookup(self, kind, name, desired_fingerprint):
+        """ Counts a run against the resource fingerprint.
+
+        Returns:
+            the resource id if the desired state fingerprint matches the last
+            applied one and no full check is due, None otherwise.
+        """
+        try:
+            with open(self._record_path(kind, name)) as record_file:
+                record = json.load(record_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if record.get('fingerprint') != desired_fingerprint or record.get('runs', 0) + 1 >= self.full_check_every:
+            return None
+        record['runs'] = record.get('runs', 0) + 1
+        self._write(kind, name, record)
+        return record['id']
+
+    def record(self, kind, name, desired_fingerprint, resource_id):
+        """ Stores the fingerprint of the desired state applied to the resource
+        after a full check
+        """
+        self._write(kind, name, {'fingerprint': desired_fingerprint, 'id': resource_id, 'runs': 0})
+
+    def forget(self, kind, name):
+        if self.check_mode:
+            return
+        try:
+            os.remove(self._record_path(kind, name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def load_snapshot(module, collections):
+    """ Loads the snapshot passed in the module snapshot_path param, failing the
+    module if it can't be used as the source of the current state, e.g. if it
+    was exported from another appliance than miq_url.
+
+    Returns:
+        the Snapshot, or None if no snapshot_path was passed.
+    """
+    path = module.params['snapshot_path']
+    if not path:
+        return None
+    if not module.check_mode:
+        module.fail_json(msg="snapshot_path can only be used in check mode")
+    try:
+        snapshot = Snapshot(path)
+        snapshot.require(collections)
+        # a snapshot of another appliance would plan changes against the wrong state
+        snapshot_url = snapshot.header.get('miq_url')
+        if (snapshot_url or '').rstrip('/') != (module.params['miq_url'] or '').rstrip('/'):
+            raise ValueError("the snapshot was exported from {snapshot_url}, not from {miq_url}".format(
+                snapshot_url=snapshot_url, miq_url=module.params['miq_url']))
+    except (IOError, OSError, ValueError) as e:
+        module.fail_json(msg="Failed to load snapshot {path}: {error}".format(path=path, error=e))
+    return snapshot
+
+
+def parse_version(version):
+    """ Returns the version string as a tuple of numbers, or None
+    """
+    if not isinstance(version, string_types):
+        return None
+    numbers = re.findall(r'\d+', version)
+    return tuple(int(number) for number in numbers[:3]) or None
+
+
+class Capabilities(object):
+    """ The features of an appliance which depend on its version, so that the
+    modules choose the shape of their requests up front instead of deducing
+    them from the resources they read.
+
+    The API version is taken from the entry point the client loaded when it
+    was created, and cached per appliance for ttl seconds for the clients
+    which don't have it. Features of an appliance whose version is unknown
+    are neither supported nor unsupported.
+
+    client    - the ManageIQ client
+    api_url   - the manageiq api url
+    cache_dir - the directory the capabilities are cached in, None to not cache them
+    ttl       - the number of seconds the cached capabilities are used
+    """
+
+    # the oldest API version supporting each feature
+    FEATURES = {
+        # endpoints have a certificate_authority since Fine (CFME 5.8)
+        'endpoint_certificate_authority': (2, 4, 0),
+        # alert definitions are returned with their expression_type since
+        # Gaprindashvili (CFME 5.9)
+        'alert_expression_type': (3, 0, 0),
+    }
+
+    def __init__(self, client, api_url, cache_dir=None, ttl=3600):
+        self.client = client
+        self.ttl    = ttl
+        self.path   = cache_dir and os.path.join(cache_dir, appliance_key(api_url) + '.capabilities')
+        self._info  = None
+
+    def _read_cache(self):
+        try:
+            with open(self.path) as cache_file:
+                info = json.load(cache_file)
+            return info if time.time() - info['time'] < self.ttl else None
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_cache(self, info):
+        # write and rename, so that concurrent readers never see a partial file
+        makedirs(os.path.dirname(self.path), 0o700)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.capabilities')
+        with os.fdopen(fd, 'w') as cache_file:
+            cache_file.write(json.dumps(info))
+        os.rename(tmp_path, self.path)
+
+    @property
+    def info(self):
+        """ The api_version and server_version of the appliance
+        """
+        if self._info is None:
+            cached = self.path and self._read_cache()
+            server_info = getattr(self.client, 'server_info', None)
+            info = dict(time=time.time(), api_version=getattr(self.client, 'version', None),
+                        server_version=server_info.get('version') if isinstance(server_info, dict) else None)
+            if parse_version(info['api_version']) is None:
+                info = cached or dict(info, api_version=None, server_version=None)
+            elif self.path and (not cached or cached['api_version'] != info['api_version']):
+                try:
+                    self._write_cache(info)
+                except (IOError, OSError):
+                    pass
+            self._info = info
+        return self._info
+
+    @property
+    def api_version(self):
+        return parse_version(self.info['api_version'])
+
+    def supports(self, feature):
+        """ Returns True if the appliance supports the feature, False if it
+        doesn't, and None if its version is unknown
+        """
+        if self.api_version is None:
+            return None
+        return self.api_version >= self.FEATURES[feature]
+
+
+def makedirs(path, mode=0o777):
+    """ Creates the directory path, unless it already exists
+
+    mode - the mode of the directory created, e.g. 0o700 for the lock
+           directory, which only the user running the modules may use
+    """
+    try:
+        os.makedirs(path, mode)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class ConcurrencyLimiter(object):
+    """ A counting semaphore shared by all the processes on the host, keyed by
+    the appliance url.
+
+    Each of the max_concurrency slots is a lock file in lock_dir. A request
+    holds an exclusive flock on one slot for as long as it is in flight, so
+    slots held by a process that died are released by the kernel.
+
+    url             - the appliance url used as the semaphore key
+    max_concurrency - maximal number of requests in flight to the appliance
+    lock_dir        - the directory holding the slot lock files
+    poll_interval   - seconds to wait between attempts when all slots are taken
+    """
+
+    def __init__(self, url, max_concurrency, lock_dir=DEFAULT_LOCK_DIR, poll_interval=0.05):
+        if not HAS_FCNTL:
+            raise ValueError("miq_max_concurrency requires fcntl, which is not available on this platform")
+        if max_concurrency < 1:
+            raise ValueError("miq_max_concurrency must be a positive number, got {}".format(max_concurrency))
+        self.max_concurrency = max_concurrency
+        self.poll_interval   = poll_interval
+        self.slot_prefix = os.path.join(lock_dir, appliance_key(url))
+        makedirs(lock_dir, 0o700)
+
+    def _try_lock(self, slot):
+        fd = os.open('{prefix}.{slot}.lock'.format(prefix=self.slot_prefix, slot=slot), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                raise
+            return None
+        return fd
+
+    def try_acquire(self):
+        """ Returns a free slot, which should be passed to release(), or None
+        if all the slots are taken
+        """
+        # start at a process dependent slot, so that waiting processes don't
+        # all compete over the first one
+        first = os.getpid() % self.max_concurrency
+        for i in range(self.max_concurrency):
+            fd = self._try_lock((first + i) % self.max_concurrency)
+            if fd is not None:
+                return fd
+        return None
+
+    def acquire(self):
+        """ Blocks until a slot is free.
+
+        Returns:
+            a (slot, waited) tuple, where slot should be passed to release() and
+            waited is the number of seconds spent waiting for it.
+        """
+        start = time.time()
+        while True:
+            fd = self.try_acquire()
+            if fd is not None:
+                return fd, time.time() - start
+            time.sleep(self.poll_interval)
+
+    def release(self, slot):
+        fcntl.flock(slot, fcntl.LOCK_UN)
+        os.close(slot)
+
+
+class RetryPolicy(object):
+    """ Decides which requests are retried on transient appliance errors, and
+    how long to wait before each retry.
+
+    Only requests which are safe to send twice are retried: reads, and POSTs
+    of actions that converge to the same state when repeated.
+
+    retries     - maximal number of retries of a single request
+    backoff     - the delay before the first retry, doubled on every retry
+    max_backoff - the maximal delay between retries
+    """
+
+    RETRY_STATUSES = frozenset([429, 502, 503, 504])
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+    SAFE_ACTIONS = frozenset(['edit', 'assign', 'unassign', 'refresh'])
+
+    def __init__(self, retries=3, backoff=1.0, max_backoff=30.0):
+        self.retries     = retries
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+
+    def allows(self, request):
+        """ Returns True if the request may be retried, False otherwise.
+        """
+        if request.method in RetryPolicy.IDEMPOTENT_METHODS:
+            return True
+        if request.method != 'POST' or not request.body:
+            return False
+        try:
+            body = json.loads(request.body)
+        except ValueError:
+            return False
+        return isinstance(body, dict) and body.get('action') in RetryPolicy.SAFE_ACTIONS
+
+    def delay(self, attempt, response=None):
+        """ Returns the number of seconds to wait before the retry following the
+        attempt (counted from 0). The Retry-After header of the response is
+        honored, otherwise an exponential backoff with full jitter is used.
+        """
+        retry_after = response is not None and response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                date = parsedate_tz(retry_after)
+                if date is not None:
+                    return min(max(mktime_tz(date) - time.time(), 0), self.max_backoff)
+        return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+
+class RefreshQueue(object):
+    """ The providers whose inventory refresh was deferred, to be refreshed
+    later by the manageiq_refresh module, kept in a file shared by all the
+    processes on the host and keyed by the appliance url.
+
+    url      - the appliance url used as the queue key
+    lock_dir - the directory holding the queue file
+    """
+
+    def __init__(self, url, lock_dir=DEFAULT_LOCK_DIR):
+        if not HAS_FCNTL:
+            raise ValueError("deferred refreshes require fcntl, which is not available on this platform")
+        self.path = os.path.join(lock_dir, appliance_key(url) + '.refresh-queue')
+        makedirs(lock_dir, 0o700)
+
+    def _update(self, update):
+        """ Applies update on the list of queued provider ids under an exclusive
+        lock, and returns the list before the update.
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), 'r+') as queue_file:
+                queued = [line.strip() for line in queue_file if line.strip()]
+                new_queued = update(list(queued))
+                if new_queued != queued:
+                    queue_file.seek(0)
+                    queue_file.truncate()
+                    queue_file.write(''.join(provider_id + '\n' for provider_id in new_queued))
+            return queued
+        finally:
+            os.close(fd)
+
+    def add(self, provider_id):
+        """ Queues the provider, unless it's already queued
+        """
+        self._update(lambda queued: queued if str(provider_id) in queued else queued + [str(provider_id)])
+
+    def peek(self):
+        """ Returns the queued provider ids
+        """
+        return self._update(lambda queued: queued)
+
+    def drain(self):
+        """ Returns the queued provider ids, and empties the queue
+        """
+        return self._update(lambda queued: [])
+
+    def remove(self, provider_ids):
+        """ Removes the providers from the queue, once they were refreshed
+        """
+        provider_ids = set(str(provider_id) for provider_id in provider_ids)
+        self._update(lambda queued: [provider_id for provider_id in queued if provider_id not in provider_ids])
+
+
+class RefreshScheduler(object):
+    """ Refreshes the inventory of providers, with at most concurrency refreshes
+    running on the appliance from all the processes on the host.
+
+    A refresh holds a slot of a ConcurrencyLimiter until the task the appliance
+    queued for it finished, so that a bulk change of many providers doesn't
+    queue all their refreshes at once.
+
+    url           - the appliance url used as the limiter key
+    concurrency   - maximal number of refreshes running at once
+    lock_dir      - the directory holding the limiter slot files
+    timeout       - seconds to wait for a refresh task to finish, after which
+                    its slot is released
+    poll_interval - seconds to wait between reads of the refresh tasks
+    """
+
+    def __init__(self, url, concurrency, lock_dir=DEFAULT_LOCK_DIR, timeout=3600, poll_interval=5):
+        if not HAS_FCNTL:
+            raise ValueError("refresh scheduling requires fcntl, which is not available on this platform")
+        if concurrency < 1:
+            raise ValueError("refresh concurrency must be a positive number, got {}".format(concurrency))
+        self.limiter       = ConcurrencyLimiter(url + '#refresh', concurrency, lock_dir, poll_interval)
+        self.timeout       = timeout
+        self.poll_interval = poll_interval
+
+    @staticmethod
+    def start(client, api_url, provider_id):
+        """ Asks the appliance to refresh the provider.
+
+        Returns:
+            the id of the refresh task, None if the appliance didn't return it.
+        """
+        result = client.post('{api_url}/providers/{id}'.format(api_url=api_url, id=provider_id), action='refresh')
+        if result and result.get('task_id'):
+            return str(result['task_id'])
+        if result and result.get('task_href'):
+            return id_from_href(result['task_href'])
+        return None
+
+    @staticmethod
+    def task_state(client, api_url, task_id):
+        """ Returns the (state, status, message) of the refresh task
+        """
+        task = client.get('{api_url}/tasks/{id}?attributes=state,status,message'.format(api_url=api_url, id=task_id))
+        return task.get('state'), task.get('status'), task.get('message')
+
+    def refresh(self, client, api_url, provider_id):
+        """ Refreshes the provider once a slot is free, and waits for the refresh
+        to finish.
+
+        Returns:
+            the refresh result, see refresh_all.
+        """
+        return self.refresh_all(client, api_url, [provider_id])[0]
+
+    def refresh_all(self, client, api_url, provider_ids):
+        """ Refreshes the providers, starting each refresh once a slot is free
+        and releasing the slot once the refresh finished.
+
+        Returns:
+            a list of the refresh results of the providers, dictionaries with
+            their provider_id, task_id, state, status and message. The state
+            is Finished, Timed out, or Failed if the refresh couldn't be started.
+        """
+        pending = [str(provider_id) for provider_id in provider_ids]
+        running = {}
+        results = {}
+        while pending or running:
+            while pending:
+                slot = self.limiter.try_acquire()
+                if slot is None:
+                    break
+                provider_id = pending.pop(0)
+                try:
+                    task_id = self.start(client, api_url, provider_id)
+                except Exception as e:
+                    self.limiter.release(slot)
+                    results[provider_id] = dict(provider_id=provider_id, task_id=None, state='Failed',
+                                                status='Error', message=str(e))
+                    continue
+                running[provider_id] = (slot, task_id, time.time())
+
+            for provider_id, (slot, task_id, started) in list(running.items()):
+                if task_id is None:
+                    # no task to wait for, the refresh is only known to be queued
+                    state, status, message = 'Queued', None, None
+                else:
+                    try:
+                        state, status, message = self.task_state(client, api_url, task_id)
+                    except Exception as e:
+                        state, status, message = None, None, str(e)
+                    if state != 'Finished' and time.time() - started >= self.timeout:
+                        state = 'Timed out'
+                    elif state != 'Finished':
+                        continue
+                self.limiter.release(slot)
+                del running[provider_id]
+                results[provider_id] = dict(provider_id=provider_id, task_id=task_id, state=state,
+                                            status=status, message=message)
+
+            if pending or running:
+                time.sleep(self.poll_interval)
+        return [results[str(provider_id)] for provider_id in provider_ids]
+
+
+def ManageIQClient(entry_point, auth, worker=False, **kwargs):
+    """ Returns a manageiq_transport.ManageIQClient created with the arguments
+    passed, importing the client and requests on first use.
+
+    With worker set, returns a manageiq_worker.WorkerClient sending the
+    requests through the local worker instead, if it is running and no
+    cassette is recorded or replayed. A worker which isn't running, whose
+    socket belongs to another user or which closes the connection is
+    skipped, only the errors of the appliance are raised.
+
+    With metrics_dir set, the metrics of the module run are written to that
+    directory when it exits, see Metrics.
+    """
+    metrics_dir = kwargs.pop('metrics_dir', None)
+    if metrics_dir:
+        METRICS.start(metrics_dir)
+    if worker and not (kwargs.get('record_cassette') or kwargs.get('replay_cassette')):
+        from ansible.module_utils.manageiq_worker import (WorkerClient, WorkerError, WorkerRequestError,
+                                                          worker_socket_path)
+        try:
+            return WorkerClient(worker_socket_path(kwargs.get('lock_dir')), entry_point, auth, **kwargs)
+        except WorkerRequestError:
+            raise
+        except WorkerError:
+            pass
+    from ansible.module_utils.manageiq_transport import ManageIQClient as Client
+    return Client(entry_point, auth, **kwargs)
+
+
+class Span(object):
+    """ A timed operation of a module run, recorded by the Tracer once it ends.
+    Attributes set in args while the span is open are recorded along with it.
+    """
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer   = tracer
+        self.name     = name
+        self.category = category
+        self.args     = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and not issubclass(exc_type, SystemExit):
+            self.args['error'] = repr(exc_value)
+        self.tracer.record(self, time.time() - self.start)
+        return False
+
+
+class NoSpan(object):
+    """ The span returned while tracing is disabled, which records nothing
+    """
+
+    args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer(object):
+    """ Records the spans of a module run, the logical operations of the
+    modules and the API requests they send, and writes them as a Chrome
+    trace-event file, which chrome://tracing, Perfetto or speedscope show as
+    a timeline.
+
+    Tracing is disabled until start is called, spans cost a function call
+    until then.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events  = []
+        self.lock    = threading.Lock()
+
+    def start(self):
+        self.enabled = True
+        self.events  = []
+
+    def span(self, name, category='module', **args):
+        """ Returns a context manager timing the operation it wraps
+        """
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, category, args)
+
+    def record(self, span, duration):
+        event = dict(name=span.name, cat=span.category, ph='X', pid=os.getpid(),
+                     tid=threading.current_thread().ident,
+                     ts=int(span.start * 1000000), dur=int(duration * 1000000), args=span.args)
+        with self.lock:
+            self.events.append(event)
+
+    def write(self, path):
+        """ Writes the spans recorded as a Chrome trace-event file, and stops
+        tracing.
+        """
+        self.enabled = False
+        makedirs(os.path.dirname(path))
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event['ts'])
+        with open(path, 'w') as trace_file:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), trace_file, default=repr)
+
+
+# the tracer of the module run, see profiled
+TRACER = Tracer()
+
+
+def traced(method):
+    """ Decorates a module method to record a span of each call, named after
+    the method
+    """
+    def traced_method(*args, **kwargs):
+        with TRACER.span(method.__name__):
+            return method(*args, **kwargs)
+    traced_method.__name__ = method.__name__
+    traced_method.__doc__ = method.__doc__
+    return traced_method
+
+
+# the metrics written by the modules, with their type, help and buckets
+METRIC_DEFINITIONS = {
+    'manageiq_api_request_duration_seconds': (
+        'histogram', "Duration of the API requests sent to the appliance, by endpoint",
+        (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    'manageiq_module_runs_total': (
+        'counter', "Module runs, by module and result", None),
+    'manageiq_module_duration_seconds': (
+        'histogram', "Duration of the module runs",
+        (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)),
+    'manageiq_module_requests': (
+        'histogram', "API requests sent by each module run",
+        (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)),
+    'manageiq_provider_validation_wait_seconds': (
+        'histogram', "Time waited for the validation of the provider authentications",
+        (1, 5, 10, 30, 60, 120, 300, 600)),
+    'manageiq_bulk_batch_size': (
+        'histogram', "Resources sent or looked up in each bulk request",
+        (1, 5, 10, 25, 50, 100, 250, 500, 1000)),
+}
+
+METRICS_FILE = 'manageiq_ansible'
+
+ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def metrics_endpoint(path):
+    """ Returns the API endpoint of a request path, with the resource ids
+    replaced so that all the requests of an endpoint share their metrics, e.g.
+    /api/providers/:id/authentications of /api/providers/12/authentications
+    """
+    return ID_SEGMENT.sub('/:id', path.rstrip('/')) or '/'
+
+
+def metric_line(name, labels, value):
+    """ Returns the line of a sample in the text exposition format
+    """
+    if not labels:
+        return '{name} {value}'.format(name=name, value=value)
+    return '{name}{{{labels}}} {value}'.format(name=name, value=value, labels=','.join(
+        '{label}="{value}"'.format(
+            label=label, value=str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for label, label_value in labels))
+
+
+class Metrics(object):
+    """ Collects the metrics of a module run, see METRIC_DEFINITIONS, and adds
+    them to a Prometheus textfile in a node-exporter textfile collector
+    directory once the run ends.
+
+    The samples of all the runs on the host are kept in a state file next to
+    the textfile, which every run updates under an exclusive flock before
+    writing the textfile anew, with a rename so that node-exporter never reads
+    a partial file.
+
+    Metrics are disabled until start is called, observing a sample costs a
+    function call until then.
+    """
+
+    def __init__(self):
+        self.enabled   = False
+        self.directory = None
+        self.samples   = {}
+        self.requests  = 0
+        self.lock      = threading.Lock()
+
+    def start(self, directory):
+        if not HAS_FCNTL:
+            raise ValueError("miq_metrics_dir requires fcntl, which is not available on this platform")
+        if not self.enabled:
+            self.samples  = {}
+            self.requests = 0
+        self.enabled   = True
+        self.directory = directory
+
+    def _sample(self, name, labels):
+        buckets = METRIC_DEFINITIONS[name][2]
+        key = json.dumps(sorted(labels.items()))
+        samples = self.samples.setdefault(name, {})
+        if key not in samples:
+            samples[key] = {'buckets': [0] * len(buckets), 'sum': 0, 'count': 0} if buckets else {'value': 0}
+        return samples[key]
+
+    def observe(self, name, value, **labels):
+        """ Adds value to the histogram name, with the labels passed
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            sample = self._sample(name, labels)
+            for index, bound in enumerate(METRIC_DEFINITIONS[name][2]):
+                if value <= bound:
+                    sample['buckets'][index] += 1
+                    break
+            sample['sum'] += value
+            sample['count'] += 1
+
+    def inc(self, name, value=1, **labels):
+        """ Adds value to the counter name, with the labels passed
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self._sample(name, labels)['value'] += value
+
+    def count_requests(self, count=1):
+        """ Counts API requests sent by the module run
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.requests += count
+
+    def write(self, module, result, duration):
+        """ Records the module run, adds the samples of the run to the
+        textfile, and stops collecting metrics.
+
+        module   - the module name
+        result   - the outcome of the run, changed, ok or failed
+        duration - the duration of the run, in seconds
+        """
+        self.inc('manageiq_module_runs_total', module=module, result=result)
+        self.observe('manageiq_module_duration_seconds', duration, module=module)
+        self.observe('manageiq_module_requests', self.requests, module=module)
+        self.enabled = False
+        makedirs(self.directory)
+        path = os.path.join(self.directory, METRICS_FILE)
+        fd = os.open(path + '.state.json', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), 'r+') as state_file:
+                try:
+                    state = json.loads(state_file.read() or '{}')
+                except ValueError:
+                    state = {}
+                with self.lock:
+                    for name, samples in self.samples.items():
+                        for key, sample in samples.items():
+                            merge_sample(state.setdefault(name, {}), key, sample)
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+            # node-exporter only reads the *.prom files, so it never sees the
+            # temporary file
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.' + METRICS_FILE)
+            with os.fdopen(tmp_fd, 'w') as metrics_file:
+                metrics_file.write(render_metrics(state))
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path + '.prom')
+        finally:
+            os.close(fd)
+
+
+def merge_sample(samples, key, sample):
+    """ Adds sample to the sample of the same labels key in samples
+    """
+    if key not in samples:
+        samples[key] = sample
+    elif 'value' in sample:
+        samples[key]['value'] += sample['value']
+    else:
+        total = samples[key]
+        total['buckets'] = [count + added for count, added in zip(total['buckets'], sample['buckets'])]
+        total['sum'] += sample['sum']
+        total['count'] += sample['count']
+
+
+def render_metrics(state):
+    """ Returns the samples of state in the Prometheus text exposition format
+    """
+    lines = []
+    for name in sorted(state):
+        if name not in METRIC_DEFINITIONS:
+            continue
+        kind, help_text, buckets = METRIC_DEFINITIONS[name]
+        lines.append('# HELP {name} {help}'.format(name=name, help=help_text))
+        lines.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+        for key in sorted(state[name]):
+            labels = [tuple(label) for label in json.loads(key)]
+            sample = state[name][key]
+            if not buckets:
+                lines.append(metric_line(name, labels, sample['value']))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, sample['buckets']):
+                cumulative += count
+                lines.append(metric_line(name + '_bucket', labels + [('le', bound)], cumulative))
+            lines.append(metric_line(name + '_bucket', labels + [('le', '+Inf')], sample['count']))
+            lines.append(metric_line(name + '_sum', labels, sample['sum']))
+            lines.append(metric_line(name + '_count', labels, sample['count']))
+    return ''.join(line + '\n' for line in lines)
+
+
+# the metrics of the module run, see profiled
+METRICS = Metrics()
+
+
+def profiled(name, main):
+    """ Returns main wrapped to profile, trace and measure the module run.
+
+    When the MIQ_PROFILE env var is set, to cpu, memory or cpu,memory, the
+    profiles are written to the MIQ_PROFILE_DIR directory, profiles in the
+    lock directory by default, and a line summarizing them is added to the
+    module result as profile.
+
+    When the MIQ_TRACE_DIR env var is set, the spans of the run are written
+    there as a Chrome trace-event file, see Tracer, whose path is added to the
+    module result as trace.
+
+    When the module creates a client with miq_metrics_dir set, the metrics of
+    the run are written there once it ends, see Metrics.
+
+    name - the module name the profile and trace files are named after
+    main - the module main function
+    """
+    def run():
+        modes = [mode.strip() for mode in os.environ.get('MIQ_PROFILE', '').split(',') if mode.strip()]
+        trace_dir = os.environ.get('MIQ_TRACE_DIR')
+        from ansible.module_utils.basic import AnsibleModule
+        trace_path = None
+        if trace_dir:
+            trace_path = os.path.join(trace_dir, '{name}-{time}-{pid}.trace.json'.format(
+                name=name, time=time.strftime('%Y%m%d%H%M%S'), pid=os.getpid()))
+            TRACER.start()
+        profiler = None
+        if modes:
+            from ansible.module_utils.manageiq_profile import ModuleProfiler
+            directory = os.environ.get('MIQ_PROFILE_DIR') or os.path.join(
+                os.environ.get('MIQ_LOCK_DIR') or DEFAULT_LOCK_DIR, 'profiles')
+            profiler = ModuleProfiler(name, modes, directory)
+        main_span = TRACER.span(name, 'main')
+        started = time.time()
+
+        def finish(result):
+            """ Ends the run span, the profiles and the metrics, on the first
+            call
+            """
+            results = {}
+            if TRACER.enabled:
+                main_span.__exit__(None, None, None)
+                TRACER.write(trace_path)
+                results['trace'] = trace_path
+            if profiler:
+                results['profile'] = profiler.stop()
+            if METRICS.enabled:
+                METRICS.write(name, result, time.time() - started)
+            return results
+
+        # the module exits from exit_json or fail_json, the run ends there
+        exit_json, fail_json = AnsibleModule.exit_json, AnsibleModule.fail_json
+
+        def with_results(method, failed):
+            def exit(self, **kwargs):
+                kwargs.update(finish('failed' if failed else 'changed' if kwargs.get('changed') else 'ok'))
+                return method(self, **kwargs)
+            return exit
+        AnsibleModule.exit_json = with_results(exit_json, False)
+        AnsibleModule.fail_json = with_results(fail_json, True)
+        if profiler:
+            profiler.start()
+        main_span.__enter__()
+        try:
+            return main()
+        finally:
+            AnsibleModule.exit_json, AnsibleModule.fail_json = exit_json, fail_json
+            finish('failed')
+    return run
@@ -0,0 +1,349 @@
+""" An optional local worker process the manageiq_* modules send their API
+requests through, instead of creating a client of their own.
+
+The worker listens on a Unix socket in the user's runtime directory, or in the
+lock directory, and keeps warm, authenticated clients to each appliance
+between module runs, along with the collections the modules look names up in,
+so a module run pays for a few local round trips instead of the client import,
+the TLS handshake and the entry point GET. Requests are newline delimited JSON messages, answered in
+order on the same connection.
+
+The worker exits once no module talked to it for its idle timeout. Modules
+only use it when miq_worker is set, and fall back to a direct client when it
+isn't running. As the modules send the appliance credentials to the worker,
+they refuse to talk to a socket, or a socket directory, of another user.
+"""
+
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from ansible.module_utils.six.moves import socketserver
+from ansible.module_utils.manageiq_utils import (DEFAULT_LOCK_DIR, METRICS, TRACER, fingerprint, makedirs,
+                                                 new_client_stats, query_collection)
+
+
+DEFAULT_IDLE_TIMEOUT = 600
+DEFAULT_CACHE_TTL = 30
+
+
+class WorkerError(Exception):
+    """ Raised when the worker fails a request, with the error of the client
+    """
+
+
+class WorkerUnavailable(WorkerError):
+    """ Raised when the worker isn't running
+    """
+
+
+class WorkerRequestError(WorkerError):
+    """ Raised when the client of the worker fails a request, e.g. on wrong
+    credentials, with the error of the client
+    """
+
+
+def worker_socket_path(lock_dir=None):
+    """ Returns the path of the worker socket in the lock directory, or, with
+    the default lock directory, in the user's runtime directory
+    ($XDG_RUNTIME_DIR) if there is one, which other users can't write to
+    """
+    if (not lock_dir or lock_dir == DEFAULT_LOCK_DIR) and os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'manageiq-ansible', 'worker.sock')
+    return os.path.join(lock_dir or DEFAULT_LOCK_DIR, 'worker.sock')
+
+
+def check_socket_owner(socket_path):
+    """ Raises a WorkerError unless the socket and its directory belong to the
+    user, and other users can't write to the directory, so that the
+    credentials are never sent to a socket another user bound. Raises a
+    WorkerUnavailable if there's no socket.
+    """
+    try:
+        directory = os.lstat(os.path.dirname(socket_path))
+        socket_stat = os.lstat(socket_path)
+    except OSError as e:
+        raise WorkerUnavailable("ManageIQ worker is not running on {path}: {error}".format(path=socket_path, error=e))
+    if directory.st_uid != os.getuid() or directory.st_mode & 0o022:
+        raise WorkerError("ManageIQ worker socket directory {path} should belong to the user and not be writable by others".format(
+            path=os.path.dirname(socket_path)))
+    if socket_stat.st_uid != os.getuid():
+        raise WorkerError("ManageIQ worker socket {path} doesn't belong to the user".format(path=socket_path))
+
+
+def peer_uid(sock):
+    """ Returns the user id of the process on the other end of the Unix socket,
+    None where the platform doesn't tell
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', credentials)[1]
+
+
+class Resource(object):
+    """ A resource of a collection read through the worker, whose attributes
+    are accessed like the ones of the ManageIQ client entities.
+    """
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+
+class WorkerCollections(object):
+    """ The collections of the appliance, read through the worker
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return [Resource(resource) for resource in self._client.call('collection', name=name)]
+
+
+class WorkerClient(object):
+    """ A client sending the API requests through the worker, which can be used
+    by the modules in place of a ManageIQClient.
+
+    socket_path - the path of the worker socket
+    entry_point - the manageiq api url
+    auth        - the authentication tuple or dictionary
+    options     - the ManageIQClient keyword arguments the worker creates its
+                  client with
+    """
+
+    def __init__(self, socket_path, entry_point, auth, **options):
+        self.stats = new_client_stats()
+        self.collections = WorkerCollections(self)
+        self._session = dict(entry_point=entry_point, auth=list(auth) if isinstance(auth, tuple) else auth,
+                             options=options)
+        check_socket_owner(socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(socket_path)
+        except socket.error as e:
+            self._socket.close()
+            raise WorkerUnavailable("ManageIQ worker is not running on {path}: {error}".format(path=socket_path, error=e))
+        # the socket may have been replaced since it was checked
+        if peer_uid(self._socket) not in (None, os.getuid()):
+            self._socket.close()
+            raise WorkerError("ManageIQ worker on {path} doesn't run as the user".format(path=socket_path))
+        self._file = self._socket.makefile('rwb')
+        # the requests of threads sharing the client take turns on the socket
+        self._lock = threading.Lock()
+        # fail early on a wrong url or credentials, like the client does
+        try:
+            entry_point_info = self.call('open') or {}
+        except Exception:
+            self.close()
+            raise
+        self.version = entry_point_info.get('version')
+        self.server_info = entry_point_info.get('server_info')
+
+    def call(self, op, **arguments):
+        """ Sends a request to the worker, and returns its result
+        """
+        message = dict(arguments, op=op, session=self._session)
+        with self._lock, TRACER.span('worker {op}'.format(op=op), 'worker', url=arguments.get('url'), collection=arguments.get('name')):
+            try:
+                self._file.write(json.dumps(message).encode('utf-8') + b'\n')
+                self._file.flush()
+                line = self._file.readline()
+            except (IOError, socket.error) as e:
+                raise WorkerError("ManageIQ worker closed the connection: {error}".format(error=e))
+        if not line:
+            raise WorkerError("ManageIQ worker closed the connection")
+        response = json.loads(line.decode('utf-8'))
+        for key, value in response.get('stats', {}).items():
+            self.stats[key] = self.stats.get(key, 0) + value
+        METRICS.count_requests(response.get('stats', {}).get('requests', 0))
+        if 'error' in response:
+            raise WorkerRequestError(response['error'])
+        return response.get('result')
+
+    def get(self, url, **params):
+        return self.call('get', url=url, params=params)
+
+    def post(self, url, **payload):
+        return self.call('post', url=url, payload=payload)
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    """ Answers the requests of a single module connection, with a client taken
+    from the pool of the session for the lifetime of the connection.
+    """
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.clients = {}
+
+    def finish(self):
+        for key, client in self.clients.items():
+            self.server.release_client(key, client)
+        self.server.touch(-1)
+        socketserver.StreamRequestHandler.finish(self)
+
+    def client(self, session):
+        key = fingerprint(session)
+        if key not in self.clients:
+            self.clients[key] = self.server.acquire_client(key, session)
+        return key, self.clients[key]
+
+    def answer(self, message):
+        session = message['session']
+        key, client = self.client(session)
+        stats = dict(client.stats)
+        try:
+            if message['op'] == 'open':
+                # the entry point details the client loaded, see Capabilities
+                result = dict(version=getattr(client, 'version', None),
+                              server_info=getattr(client, 'server_info', None))
+            elif message['op'] == 'get':
+                result = client.get(message['url'], **message.get('params', {}))
+            elif message['op'] == 'post':
+                try:
+                    result = client.post(message['url'], **message.get('payload', {}))
+                finally:
+                    # dropped once the write is done, even if it failed half way
+                    self.server.invalidate(key)
+            elif message['op'] == 'collection':
+                result = self.server.collection(key, client, session['entry_point'], message['name'])
+            else:
+                raise ValueError("Unknown operation {!r}".format(message['op']))
+            response = dict(result=result)
+        except Exception as e:
+            response = dict(error=str(e))
+        response['stats'] = dict((name, client.stats[name] - stats.get(name, 0)) for name in client.stats)
+        return response
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            try:
+                response = self.answer(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                # e.g. the client of the session couldn't be created
+                response = dict(error=str(e))
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ The worker, answering each module connection in a thread of its own.
+
+    socket_path  - the path of the Unix socket the worker listens on
+    client_class - creates the clients, called with the entry point, the
+                   authentication and the client options of a session
+    idle_timeout - seconds without any module connection after which
+                   serve_until_idle returns
+    cache_ttl    - seconds the collections read by the modules are kept, a
+                   post through the worker drops the appliance collections
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, client_class, idle_timeout=DEFAULT_IDLE_TIMEOUT, cache_ttl=DEFAULT_CACHE_TTL):
+        self.client_class  = client_class
+        self.idle_timeout  = idle_timeout
+        self.cache_ttl     = cache_ttl
+        self.lock          = threading.Lock()
+        self.idle_clients  = {}
+        self.collections   = {}
+        self.generations   = {}
+        self.connections   = 0
+        self.last_activity = time.time()
+        makedirs(os.path.dirname(socket_path), 0o700)
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                # left behind by a worker which didn't exit cleanly
+                os.remove(socket_path)
+            else:
+                raise WorkerError("ManageIQ worker is already running on {path}".format(path=socket_path))
+            finally:
+                probe.close()
+        # only the user running the modules may talk to the worker, which holds
+        # their credentials
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, WorkerHandler)
+        finally:
+            os.umask(umask)
+
+    def touch(self, connections):
+        with self.lock:
+            self.connections += connections
+            self.last_activity = time.time()
+
+    def process_request(self, request, client_address):
+        # counted before the handler thread starts, so that the worker doesn't
+        # exit while the connection waits for it
+        self.touch(1)
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def acquire_client(self, key, session):
+        """ Returns an idle client of the session, creating one if there's none
+        """
+        with self.lock:
+            idle = self.idle_clients.get(key)
+            if idle:
+                return idle.pop()
+        auth = session['auth']
+        return self.client_class(session['entry_point'], tuple(auth) if isinstance(auth, list) else auth,
+                                 **session['options'])
+
+    def release_client(self, key, client):
+        with self.lock:
+            self.idle_clients.setdefault(key, []).append(client)
+
+    def collection(self, key, client, api_url, name):
+        """ Returns the resources of the collection, read at most once in
+        cache_ttl seconds.
+        """
+        with self.lock:
+            cached = self.collections.get((key, name))
+            generation = self.generations.get(key, 0)
+        if cached and time.time() - cached[0] < self.cache_ttl:
+            return cached[1]
+        resources = list(query_collection(client, api_url, name, 'expand=resources', 1000))
+        with self.lock:
+            # not cached if a post went through while it was read, as it may
+            # have been read before the change
+            if self.generations.get(key, 0) == generation:
+                self.collections[(key, name)] = (time.time(), resources)
+        return resources
+
+    def invalidate(self, key):
+        """ Drops the cached collections of the session
+        """
+        with self.lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+            for cache_key in [k for k in self.collections if k[0] == key]:
+                del self.collections[cache_key]
+
+    def idle(self):
+        with self.lock:
+            return not self.connections and time.time() - self.last_activity >= self.idle_timeout
+
+    def serve_until_idle(self, poll_interval=1):
+        """ Answers module connections until the worker is idle, then closes
+        and removes the socket.
+        """
+        self.timeout = poll_interval
+        try:
+            while not self.idle():
+                self.handle_request()
+        finally:
+            self.server_close()
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address)
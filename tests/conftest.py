@@ -0,0 +1,9 @@
+import os
+
+import ansible.module_utils
+
+
+# Ansible loads the modules' shared code from the module_utils directory (see
+# ansible.cfg), make it importable the same way when running the tests.
+ansible.module_utils.__path__.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils'))
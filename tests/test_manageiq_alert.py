@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+import gzip
+import json
+
 import pytest
 from mock import Mock
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.manageiq_utils import FingerprintStore, Snapshot
 
 from manageiq_client.api import ManageIQClient
 import manageiq_alert
@@ -64,7 +68,7 @@ GET_RETURN_VALUES = {
 
 POST_RETURN_VALUES = {
     "created_alert": {
-        "results": {
+        "results": [{
             "id": ALERT_ID,
             "guid": "4ebca44e-190a-11e7-be91-68f728d88921",
             "description": DESCRIPTION,
@@ -86,7 +90,7 @@ POST_RETURN_VALUES = {
                 "context_type": None
             },
             "enabled": True
-        }
+        }]
     },
     'updated_alert': {
         "id": ALERT_ID,
@@ -128,6 +132,8 @@ def miq_api_class(monkeypatch):
 @pytest.fixture
 def miq_ansible_module():
     miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
     yield miq_ansible_module
 
 
@@ -154,8 +160,10 @@ def test_create_alert_if_not_exist(miq, miq_api_class):
 
     result = miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, OPTIONS, ENABLED)
     assert result == {
+        'alert_id': ALERT_ID,
+        'href': '{hostname}/api/alert_definitions/{id}'.format(hostname=MANAGEIQ_HOSTNAME, id=ALERT_ID),
         'changed': True,
-        'msg': "Successfully created alert {description}: {alert_details}".format(description=DESCRIPTION, alert_details=POST_RETURN_VALUES['created_alert']['results'])
+        'msg': "Successfully created alert {description}".format(description=DESCRIPTION)
     }
     miq.client.post.assert_called_once_with(
         '{hostname}/api/alert_definitions/'.format(hostname=MANAGEIQ_HOSTNAME),
@@ -173,11 +181,41 @@ def test_update_alert_options(miq, miq_api_class):
 
     result = miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, UPDATED_OPTIONS, ENABLED)
     assert result == {
+        'alert_id': ALERT_ID,
+        'href': '{hostname}/api/alert_definitions/{id}'.format(hostname=MANAGEIQ_HOSTNAME, id=ALERT_ID),
         'changed': True,
-        'msg': "Successfully updated alert {description}: {alert_details}".format(description=DESCRIPTION, alert_details=POST_RETURN_VALUES['updated_alert'])
+        'msg': "Successfully updated alert {description}".format(description=DESCRIPTION),
+        'changed_fields': ['options']
     }
 
 
+@pytest.mark.parametrize('result_detail, details', [
+    ('normal', {'updates': {'options': UPDATED_OPTIONS}}),
+    ('full', {'updates': {'options': UPDATED_OPTIONS}, 'result': POST_RETURN_VALUES['updated_alert']}),
+])
+def test_update_alert_result_detail(miq, miq_api_class, result_detail, details):
+    miq.result_detail = result_detail
+    miq_api_class.return_value.get.side_effect = [
+        GET_RETURN_VALUES['alert_definitions_exist'],
+        GET_RETURN_VALUES['alert_definitions_exist']['resources'][0]
+    ]
+    miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['updated_alert']
+
+    result = miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, UPDATED_OPTIONS, ENABLED)
+    assert dict((key, result[key]) for key in details) == details
+    assert result['msg'] == "Successfully updated alert {description}".format(description=DESCRIPTION)
+
+
+def test_update_alert_expression_type_reported_by_appliance(miq, miq_api_class):
+    miq.client.version = '3.0.0'
+    hash_alert = dict(GET_RETURN_VALUES['alert_definitions_exist']['resources'][0],
+                      expression=EXPRESSION, expression_type='hash')
+    miq_api_class.return_value.get.return_value = hash_alert
+
+    updates = miq.alert_update_required(ALERT_ID, DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, 'ContainerNode', OPTIONS, ENABLED)
+    assert updates == {'expression_type': ('hash', EXPRESSION_TYPE)}
+
+
 def test_delete_existing_alert(miq, miq_api_class):
     miq_api_class.return_value.get.return_value = GET_RETURN_VALUES['alert_definitions_exist']
     miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['deleted_alert']
@@ -213,3 +251,133 @@ def test_create_alert_with_same_attributes(miq, miq_api_class):
         'changed': False,
         'msg': 'Alert {description} already exist, no need for updates'.format(description=DESCRIPTION)
     }
+
+
+def test_update_alert_in_check_mode(miq, miq_api_class, miq_ansible_module):
+    miq_ansible_module.check_mode = True
+    miq_ansible_module._diff = True
+    miq_api_class.return_value.get.side_effect = [
+        GET_RETURN_VALUES['alert_definitions_exist'],
+        GET_RETURN_VALUES['alert_definitions_exist']['resources'][0]
+    ]
+
+    result = miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, UPDATED_OPTIONS, ENABLED)
+    assert result == {
+        'changed': True,
+        'msg': 'Alert {description} would be updated'.format(description=DESCRIPTION),
+        'diff': {'before': {'options': OPTIONS}, 'after': {'options': UPDATED_OPTIONS}}
+    }
+    assert not miq.client.post.called
+
+
+def test_create_alert_in_check_mode(miq, miq_api_class, miq_ansible_module):
+    miq_ansible_module.check_mode = True
+    miq_api_class.return_value.get.return_value = GET_RETURN_VALUES['alert_definitions_not_exist']
+
+    result = miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, OPTIONS, ENABLED)
+    assert result == {
+        'changed': True,
+        'msg': 'Alert {description} would be created'.format(description=DESCRIPTION)
+    }
+    assert not miq.client.post.called
+
+
+def test_update_alert_from_snapshot(miq_api_class, miq_ansible_module, tmpdir):
+    path = str(tmpdir.join('snapshot.jsonl.gz'))
+    with gzip.open(path, 'wb') as snapshot_file:
+        for record in [{'snapshot': {'collections': ['alert_definitions']}},
+                       {'collection': 'alert_definitions', 'resource': GET_RETURN_VALUES['alert_definitions_exist']['resources'][0]}]:
+            snapshot_file.write((json.dumps(record) + '\n').encode('utf-8'))
+    miq_ansible_module.check_mode = True
+    miq = manageiq_alert.ManageIQAlert(
+        miq_ansible_module, MANAGEIQ_HOSTNAME, "The username", "The password",
+        False, None, snapshot=Snapshot(path))
+
+    result = miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, UPDATED_OPTIONS, ENABLED)
+    assert result == {
+        'changed': True,
+        'msg': 'Alert {description} would be updated'.format(description=DESCRIPTION)
+    }
+    assert not miq.client.get.called
+    assert not miq.client.post.called
+
+
+def test_matching_fingerprint_skips_alert_comparison(miq_api_class, miq_ansible_module, tmpdir):
+    miq = manageiq_alert.ManageIQAlert(
+        miq_ansible_module, MANAGEIQ_HOSTNAME, "The username", "The password",
+        False, None, fingerprints=FingerprintStore(MANAGEIQ_HOSTNAME, str(tmpdir), full_check_every=3))
+    miq_api_class.return_value.get.side_effect = [
+        GET_RETURN_VALUES['alert_definitions_exist'],
+        GET_RETURN_VALUES['alert_definitions_exist']['resources'][0]
+    ]
+    result = miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, OPTIONS, ENABLED)
+    assert result['changed'] is False
+
+    # the following runs only verify the alert still exists
+    for i in range(2):
+        miq_api_class.return_value.get.reset_mock()
+        miq_api_class.return_value.get.side_effect = None
+        miq_api_class.return_value.get.return_value = {'id': ALERT_ID}
+        result = miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, OPTIONS, ENABLED)
+        assert result['changed'] is False
+        miq.client.get.assert_called_once_with(
+            '{hostname}/api/alert_definitions/{id}?attributes=id'.format(hostname=MANAGEIQ_HOSTNAME, id=ALERT_ID))
+
+    # a full check is forced every 3 runs
+    miq_api_class.return_value.get.reset_mock()
+    miq_api_class.return_value.get.side_effect = [
+        GET_RETURN_VALUES['alert_definitions_exist'],
+        GET_RETURN_VALUES['alert_definitions_exist']['resources'][0]
+    ]
+    miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, OPTIONS, ENABLED)
+    assert miq.client.get.call_count == 2
+
+
+def test_changed_fingerprint_does_full_alert_comparison(miq_api_class, miq_ansible_module, tmpdir):
+    fingerprints = FingerprintStore(MANAGEIQ_HOSTNAME, str(tmpdir))
+    miq = manageiq_alert.ManageIQAlert(
+        miq_ansible_module, MANAGEIQ_HOSTNAME, "The username", "The password",
+        False, None, fingerprints=fingerprints)
+    fingerprints.record('alert', DESCRIPTION, "an older fingerprint", ALERT_ID)
+    miq_api_class.return_value.get.side_effect = [
+        GET_RETURN_VALUES['alert_definitions_exist'],
+        GET_RETURN_VALUES['alert_definitions_exist']['resources'][0]
+    ]
+    miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['updated_alert']
+
+    result = miq.create_or_update_alert(DESCRIPTION, EXPRESSION, EXPRESSION_TYPE, MIQ_ENTITY, UPDATED_OPTIONS, ENABLED)
+    assert result['changed'] is True
+    assert miq.client.post.called
+
+
+def test_delete_alert_by_id_skips_lookup(miq, miq_api_class):
+    miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['deleted_alert']
+
+    result = miq.delete_alert(DESCRIPTION, ALERT_ID)
+    assert result['changed']
+    miq.client.get.assert_called_once_with(
+        '{hostname}/api/alert_definitions/{id}?attributes=id'.format(hostname=MANAGEIQ_HOSTNAME, id=ALERT_ID))
+    miq.client.post.assert_called_once_with(
+        '{hostname}/api/alert_definitions/{id}'.format(hostname=MANAGEIQ_HOSTNAME, id=ALERT_ID),
+        action='delete')
+
+
+def test_delete_alert_by_id_fails_on_query_error(miq, miq_api_class):
+    miq_api_class.return_value.get.side_effect = Exception("The request failed with HTTP status 503: Service Unavailable")
+
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.delete_alert(DESCRIPTION, ALERT_ID)
+    assert str(excinfo.value) == ("Failed to query alert {id}: The request failed with HTTP status 503: "
+                                  "Service Unavailable".format(id=ALERT_ID))
+    assert not miq.client.post.called
+
+
+def test_delete_alert_by_id_not_exist(miq, miq_api_class):
+    miq_api_class.return_value.get.side_effect = Exception("ActiveRecord::RecordNotFound: Couldn't find the resource")
+
+    result = miq.delete_alert(DESCRIPTION, ALERT_ID)
+    assert result == {
+        'changed': False,
+        'msg': 'Alert {description} does not exist in manageiq'.format(description=DESCRIPTION)
+    }
+    assert not miq.client.post.called
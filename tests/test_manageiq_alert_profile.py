@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import pytest
+from mock import Mock
+
+from ansible.module_utils.basic import AnsibleModule
+
+from manageiq_client.api import ManageIQClient
+import manageiq_alert_profile
+
+
+MANAGEIQ_HOSTNAME = "http://miq.example.com"
+API_URL = MANAGEIQ_HOSTNAME + "/api"
+PROFILE_NAME = "OpenShift Node Alerts"
+PROFILE_ID = "5"
+ALERTS = [{'id': str(i), 'description': 'Alert {}'.format(i), 'href': API_URL + '/alert_definitions/{}'.format(i)}
+          for i in range(5)]
+PROFILE = {'id': PROFILE_ID, 'description': PROFILE_NAME, 'mode': 'ContainerNode',
+           'set_data': {'notes': 'managed'}, 'alert_definitions': ALERTS[:2]}
+
+
+@pytest.fixture(autouse=True)
+def miq_api_class(monkeypatch):
+    miq_api_class = Mock(spec=ManageIQClient)
+    monkeypatch.setattr("manageiq_alert_profile.MiqApi", miq_api_class)
+    yield miq_api_class
+
+
+@pytest.fixture
+def miq_ansible_module():
+    miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
+    yield miq_ansible_module
+
+
+class AnsibleModuleFailed(Exception):
+    pass
+
+
+@pytest.fixture
+def appliance(miq_api_class):
+    """ Answers the queries of the alert profiles and of the alert definitions,
+    and every POST with a successful result per resource
+    """
+    appliance = dict(profiles=[PROFILE])
+
+    def get(url):
+        if '/api/alert_definition_profiles?' in url:
+            return {'resources': appliance['profiles']}
+        return {'subcount': len(ALERTS), 'resources': ALERTS}
+
+    def post(url, action, resource=None, resources=None):
+        if action == 'create':
+            return {'results': [dict(resource, id='6')]}
+        if action == 'delete':
+            return {'success': True, 'message': 'alert_definition_profiles id: 5 deleting'}
+        return {'results': [{'success': True} for _ in resources or [resource]]}
+
+    miq_api_class.return_value.get.side_effect = get
+    miq_api_class.return_value.post.side_effect = post
+    yield appliance
+
+
+@pytest.fixture()
+def miq(miq_api_class, miq_ansible_module):
+    def fail(msg, **kwargs):
+        raise AnsibleModuleFailed(msg)
+
+    miq_ansible_module.fail_json = fail
+    miq = manageiq_alert_profile.ManageIQAlertProfile(
+        miq_ansible_module, MANAGEIQ_HOSTNAME, "The username",
+        "The password", miq_verify_ssl=False, ca_bundle_path=None)
+    yield miq
+
+
+def test_membership_changes():
+    changes = manageiq_alert_profile.ManageIQAlertProfile.membership_changes
+    assigned = ALERTS[:2]
+    assert changes(assigned, ['Alert 1', 'Alert 2', 'Alert 2'], False) == (['Alert 2'], [])
+    assert changes(assigned, ['Alert 1', 'Alert 2'], True) == (['Alert 2'], [ALERTS[0]])
+
+
+def test_profile_unchanged_reads_membership_once(miq, appliance):
+    result = miq.create_or_update_profile(PROFILE_NAME, None, ['Alert 0', 'Alert 1'], True, 'managed')
+    assert not result['changed']
+    assert result['msg'] == "Alert profile {} already exist, no need for updates".format(PROFILE_NAME)
+    miq.client.get.assert_called_once()
+    assert 'expand=resources,alert_definitions' in miq.client.get.call_args[0][0]
+    miq.client.post.assert_not_called()
+
+
+def test_assign_and_unassign_many_alerts_in_single_posts(miq, appliance):
+    result = miq.create_or_update_profile(PROFILE_NAME, None, ['Alert 1', 'Alert 2', 'Alert 3', 'Alert 4'], True, None)
+    assert result['changed']
+    assert result['assigned'] == ['Alert 2', 'Alert 3', 'Alert 4']
+    assert result['unassigned'] == ['Alert 0']
+    # the profile and the alerts not assigned yet are read with a query each
+    assert miq.client.get.call_count == 2
+    url = '{}/alert_definition_profiles/{}/alert_definitions'.format(API_URL, PROFILE_ID)
+    assert miq.client.post.call_args_list[0][0] == (url,)
+    assert miq.client.post.call_args_list[0][1] == dict(
+        action='assign', resources=[{'href': alert['href']} for alert in ALERTS[2:]])
+    assert miq.client.post.call_args_list[1][1] == dict(action='unassign', resources=[{'href': ALERTS[0]['href']}])
+
+
+def test_create_profile_with_alerts(miq, appliance):
+    appliance['profiles'] = []
+    result = miq.create_or_update_profile(PROFILE_NAME, 'container_node', ['Alert 3'], False, 'managed')
+    assert result['changed']
+    assert result['profile_id'] == '6'
+    miq.client.post.assert_any_call(
+        API_URL + '/alert_definition_profiles', action='create',
+        resource={'description': PROFILE_NAME, 'mode': 'ContainerNode', 'set_data': {'notes': 'managed'}})
+    miq.client.post.assert_called_with(
+        API_URL + '/alert_definition_profiles/6/alert_definitions', action='assign',
+        resources=[{'href': ALERTS[3]['href']}])
+
+
+def test_create_profile_requires_entity(miq, appliance):
+    appliance['profiles'] = []
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.create_or_update_profile(PROFILE_NAME, None, ['Alert 3'], False, None)
+    assert str(excinfo.value) == "Failed to create alert profile {}: entity is required".format(PROFILE_NAME)
+
+
+def test_assign_missing_alerts_fails(miq, appliance):
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.create_or_update_profile(PROFILE_NAME, None, ['Alert 3', 'No Such Alert'], False, None)
+    assert str(excinfo.value) == "Alerts No Such Alert do not exist in manageiq"
+    miq.client.post.assert_not_called()
+
+
+def test_update_profile_notes(miq, appliance):
+    result = miq.create_or_update_profile(PROFILE_NAME, None, [], False, 'new notes')
+    assert result['changed']
+    miq.client.post.assert_called_once_with(
+        '{}/alert_definition_profiles/{}'.format(API_URL, PROFILE_ID), action='edit',
+        resource={'set_data': {'notes': 'new notes'}})
+
+
+def test_assign_alerts_in_check_mode(miq, miq_ansible_module, appliance):
+    miq_ansible_module.check_mode = True
+    result = miq.create_or_update_profile(PROFILE_NAME, None, ['Alert 2'], False, None)
+    assert result['changed']
+    assert result['msg'] == "Alert profile {} would be updated".format(PROFILE_NAME)
+    miq.client.post.assert_not_called()
+
+
+def test_partially_assigned_alerts_fail(miq, appliance):
+    miq.client.post.side_effect = lambda url, action, resources: {'results': [{'success': True}]}
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.create_or_update_profile(PROFILE_NAME, None, ['Alert 2', 'Alert 3'], False, None)
+    assert str(excinfo.value) == "Failed to assign alerts: 1 of 2 alerts were assigned"
+
+
+def test_delete_profile(miq, appliance):
+    result = miq.delete_profile(PROFILE_NAME)
+    assert result['changed']
+    miq.client.post.assert_called_once_with('{}/alert_definition_profiles/{}'.format(API_URL, PROFILE_ID),
+                                            action='delete')
+
+
+def test_delete_profile_not_exist(miq, appliance):
+    appliance['profiles'] = []
+    result = miq.delete_profile(PROFILE_NAME)
+    assert not result['changed']
+    assert result['msg'] == "Alert profile {} does not exist in manageiq".format(PROFILE_NAME)
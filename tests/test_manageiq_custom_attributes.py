@@ -92,6 +92,8 @@ def the_provider():
 @pytest.fixture
 def miq_ansible_module():
     miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
     yield miq_ansible_module
 
 
@@ -185,3 +187,133 @@ def test_delete_existing_custom_attribute(miq, miq_api_class):
         'msg': "Successfully deleted the following custom attributes from {provider_name} provider: {deleted}".format(
             provider_name=PROVIDER_NAME, deleted=POST_RETURN_VALUES['added_ca']['results'])
     }
+
+
+def test_update_existing_custom_attribute_in_check_mode(miq, miq_api_class, miq_ansible_module):
+    miq_ansible_module.check_mode = True
+    miq_ansible_module._diff = True
+    miq_api_class.return_value.get.return_value = GET_RETURN_VALUES['ca_exist']
+
+    updated_ca = [{'name': EXISTING_CA['name'], 'value': UPDATED_CA_VALUE, 'section': DEFAULT_SECTION}]
+    result = miq.add_or_update_custom_attributes('provider', PROVIDER_NAME, updated_ca)
+    assert result['changed']
+    assert result['msg'] == "The custom attributes would be set to {entity_name} {entity_type}".format(entity_name=PROVIDER_NAME, entity_type='provider')
+    assert result['diff'] == {'before': {EXISTING_CA['name']: EXISTING_CA['value']},
+                              'after': {EXISTING_CA['name']: UPDATED_CA_VALUE}}
+    assert not miq.client.post.called
+
+
+def test_delete_custom_attribute_by_entity_id_skips_lookup(miq, miq_api_class):
+    miq_api_class.return_value.get.return_value = GET_RETURN_VALUES['ca_exist']
+    miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['added_ca']
+    miq_api_class.return_value.collections.providers = []
+
+    deleted_ca = [{'name': EXISTING_CA['name'], 'section': DEFAULT_SECTION}]
+    result = miq.delete_custom_attributes('provider', None, deleted_ca, PROVIDER_ID)
+    assert result['changed']
+    miq.client.get.assert_called_once_with(
+        '{}/api/providers/{}?expand=custom_attributes'.format(MANAGEIQ_HOSTNAME, PROVIDER_ID))
+
+
+def vm(vm_id, cas):
+    return {'id': str(vm_id), 'name': 'vm{}'.format(vm_id), 'href': '{}/api/vms/{}'.format(MANAGEIQ_HOSTNAME, vm_id),
+            'custom_attributes': [dict(ca, section=DEFAULT_SECTION, href='{}/api/vms/{}/custom_attributes/{}'.format(
+                MANAGEIQ_HOSTNAME, vm_id, ca['name'])) for ca in cas]}
+
+
+VMS = [vm(0, []),
+       vm(1, [{'name': 'cost_center', 'value': '1001'}]),
+       vm(2, [{'name': 'cost_center', 'value': '2002'}])]
+
+
+def test_normalize_custom_attributes():
+    normalize = manageiq_custom_attributes.ManageIQCustomAttributes.normalize_custom_attributes
+    assert normalize({'b': '2', 'a': '1'}) == [{'name': 'a', 'value': '1', 'section': DEFAULT_SECTION},
+                                               {'name': 'b', 'value': '2', 'section': DEFAULT_SECTION}]
+    assert normalize([{'name': 'a', 'value': '1', 'section': DIFFERENT_SECTION}]) == [
+        {'name': 'a', 'value': '1', 'section': DIFFERENT_SECTION}]
+
+
+def test_set_custom_attributes_of_many_entities(miq, miq_api_class):
+    miq_api_class.return_value.get.return_value = {'subcount': len(VMS), 'resources': VMS}
+    miq_api_class.return_value.post.return_value = {'results': [{'success': True}]}
+    cost_center = [{'name': 'cost_center', 'value': '1001', 'section': DEFAULT_SECTION}]
+    entities = [{'name': vm['name'], 'custom_attributes': cost_center} for vm in VMS]
+
+    result = miq.set_entities_custom_attributes('vm', entities, None, None, 'present')
+    assert result['changed']
+    assert result['msg'] == "Successfully set the custom attributes of 2 of 3 vms"
+    assert sorted(result['entities'], key=lambda e: e['id']) == [
+        {'name': 'vm0', 'id': '0', 'added': ['cost_center']},
+        {'name': 'vm2', 'id': '2', 'updated': ['cost_center']}]
+    # the entities and their custom attributes are read with a single query
+    url = miq.client.get.call_args[0][0]
+    assert url.startswith('{}/api/vms?expand=resources,custom_attributes&attributes=name&filter[]='.format(MANAGEIQ_HOSTNAME))
+    assert miq.client.get.call_count == 1
+    miq.client.post.assert_any_call('{}/api/vms/0/custom_attributes'.format(MANAGEIQ_HOSTNAME),
+                                    action='add', resources=cost_center)
+    miq.client.post.assert_any_call('{}/api/vms/2/custom_attributes'.format(MANAGEIQ_HOSTNAME), action='edit',
+                                    resources=[{'name': 'cost_center', 'value': '1001',
+                                                'href': VMS[2]['custom_attributes'][0]['href']}])
+    assert miq.client.post.call_count == 2
+
+
+def test_set_custom_attributes_of_filtered_entities_unchanged(miq, miq_api_class):
+    miq_api_class.return_value.get.return_value = {'subcount': 1, 'resources': VMS[1:2]}
+    cost_center = [{'name': 'cost_center', 'value': '1001', 'section': DEFAULT_SECTION}]
+
+    result = miq.set_entities_custom_attributes('vm', None, ['ems_id=3'], cost_center, 'present')
+    assert not result['changed']
+    assert result['msg'] == "The custom attributes are already set on 1 vms"
+    assert 'filter[]=ems_id%3D3' in miq.client.get.call_args[0][0]
+    assert not miq.client.post.called
+
+
+def test_delete_custom_attributes_of_many_entities_in_check_mode(miq, miq_api_class, miq_ansible_module):
+    miq_ansible_module.check_mode = True
+    miq_api_class.return_value.get.return_value = {'subcount': len(VMS), 'resources': VMS}
+    cost_center = [{'name': 'cost_center', 'section': DEFAULT_SECTION}]
+
+    result = miq.set_entities_custom_attributes('vm', None, ['ems_id=3'], cost_center, 'absent')
+    assert result['changed']
+    assert result['msg'] == "The custom attributes would be deleted from 2 of 3 vms"
+    assert not miq.client.post.called
+
+
+def test_set_custom_attributes_of_missing_entities_fails(miq, miq_api_class):
+    miq_api_class.return_value.get.return_value = {'subcount': len(VMS), 'resources': VMS}
+    entities = [{'name': name, 'custom_attributes': []} for name in ('vm0', 'vm9')]
+
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.set_entities_custom_attributes('vm', entities, None, None, 'present')
+    assert str(excinfo.value) == "Failed to set the custom attributes. vm vm9 do not exist"
+
+
+def test_set_custom_attributes_of_duplicate_entities_fails(miq, miq_api_class):
+    entities = [{'name': name, 'custom_attributes': []} for name in ('vm0', 'vm1', 'vm0')]
+
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.set_entities_custom_attributes('vm', entities, None, None, 'present')
+    assert str(excinfo.value) == "Failed to set the custom attributes. vm vm0 are given more than once"
+    assert not miq.client.get.called
+    assert not miq.client.post.called
+
+
+def test_set_custom_attributes_of_many_entities_reports_failed_entities(miq, miq_api_class, miq_ansible_module):
+    def fail(msg, **kwargs):
+        raise AnsibleModuleFailed(msg, kwargs)
+    miq_ansible_module.fail_json = fail
+    miq_api_class.return_value.get.return_value = {'subcount': len(VMS), 'resources': VMS}
+
+    def post(url, action, resources):
+        if '/vms/2/' in url:
+            raise Exception("Internal Server Error")
+        return {'results': [{'success': True}]}
+    miq_api_class.return_value.post.side_effect = post
+    cost_center = [{'name': 'cost_center', 'value': '1001', 'section': DEFAULT_SECTION}]
+
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.set_entities_custom_attributes('vm', None, ['ems_id=3'], cost_center, 'present', concurrency=2)
+    msg, kwargs = excinfo.value.args
+    assert msg == "Failed to set the custom attributes of 1 of 2 vms: vm2: Internal Server Error"
+    assert kwargs == {'changed': True, 'entities': [{'name': 'vm0', 'id': '0', 'added': ['cost_center']}]}
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+from mock import Mock
+
+from ansible.inventory.data import InventoryData
+
+
+# inventory plugins are loaded by ansible from the inventory_plugins directory
+# (see ansible.cfg), import it from there under its plugin name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'inventory_plugins'))
+import manageiq as manageiq_inventory  # noqa: E402
+sys.path.pop(0)
+
+
+MANAGEIQ_HOSTNAME = "http://themanageiq.tld"
+
+OPTIONS = {
+    'miq_url': MANAGEIQ_HOSTNAME,
+    'miq_username': 'The username',
+    'miq_password': 'The password',
+    'miq_verify_ssl': False,
+    'ca_bundle_path': None,
+    'collections': ['vms', 'container_nodes'],
+    'page_size': 2,
+    'group_by_providers': True,
+    'group_by_tags': True,
+    'strict': False,
+    'compose': {},
+    'groups': {},
+    'keyed_groups': [],
+    'cache': False,
+}
+
+RESOURCES = {
+    'providers': [{'id': 1, 'name': 'Molecule'}],
+    'vms': [{'id': 10, 'name': 'vm01', 'ems_id': 1, 'ipaddresses': ['10.0.0.1'], 'power_state': 'on',
+             'tags': [{'name': '/managed/environment/prod'}]},
+            {'id': 11, 'name': 'vm02', 'ems_id': 1, 'ipaddresses': [], 'power_state': 'off', 'tags': []},
+            {'id': 12, 'name': 'vm03', 'ems_id': None, 'ipaddresses': ['10.0.0.3'], 'power_state': 'on',
+             'tags': []}],
+    'container_nodes': [{'id': 20, 'name': 'node01.example.com', 'ems_id': 1, 'tags': []}],
+}
+
+
+def paged_get(url):
+    collection, query = url.rsplit('/', 1)[1].split('?')
+    params = dict(p.split('=') for p in query.split('&'))
+    offset, limit = int(params['offset']), int(params['limit'])
+    resources = RESOURCES[collection]
+    return {'subcount': len(resources), 'resources': resources[offset:offset + limit]}
+
+
+@pytest.fixture(autouse=True)
+def miq_api_class(monkeypatch):
+    miq_api_class = Mock()
+    miq_api_class.return_value.get.side_effect = paged_get
+    monkeypatch.setattr(manageiq_inventory, "ManageIQClient", miq_api_class)
+    yield miq_api_class
+
+
+@pytest.fixture
+def plugin():
+    plugin = manageiq_inventory.InventoryModule()
+    plugin.inventory = InventoryData()
+    plugin.get_option = OPTIONS.get
+    yield plugin
+
+
+def test_verify_file(plugin, tmpdir):
+    config = tmpdir.join('prod.manageiq.yml')
+    config.write('plugin: manageiq\n')
+    other = tmpdir.join('hosts.yml')
+    other.write('all: {}\n')
+    assert plugin.verify_file(str(config))
+    assert not plugin.verify_file(str(other))
+
+
+def test_fetch_inventory_pages_and_projects(plugin, miq_api_class):
+    inventory_data = plugin.fetch_inventory()
+    assert inventory_data['providers'] == {'1': 'Molecule'}
+    assert [h['id'] for h in inventory_data['hosts']['vms']] == ['10', '11', '12']
+    urls = [c[0][0] for c in miq_api_class.return_value.get.call_args_list]
+    assert '{}/api/vms?expand=resources,tags&attributes=id,name,ems_id,ipaddresses,power_state,vendor,guid' \
+           '&offset=2&limit=2'.format(MANAGEIQ_HOSTNAME) in urls
+    assert len(urls) == 4
+
+
+def test_fetch_inventory_rejects_unknown_collection(plugin):
+    plugin.get_option = dict(OPTIONS, collections=['templates']).get
+    with pytest.raises(manageiq_inventory.AnsibleError):
+        plugin.fetch_inventory()
+
+
+def test_populate_groups_hosts(plugin):
+    plugin.populate(plugin.fetch_inventory())
+    groups = plugin.inventory.groups
+    assert sorted(h.name for h in groups['manageiq_vms'].get_hosts()) == ['vm01', 'vm02', 'vm03']
+    assert sorted(h.name for h in groups['manageiq_provider_Molecule'].get_hosts()) == \
+        ['node01.example.com', 'vm01', 'vm02']
+    assert [h.name for h in groups['manageiq_tag_environment_prod'].get_hosts()] == ['vm01']
+
+    vm01 = plugin.inventory.get_host('vm01').vars
+    assert vm01['ansible_host'] == '10.0.0.1'
+    assert vm01['manageiq_provider'] == 'Molecule'
+    assert vm01['manageiq_power_state'] == 'on'
+    assert 'ansible_host' not in plugin.inventory.get_host('vm02').vars
+    assert plugin.inventory.get_host('node01.example.com').vars['ansible_host'] == 'node01.example.com'
+
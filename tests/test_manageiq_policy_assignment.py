@@ -41,6 +41,8 @@ def the_policy_profile():
 @pytest.fixture
 def miq_ansible_module():
     miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
     yield miq_ansible_module
 
 
@@ -88,3 +90,94 @@ def test_will_assign_policy_profile_on_resource_if_not_assigned(miq, miq_api_cla
     miq.client.post.assert_called_once_with(
         '{}/api/providers/1/policy_profiles'.format(MANAGEIQ_HOSTNAME),
         action='assign', resource={"href": "{}/api/policy_profiles/1".format(MANAGEIQ_HOSTNAME)})
+
+
+def test_assign_policy_profile_reports_post_error(miq, miq_api_class):
+    miq_api_class.return_value.get.return_value = {}
+    miq_api_class.return_value.post.side_effect = Exception("The request failed with HTTP status 500: Internal Server Error")
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.assign_or_unassign_entity('policy profile', POLICY_PROFILE_NAME, 'provider', RESOURCE_NAME, 'present')
+    assert str(excinfo.value) == "Failed to assign: The request failed with HTTP status 500: Internal Server Error"
+
+
+def test_will_not_assign_policy_profile_if_already_assigned(miq, miq_api_class):
+    res_args = miq.assign_or_unassign_entity(
+        'policy profile', POLICY_PROFILE_NAME, 'provider', RESOURCE_NAME, 'present')
+    assert res_args == {
+        "changed": False,
+        "msg": "policy profile {} already assigned, nothing to do".format(POLICY_PROFILE_NAME)}
+    assert not miq.client.post.called
+
+
+def test_assign_policy_profile_in_check_mode(miq, miq_api_class, miq_ansible_module):
+    miq_ansible_module.check_mode = True
+    miq_ansible_module._diff = True
+    miq_api_class.return_value.get.return_value = {}
+    res_args = miq.assign_or_unassign_entity(
+        'policy profile', POLICY_PROFILE_NAME, 'provider', RESOURCE_NAME, 'present')
+    assert res_args == {
+        "changed": True,
+        "msg": "policy profile {} would be assigned".format(POLICY_PROFILE_NAME),
+        "diff": {"before": {"assigned": False}, "after": {"assigned": True}}}
+    assert not miq.client.post.called
+
+
+def test_assign_policy_profile_by_resource_id_skips_lookup(miq, miq_api_class):
+    miq_api_class.return_value.get.return_value = {}
+    miq_api_class.return_value.collections.providers = []
+    res_args = miq.assign_or_unassign_entity(
+        'policy profile', POLICY_PROFILE_NAME, 'provider', None, 'present', resource_id='27')
+    assert res_args["changed"]
+    miq.client.post.assert_called_once_with(
+        '{}/api/providers/27/policy_profiles'.format(MANAGEIQ_HOSTNAME),
+        action='assign', resource={"href": "{}/api/policy_profiles/1".format(MANAGEIQ_HOSTNAME)})
+
+
+def test_assign_policy_profile_by_entity_id_skips_lookup(miq, miq_api_class):
+    miq_api_class.return_value.collections.policy_profiles = []
+    res_args = miq.assign_or_unassign_entity(
+        'policy profile', None, 'provider', RESOURCE_NAME, 'present', entity_id='1')
+    assert res_args == {
+        "changed": False,
+        "msg": "policy profile 1 already assigned, nothing to do"}
+    miq.client.get.assert_any_call('{}/api/policy_profiles/1?attributes=id'.format(MANAGEIQ_HOSTNAME))
+
+
+def test_assign_policy_profile_by_entity_id_not_exist(miq, miq_api_class):
+    miq_api_class.return_value.get.side_effect = Exception("ActiveRecord::RecordNotFound: Couldn't find the resource")
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.assign_or_unassign_entity(
+            'policy profile', None, 'provider', RESOURCE_NAME, 'present', entity_id='7')
+    assert str(excinfo.value) == "Failed to assign policy profile: policy profile 7 does not exist in manageiq"
+
+
+def test_assign_on_appliances_reports_failure_once(miq_api_class):
+    module = Mock(spec=AnsibleModule)
+    module.check_mode = False
+    module.params = {'miq_url': None, 'miq_username': 'admin', 'miq_password': 'smartvm', 'miq_verify_ssl': True,
+                     'ca_bundle_path': None, 'miq_appliances_concurrency': 2,
+                     'miq_appliances': [{'name': 'region1', 'miq_url': 'https://miq1.example.com'},
+                                        {'name': 'region2', 'miq_url': 'https://miq2.example.com'}]}
+    module.no_log_values = set()
+
+    def fail(**kwargs):
+        raise AnsibleModuleFailed(kwargs)
+    module.fail_json = fail
+
+    def post(url, **kwargs):
+        if url.startswith('https://miq2.example.com'):
+            return dict(results=[{'success': False, 'message': "Policy profile 1 is already assigned"}])
+        return dict(results=[{'success': True, 'message': "Assigning Policy Profile"}])
+    miq_api_class.return_value.post.side_effect = post
+
+    def apply(module, connection):
+        miq = manageiq_policy_assignment.ManageIQ(module, connection['miq_url'], connection['miq_username'],
+                                                  connection['miq_password'], connection['miq_verify_ssl'],
+                                                  connection['ca_bundle_path'])
+        return miq.execute_action('policy_profiles', '1', 'providers', '1', 'assign')
+
+    with pytest.raises(AnsibleModuleFailed) as e:
+        manageiq_policy_assignment.run_on_appliances(module, apply)
+    regions = e.value.args[0]['regions']
+    assert regions['region1']['changed']
+    assert regions['region2']['msg'] == "Failed to assign: Policy profile 1 is already assigned"
@@ -4,6 +4,7 @@ from mock import Mock, call
 
 from ansible.module_utils.basic import AnsibleModule
 
+from ansible.module_utils import manageiq_utils
 from manageiq_client.api import ManageIQClient
 import manageiq_provider
 
@@ -223,6 +224,8 @@ def the_zone():
 @pytest.fixture
 def miq_ansible_module():
     miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
     yield miq_ansible_module
 
 
@@ -302,6 +305,46 @@ def test_generate_auth_key_config(miq):
                                      'security_protocol': 'ssl-without-validation'}}
 
 
+def test_generate_auth_key_config_reads_ca_file_once(miq, tmpdir, monkeypatch):
+    ca_file = tmpdir.join('ca.crt')
+    ca_file.write('-----BEGIN CERTIFICATE-----\r\nMIIB\r\n-----END CERTIFICATE-----\r\n\r\n')
+    monkeypatch.setattr(manageiq_utils, 'CERTIFICATES', {})
+    opened = []
+    real_open = open
+    monkeypatch.setattr(manageiq_utils, 'open', lambda *args: opened.append(args) or real_open(*args), raising=False)
+    endpoints = [miq.generate_auth_key_config(role, role, PROVIDER_HOSTNAME, PROVIDER_PORT, PROVIDER_TOKEN,
+                                              True, str(ca_file)) for role in ('default', 'hawkular')]
+    assert len(opened) == 1
+    assert endpoints[1]['endpoint']['certificate_authority'] == \
+        '-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----\n'
+    assert endpoints[1]['endpoint']['security_protocol'] == 'ssl-with-validation-custom-ca'
+
+
+def test_required_updates_compares_ca_by_fingerprint(miq):
+    endpoint = dict(GET_RETURN_VALUES['openshift_without_monitoring']['endpoints'][0],
+                    certificate_authority='-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----\n')
+    existing_config = {'zone_id': 1, 'endpoints': [dict(endpoint, certificate_authority=endpoint['certificate_authority'].replace('\n', '\r\n'))]}
+    assert miq.required_updates(PROVIDER_ID, [{'endpoint': endpoint}], 1, None, existing_config) == {}
+
+    existing_config['endpoints'][0]['certificate_authority'] = '-----BEGIN CERTIFICATE-----\nMIIC\n-----END CERTIFICATE-----\n'
+    updates = miq.required_updates(PROVIDER_ID, [{'endpoint': endpoint}], 1, None, existing_config)
+    assert updates['Updated']['default'] == {
+        'certificate_authority': manageiq_utils.certificate_fingerprint(endpoint['certificate_authority'])}
+
+
+@pytest.mark.parametrize('api_version, existing_endpoints, filtered', [
+    (None, [{'certificate_authority': None}], False),
+    (None, [{}], True),
+    ('2.3.0', [{'certificate_authority': None}], True),
+    ('2.4.0', [{}], False),
+])
+def test_filter_certificate_authority_by_api_version(miq, api_version, existing_endpoints, filtered):
+    miq.client.version = api_version
+    configs = [{'endpoint': {'role': 'default', 'certificate_authority': None}}]
+    miq.filter_certificate_authority(configs, existing_endpoints)
+    assert ('certificate_authority' not in configs[0]['endpoint']) == filtered
+
+
 def test_filter_unsupported_fields_from_config(miq):
 
     # Covering all combinations of:
@@ -346,7 +389,7 @@ def test_will_add_openshift_provider_if_none_present(miq, miq_api_class, openshi
         'changed': True,
         'msg': "Successful addition of {} provider. Authentication: {{'bearer': ('Valid', 'Ok')}}. Refreshing provider inventory".format(PROVIDER_NAME),
         'provider_id': PROVIDER_ID,
-        'updates': None}
+        'href': '{}/api/providers/{}'.format(MANAGEIQ_HOSTNAME, PROVIDER_ID)}
     calls = [call('{}/api/providers'.format(MANAGEIQ_HOSTNAME),
                   connection_configurations=[
                       {'endpoint': {'port': PROVIDER_PORT,
@@ -377,7 +420,7 @@ def test_will_add_amazon_provider_if_none_present(miq, miq_api_class, amazon_end
         "changed": True,
         "msg": "Successful addition of {} provider. Authentication: {{'default': ('Valid', 'Ok')}}. Refreshing provider inventory".format(AMAZON_PROVIDER_NAME),
         "provider_id": PROVIDER_ID,
-        'updates': None
+        "href": '{}/api/providers/{}'.format(MANAGEIQ_HOSTNAME, PROVIDER_ID)
         }
     calls = [call('{}/api/providers'.format(MANAGEIQ_HOSTNAME),
                   connection_configurations=[
@@ -406,7 +449,7 @@ def test_will_add_hawkular_datawarehose_provider_if_none_present(miq, miq_api_cl
         'changed': True,
         'msg': "Successful addition of {} provider. Authentication: {{'default': ('Valid', 'Ok')}}. Refreshing provider inventory".format(HAWK_DW_PROVIDER_NAME),
         'provider_id': PROVIDER_ID,
-        'updates': None}
+        'href': '{}/api/providers/{}'.format(MANAGEIQ_HOSTNAME, PROVIDER_ID)}
     calls = [call('{}/api/providers'.format(MANAGEIQ_HOSTNAME),
                   connection_configurations=[
                       {'endpoint': {'port': HAWK_DW_PROVIDER_PORT,
@@ -434,6 +477,7 @@ def test_will_update_openshift_provider_if_present(miq, miq_api_class, openshift
     ]
     miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['openshift']
 
+    miq.result_detail = 'normal'
     openshift_endpoint.extend(hawkular_endpoint)
     res_args = miq.add_or_update_provider(
         PROVIDER_NAME, "openshift-origin", openshift_endpoint,
@@ -442,6 +486,8 @@ def test_will_update_openshift_provider_if_present(miq, miq_api_class, openshift
         'changed': True,
         'msg': "Successful update of {} provider. Authentication: {{'hawkular': ('Valid', 'Ok')}}. Refreshing provider inventory".format(PROVIDER_NAME),
         'provider_id': PROVIDER_ID,
+        'href': '{}/api/providers/{}'.format(MANAGEIQ_HOSTNAME, PROVIDER_ID),
+        'changed_fields': ['endpoints.hawkular'],
         'updates': {
             'Added': {
                 'hawkular': {'hostname': 'some-hawkular-hostname.tld', 'port': 443,
@@ -472,16 +518,8 @@ def test_will_add_prometheus_endpoint_to_openshift_provider_if_present(miq, miq_
         'changed': True,
         'msg': "Successful update of {} provider. Authentication: {{}}. Refreshing provider inventory".format(PROVIDER_NAME),
         'provider_id': PROVIDER_ID,
-        'updates': {
-            'Added': {
-                'prometheus': {'hostname': 'some-prometheus-hostname.tld', 'port': 80,
-                               'certificate_authority': None,
-                               'verify_ssl': False,
-                               'security_protocol': 'ssl-without-validation'}
-            },
-            'Removed': {},
-            'Updated': {}
-        }
+        'href': '{}/api/providers/{}'.format(MANAGEIQ_HOSTNAME, PROVIDER_ID),
+        'changed_fields': ['endpoints.prometheus']
     }
 
 
@@ -499,16 +537,23 @@ def test_will_update_amazon_provider_if_present(miq, miq_api_class, amazon_endpo
         'changed': True,
         'msg': 'Successful update of {} provider. Authentication: {{}}. Refreshing provider inventory'.format(AMAZON_PROVIDER_NAME),
         'provider_id': the_amazon_provider.id,
-        'updates': {
-            'Added': {},
-            'Removed': {},
-            'Updated': {
-                'provider_region': 'other region'
-            }
-        }
+        'href': '{}/api/providers/{}'.format(MANAGEIQ_HOSTNAME, the_amazon_provider.id),
+        'changed_fields': ['provider_region']
     }
 
 
+def test_update_provider_full_result_detail(miq, miq_api_class, amazon_endpoint, the_amazon_provider):
+    miq.result_detail = 'full'
+    miq_api_class.return_value.collections.providers = [the_amazon_provider]
+    miq_api_class.return_value.get.return_value = GET_RETURN_VALUES['amazon']
+    miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['updated_amazon']
+
+    res_args = miq.add_or_update_provider(
+        AMAZON_PROVIDER_NAME, "amazon", amazon_endpoint, "default",
+        "other region")
+    assert res_args['updates']['Updated'] == {'provider_region': 'other region'}
+    assert res_args['result'] == POST_RETURN_VALUES['updated_amazon']
+
 def test_reports_error(miq, openshift_endpoint, the_provider, miq_api_class):
     miq_api_class.return_value.collections.providers = [the_provider]
     miq_api_class().get.side_effect = Exception("foo")
@@ -516,3 +561,63 @@ def test_reports_error(miq, openshift_endpoint, the_provider, miq_api_class):
         miq.add_or_update_provider(
             PROVIDER_NAME, "openshift-origin", openshift_endpoint, "default", None)
     assert str(excinfo.value) == "Failed to get provider data. Error: Exception('foo',)"
+
+
+def test_update_provider_in_check_mode(miq, miq_api_class, miq_ansible_module, openshift_endpoint, hawkular_endpoint, the_provider):
+    miq_ansible_module.check_mode = True
+    miq_ansible_module._diff = True
+    miq_api_class.return_value.collections.providers = [the_provider]
+    miq_api_class.return_value.get.return_value = GET_RETURN_VALUES['openshift_without_monitoring']
+
+    openshift_endpoint.extend(hawkular_endpoint)
+    res_args = miq.add_or_update_provider(
+        PROVIDER_NAME, "openshift-origin", openshift_endpoint,
+        "default", None)
+    assert res_args['changed']
+    assert res_args['msg'] == "Provider {} would be updated".format(PROVIDER_NAME)
+    assert res_args['changed_fields'] == ['endpoints.hawkular']
+    assert set(res_args['diff']['before']['endpoints']) == {'default'}
+    assert set(res_args['diff']['after']['endpoints']) == {'default', 'hawkular'}
+    assert miq.client.get.call_count == 1
+    assert not miq.client.post.called
+
+
+def test_add_provider_in_check_mode(miq, miq_api_class, miq_ansible_module, amazon_endpoint):
+    miq_ansible_module.check_mode = True
+    miq_api_class.return_value.collections.providers = []
+
+    res_args = miq.add_or_update_provider(
+        AMAZON_PROVIDER_NAME, "amazon", amazon_endpoint, "default",
+        AMAZON_PROVIDER_REGION)
+    assert res_args == {
+        'changed': True,
+        'msg': "Provider {} would be added".format(AMAZON_PROVIDER_NAME),
+        'provider_id': None
+    }
+    assert not miq.client.post.called
+
+
+def test_deferred_refresh_is_queued(miq, tmpdir):
+    miq.refresh_queue = manageiq_utils.RefreshQueue(MANAGEIQ_HOSTNAME, str(tmpdir))
+    assert miq.refresh_provider(PROVIDER_ID) == "Provider inventory refresh deferred"
+    assert miq.refresh_queue.peek() == [str(PROVIDER_ID)]
+    assert not miq.client.post.called
+
+
+def test_scheduled_refresh_waits_for_refresh_task(miq, miq_api_class, tmpdir):
+    miq.refresh_scheduler = manageiq_utils.RefreshScheduler(MANAGEIQ_HOSTNAME, 1, str(tmpdir), poll_interval=0)
+    miq_api_class.return_value.post.return_value = {'success': True, 'task_id': '9'}
+    miq_api_class.return_value.get.side_effect = [{'state': 'Queued'}, {'state': 'Finished', 'status': 'Ok'}]
+    assert miq.refresh_provider(PROVIDER_ID) == "Refreshed provider inventory"
+    assert miq.client.get.call_args[0][0] == '{}/api/tasks/9?attributes=state,status,message'.format(MANAGEIQ_HOSTNAME)
+    assert miq.changed
+
+
+def test_delete_provider_by_id_skips_lookup(miq, miq_api_class):
+    miq_api_class.return_value.collections.providers = []
+    miq_api_class.return_value.post.return_value = {'success': True, 'task_id': 7, 'message': 'Deleting provider'}
+
+    result = miq.delete_provider(PROVIDER_NAME, PROVIDER_ID)
+    assert result == {'task_id': 7, 'changed': True, 'msg': 'Deleting provider'}
+    miq.client.post.assert_called_once_with(
+        '{}/api/providers/{}'.format(MANAGEIQ_HOSTNAME, PROVIDER_ID), action='delete')
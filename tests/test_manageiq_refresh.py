@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+from mock import Mock
+
+from ansible.module_utils import basic
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_bytes
+from ansible.module_utils.manageiq_utils import RefreshQueue, RefreshScheduler
+
+from manageiq_client.api import ManageIQClient
+import manageiq_refresh
+
+
+MANAGEIQ_HOSTNAME = "http://themanageiq.tld"
+PROVIDERS = [{'name': 'provider{}'.format(i), 'href': MANAGEIQ_HOSTNAME + '/api/providers/{}'.format(i)}
+             for i in range(3)]
+
+
+@pytest.fixture(autouse=True)
+def miq_api_class(monkeypatch):
+    miq_api_class = Mock(spec=ManageIQClient)
+    monkeypatch.setattr("manageiq_refresh.MiqApi", miq_api_class)
+    yield miq_api_class
+
+
+@pytest.fixture
+def miq_ansible_module():
+    miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
+    yield miq_ansible_module
+
+
+class AnsibleModuleFailed(Exception):
+    pass
+
+
+@pytest.fixture
+def appliance(miq_api_class):
+    """ Runs each refresh task for two reads of its state, and records the
+    highest number of refreshes running at once
+    """
+    appliance = dict(tasks={}, running=0, max_running=0, fail=set())
+
+    def post(url, action):
+        provider_id = url.rsplit('/', 1)[1]
+        if provider_id in appliance['fail']:
+            raise Exception("Provider {} is not refreshable".format(provider_id))
+        appliance['tasks'][provider_id] = 2
+        appliance['running'] += 1
+        appliance['max_running'] = max(appliance['max_running'], appliance['running'])
+        return {'success': True, 'task_id': provider_id, 'task_href': MANAGEIQ_HOSTNAME + '/api/tasks/' + provider_id}
+
+    def get(url):
+        if '/api/providers?' in url:
+            return {'subcount': len(PROVIDERS), 'resources': PROVIDERS}
+        task_id = url.split('/api/tasks/')[1].split('?')[0]
+        appliance['tasks'][task_id] -= 1
+        if appliance['tasks'][task_id]:
+            return {'state': 'Active', 'status': 'Ok'}
+        appliance['running'] -= 1
+        return {'state': 'Finished', 'status': 'Ok', 'message': 'Task completed successfully'}
+
+    miq_api_class.return_value.post.side_effect = post
+    miq_api_class.return_value.get.side_effect = get
+    yield appliance
+
+
+@pytest.fixture()
+def miq(miq_api_class, miq_ansible_module):
+    def fail(msg, **kwargs):
+        raise AnsibleModuleFailed(msg)
+
+    miq_ansible_module.fail_json = fail
+    miq = manageiq_refresh.ManageIQRefresh(
+        miq_ansible_module, MANAGEIQ_HOSTNAME, "The username",
+        "The password", miq_verify_ssl=False, ca_bundle_path=None)
+    yield miq
+
+
+@pytest.fixture
+def scheduler(tmpdir):
+    yield RefreshScheduler(MANAGEIQ_HOSTNAME, 2, str(tmpdir), poll_interval=0)
+
+
+def test_refreshes_with_limited_concurrency(miq, appliance, scheduler):
+    result = miq.refresh_providers(['0', '1', '2'], scheduler)
+    assert result['changed']
+    assert result['msg'] == "Successfully refreshed 3 providers"
+    assert [r['provider_id'] for r in result['refreshes']] == ['0', '1', '2']
+    assert all(r['state'] == 'Finished' for r in result['refreshes'])
+    assert appliance['max_running'] == 2
+
+
+def test_find_provider_ids_with_a_single_query(miq, miq_api_class):
+    miq_api_class.return_value.get.return_value = {'subcount': len(PROVIDERS), 'resources': PROVIDERS}
+    assert miq.find_provider_ids(['provider2', 'provider0']) == ['2', '0']
+    assert miq_api_class.return_value.get.call_count == 1
+    with pytest.raises(AnsibleModuleFailed) as e:
+        miq.find_provider_ids(['provider0', 'missing'])
+    assert 'missing' in str(e.value)
+
+
+def test_refreshes_queued_providers_once(miq, appliance, scheduler, tmpdir):
+    queue = RefreshQueue(MANAGEIQ_HOSTNAME, str(tmpdir))
+    queue.add('1')
+    queue.add('2')
+    queue.add('1')
+    result = miq.refresh_providers(['1'], scheduler, queue)
+    assert [r['provider_id'] for r in result['refreshes']] == ['1', '2']
+    assert queue.peek() == []
+
+
+def test_requeues_failed_refreshes(miq, appliance, scheduler, tmpdir):
+    appliance['fail'].add('2')
+    queue = RefreshQueue(MANAGEIQ_HOSTNAME, str(tmpdir))
+    queue.add('2')
+    with pytest.raises(AnsibleModuleFailed) as e:
+        miq.refresh_providers(['0'], scheduler, queue)
+    assert str(e.value) == "Failed to refresh providers 2"
+    assert queue.peek() == ['2']
+
+
+def test_keeps_queue_on_refresh_error(miq, appliance, scheduler, tmpdir, monkeypatch):
+    queue = RefreshQueue(MANAGEIQ_HOSTNAME, str(tmpdir))
+    queue.add('1')
+    queue.add('2')
+
+    def refresh_all(client, api_url, provider_ids):
+        raise Exception("Circuit breaker is open")
+    monkeypatch.setattr(scheduler, 'refresh_all', refresh_all)
+    with pytest.raises(AnsibleModuleFailed) as e:
+        miq.refresh_providers(['0'], scheduler, queue)
+    assert str(e.value) == "Failed to refresh providers: Circuit breaker is open"
+    assert queue.peek() == ['1', '2']
+
+
+def test_requeues_timed_out_refreshes(miq, appliance, scheduler, tmpdir, monkeypatch):
+    queue = RefreshQueue(MANAGEIQ_HOSTNAME, str(tmpdir))
+    queue.add('1')
+    queue.add('2')
+    monkeypatch.setattr(scheduler, 'refresh_all', lambda client, api_url, provider_ids: [
+        dict(provider_id=provider_id, state='Timed out' if provider_id in ('0', '2') else 'Finished', status='Ok')
+        for provider_id in provider_ids])
+    result = miq.refresh_providers(['0'], scheduler, queue)
+    assert result['msg'] == "Successfully refreshed 1 providers, 2 timed out"
+    assert queue.peek() == ['2', '0']
+
+
+def test_refresh_in_check_mode(miq, miq_ansible_module, appliance, scheduler, tmpdir):
+    miq_ansible_module.check_mode = True
+    queue = RefreshQueue(MANAGEIQ_HOSTNAME, str(tmpdir))
+    queue.add('2')
+    result = miq.refresh_providers(['0'], scheduler, queue)
+    assert result['msg'] == "2 providers would be refreshed"
+    assert queue.peek() == ['2']
+    assert not miq.client.post.called
+
+
+def test_requires_providers_to_refresh(monkeypatch, capsys):
+    args = dict(miq_url=MANAGEIQ_HOSTNAME, miq_username='The username', miq_password='The password')
+    monkeypatch.setattr(basic, '_ANSIBLE_ARGS', to_bytes(json.dumps({'ANSIBLE_MODULE_ARGS': args})))
+    # newer ansible versions also need the serialization profile of the arguments
+    monkeypatch.setattr(basic, '_ANSIBLE_PROFILE', 'legacy', raising=False)
+    with pytest.raises(SystemExit):
+        manageiq_refresh.main()
+    assert 'one of the following is required: providers, provider_ids, from_queue' in capsys.readouterr().out
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+
+import pytest
+from mock import Mock
+
+from ansible.plugins.loader import lookup_loader
+
+# lookup plugins are loaded by ansible from the lookup_plugins directory (see
+# ansible.cfg), load it the same way so that its options are defined
+lookup_loader.add_directory(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lookup_plugins'))
+manageiq_resolve = sys.modules[type(lookup_loader.get('manageiq_resolve')).__module__]
+
+
+MANAGEIQ_HOSTNAME = "http://themanageiq.tld"
+OPTIONS = dict(miq_url=MANAGEIQ_HOSTNAME, miq_username='The username', miq_password='The password')
+
+RESOURCES = {
+    'providers': [{'name': 'OpenShift01', 'href': MANAGEIQ_HOSTNAME + '/api/providers/1'},
+                  {'name': 'OpenShift02', 'href': MANAGEIQ_HOSTNAME + '/api/providers/2'}],
+    'users': [{'userid': 'admin', 'href': MANAGEIQ_HOSTNAME + '/api/users/3'}],
+}
+
+
+@pytest.fixture(autouse=True)
+def lock_dir(monkeypatch, tmpdir):
+    monkeypatch.setenv('MIQ_LOCK_DIR', str(tmpdir))
+    yield tmpdir
+
+
+@pytest.fixture(autouse=True)
+def miq_api_class(monkeypatch):
+    miq_api_class = Mock()
+
+    def get(url):
+        collection = url.split('/api/')[1].split('?')[0]
+        return {'subcount': len(RESOURCES[collection]), 'resources': RESOURCES[collection]}
+
+    miq_api_class.return_value.get.side_effect = get
+    monkeypatch.setattr(manageiq_resolve, "ManageIQClient", miq_api_class)
+    yield miq_api_class
+
+
+@pytest.fixture
+def lookup():
+    yield lookup_loader.get('manageiq_resolve')
+
+
+def test_resolves_many_names_with_a_query_per_collection(lookup, miq_api_class):
+    hrefs = lookup.run(['providers/OpenShift02', {'collection': 'providers', 'name': 'OpenShift01'}, 'users/admin'],
+                       **OPTIONS)
+    assert hrefs == [MANAGEIQ_HOSTNAME + '/api/providers/2', MANAGEIQ_HOSTNAME + '/api/providers/1',
+                     MANAGEIQ_HOSTNAME + '/api/users/3']
+    assert miq_api_class.return_value.get.call_count == 2
+
+
+def test_memoizes_names_for_the_play(lookup, miq_api_class):
+    lookup.run(['providers/OpenShift01'], **OPTIONS)
+    ids = lookup_loader.get('manageiq_resolve').run(['providers/OpenShift01'], **dict(OPTIONS, **{'return': 'id'}))
+    assert ids == ['1']
+    assert miq_api_class.call_count == 1
+    assert miq_api_class.return_value.get.call_count == 1
+
+
+def test_resolved_names_are_cached_across_tasks(miq_api_class, lock_dir):
+    # each task runs the lookup in a new process, with only the cache file in common
+    lookup_loader.get('manageiq_resolve').run(['providers/OpenShift01'], **OPTIONS)
+    assert lock_dir.listdir()[0].basename.endswith('.resolved')
+    hrefs = lookup_loader.get('manageiq_resolve').run(['providers/OpenShift01'], **OPTIONS)
+    assert hrefs == [MANAGEIQ_HOSTNAME + '/api/providers/1']
+    assert miq_api_class.return_value.get.call_count == 1
+
+
+def test_resolved_names_are_cached_per_user(miq_api_class):
+    lookup_loader.get('manageiq_resolve').run(['providers/OpenShift01'], **OPTIONS)
+    lookup_loader.get('manageiq_resolve').run(['providers/OpenShift01'], **dict(OPTIONS, miq_username='Another user'))
+    assert miq_api_class.return_value.get.call_count == 2
+
+
+def test_resolved_names_expire(monkeypatch, miq_api_class):
+    lookup_loader.get('manageiq_resolve').run(['providers/OpenShift01'], **OPTIONS)
+    now = time.time()
+    monkeypatch.setattr(manageiq_resolve.time, 'time', lambda: now + 60)
+    lookup_loader.get('manageiq_resolve').run(['providers/OpenShift01'], **dict(OPTIONS, cache_ttl=30))
+    assert miq_api_class.return_value.get.call_count == 2
+
+
+def test_fails_on_missing_name(lookup):
+    with pytest.raises(manageiq_resolve.AnsibleError):
+        lookup.run(['providers/missing'], **OPTIONS)
+
+
+def test_fails_on_invalid_term(lookup):
+    with pytest.raises(manageiq_resolve.AnsibleError):
+        lookup.run(['OpenShift01'], **OPTIONS)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+
+import pytest
+from mock import Mock
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.manageiq_utils import Snapshot
+
+from manageiq_client.api import ManageIQClient
+import manageiq_snapshot
+
+
+MANAGEIQ_HOSTNAME = "http://themanageiq.tld"
+PROVIDERS = [{'id': str(i), 'name': 'provider{}'.format(i), 'zone_id': '1', 'endpoints': []} for i in range(5)]
+USERS = [{'id': '1', 'userid': 'admin', 'name': 'Administrator', 'current_group_id': '2'}]
+
+
+@pytest.fixture(autouse=True)
+def miq_api_class(monkeypatch):
+    miq_api_class = Mock(spec=ManageIQClient)
+    monkeypatch.setattr("manageiq_snapshot.MiqApi", miq_api_class)
+    yield miq_api_class
+
+
+@pytest.fixture
+def miq_ansible_module():
+    miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
+    yield miq_ansible_module
+
+
+class AnsibleModuleFailed(Exception):
+    pass
+
+
+@pytest.fixture()
+def miq(miq_api_class, miq_ansible_module):
+    def fail(msg):
+        raise AnsibleModuleFailed(msg)
+
+    miq_ansible_module.fail_json = fail
+    miq = manageiq_snapshot.ManageIQSnapshot(
+        miq_ansible_module, MANAGEIQ_HOSTNAME, "The username",
+        "The password", miq_verify_ssl=False, ca_bundle_path=None)
+
+    def get(url):
+        collection = url.split('/api/')[1].split('?')[0]
+        offset = int(url.split('offset=')[1].split('&')[0])
+        limit = int(url.split('limit=')[1].split('&')[0])
+        resources = {'providers': PROVIDERS, 'users': USERS}[collection]
+        return dict(resources=resources[offset:offset + limit], subcount=len(resources))
+
+    miq_api_class.return_value.get.side_effect = get
+    yield miq
+
+
+def test_export_pages_through_collections(miq, tmpdir):
+    path = str(tmpdir.join('snapshot.jsonl.gz'))
+    result = miq.export(path, ['providers', 'users'], 2)
+    assert result == {
+        'changed': True,
+        'msg': "Successfully wrote snapshot {}".format(path),
+        'path': path,
+        'counts': {'providers': 5, 'users': 1}
+    }
+    # 3 pages of providers, a single page of users
+    assert miq.client.get.call_count == 4
+    assert '/api/providers?expand=resources,tags,policies,policy_profiles,custom_attributes&attributes=endpoints&offset=4&limit=2' in \
+        miq.client.get.call_args_list[2][0][0]
+
+    with gzip.open(path, 'rb') as snapshot_file:
+        lines = [json.loads(line.decode('utf-8')) for line in snapshot_file]
+    assert lines[0]['snapshot']['collections'] == ['providers', 'users']
+    assert lines[1] == {'collection': 'providers', 'resource': PROVIDERS[0]}
+    assert len(lines) == 7
+
+
+def test_snapshot_reads_exported_resources(miq, tmpdir):
+    path = str(tmpdir.join('snapshot.jsonl.gz'))
+    miq.export(path, ['providers', 'users'], 100)
+
+    snapshot = Snapshot(path)
+    assert snapshot.resources('providers') == PROVIDERS
+    assert snapshot.find('providers', name='provider3') == PROVIDERS[3]
+    assert snapshot.find('providers', name='nope') is None
+    assert snapshot.get('users', 1) == USERS[0]
+    snapshot.require(['users'])
+    with pytest.raises(ValueError):
+        snapshot.require(['alert_definitions'])
+
+
+def test_export_in_check_mode_writes_nothing(miq, miq_ansible_module, tmpdir):
+    miq_ansible_module.check_mode = True
+    path = str(tmpdir.join('snapshot.jsonl.gz'))
+    result = miq.export(path, ['users'], 100)
+    assert result['changed'] is True
+    assert result['counts'] == {'users': 1}
+    assert tmpdir.listdir() == []
@@ -32,6 +32,8 @@ def the_provider():
 @pytest.fixture
 def miq_ansible_module():
     miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
     yield miq_ansible_module
 
 
@@ -84,3 +86,59 @@ def test_will_assign_tag_on_resource_if_not_assigned(miq, miq_api_class, the_pro
         '{}/api/providers/1/tags'.format(MANAGEIQ_HOSTNAME),
         action='assign', resources=[{'name': TAG_NAME, 'category': CATEGORY_NAME}])
 
+
+
+def test_assign_tag_in_check_mode(miq, miq_api_class, miq_ansible_module, the_provider):
+    miq_ansible_module.check_mode = True
+    miq_ansible_module._diff = True
+    res_args = miq.assign_or_unassign_tag(
+        [{'name': 'prod', 'category': CATEGORY_NAME}],
+        'provider', PROVIDER_NAME, 'present')
+    assert res_args == {
+        "changed": True,
+        "msg": "Tags would be assigned",
+        "diff": {"before": ["/managed/environment/test"],
+                 "after": ["/managed/environment/prod", "/managed/environment/test"]}}
+    assert not miq.client.post.called
+
+
+def test_assign_tag_by_resource_id_skips_lookup(miq, miq_api_class):
+    miq_api_class.return_value.get.return_value = {}
+    miq_api_class.return_value.collections.providers = []
+    res_args = miq.assign_or_unassign_tag(
+        [{'name': TAG_NAME, 'category': CATEGORY_NAME}],
+        'provider', None, 'present', resource_id='27')
+    assert res_args == {
+        "changed": True,
+        "msg": "Successfully assigned tags"}
+    miq.client.post.assert_called_once_with(
+        '{}/api/providers/27/tags'.format(MANAGEIQ_HOSTNAME),
+        action='assign', resources=[{'name': TAG_NAME, 'category': CATEGORY_NAME}])
+
+
+def test_assign_tag_by_resource_id_not_exist(miq, miq_api_class):
+    miq_api_class.return_value.get.side_effect = Exception("ActiveRecord::RecordNotFound: Couldn't find the resource")
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.assign_or_unassign_tag(
+            [{'name': TAG_NAME, 'category': CATEGORY_NAME}],
+            'provider', None, 'present', resource_id='27')
+    assert str(excinfo.value) == "Failed to assign tag: provider 27 does not exist in manageiq"
+    miq.client.get.assert_called_once_with('{}/api/providers/27?attributes=id'.format(MANAGEIQ_HOSTNAME))
+
+
+def test_assign_tag_by_resource_id_query_error(miq, miq_api_class):
+    miq_api_class.return_value.get.side_effect = Exception("The request failed with HTTP status 401: Unauthorized")
+    with pytest.raises(AnsibleModuleFailed) as excinfo:
+        miq.assign_or_unassign_tag(
+            [{'name': TAG_NAME, 'category': CATEGORY_NAME}],
+            'provider', None, 'present', resource_id='27')
+    assert str(excinfo.value) == ("Failed to assign tag: failed to query provider 27: "
+                                  "The request failed with HTTP status 401: Unauthorized")
+
+
+def test_tags_to_execute():
+    tags = [{'category': CATEGORY_NAME, 'name': TAG_NAME}, {'category': CATEGORY_NAME, 'name': 'other'}]
+    assigned = set(['/managed/{}/{}'.format(CATEGORY_NAME, TAG_NAME)])
+    execute = manageiq_tag_assignment.ManageIQTagAssignment.tags_to_execute
+    assert execute(tags, assigned, 'present') == [tags[1]]
+    assert execute(tags, assigned, 'absent') == [tags[0]]
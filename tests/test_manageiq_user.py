@@ -33,7 +33,7 @@ GET_RETURN_VALUES = {
 
 POST_RETURN_VALUES = {
     'created_user': {
-        'results': {
+        'results': [{
             'name': USERNAME,
             'userid': USERID,
             'current_group_id': GROUP_ID,
@@ -41,7 +41,7 @@ POST_RETURN_VALUES = {
             'updated_on': u'2016-11-17T08:56:55Z',
             'id': MANGEIQ_USER_ID,
             'email': EMAIL
-        }
+        }]
     },
     'updated_user': {
         'name': "New Name",
@@ -88,6 +88,8 @@ def miq_api_class(monkeypatch):
 @pytest.fixture
 def miq_ansible_module():
     miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
     yield miq_ansible_module
 
 
@@ -117,8 +119,10 @@ def test_create_user_if_not_exist(miq, miq_api_class, the_group):
 
     result = miq.create_or_update_user(USERID, USERNAME, PASSWORD, GROUP, EMAIL)
     assert result == {
+        'user_id': MANGEIQ_USER_ID,
+        'href': '{hostname}/api/users/{id}'.format(hostname=MANAGEIQ_HOSTNAME, id=MANGEIQ_USER_ID),
         'changed': True,
-        'msg': "Successfully created the user testuser: {}".format(POST_RETURN_VALUES['created_user']['results'])
+        'msg': "Successfully created the user testuser"
     }
     miq.client.post.assert_called_once_with(
         '{hostname}/api/users'.format(hostname=MANAGEIQ_HOSTNAME),
@@ -134,8 +138,11 @@ def test_update_user_email_and_name(miq, miq_api_class, the_user, the_group):
 
     result = miq.create_or_update_user(USERID, "New Name", PASSWORD, GROUP, "newname@example.com")
     assert result == {
+        'user_id': the_user.id,
+        'href': '{hostname}/api/users/{id}'.format(hostname=MANAGEIQ_HOSTNAME, id=the_user.id),
         'changed': True,
-        'msg': "Successfully updated the user testuser: {}".format(POST_RETURN_VALUES['updated_user'])
+        'msg': "Successfully updated the user testuser",
+        'changed_fields': ['email', 'name']
     }
     miq.client.post.assert_called_once_with(
         '{hostname}/api/users/{id}'.format(hostname=MANAGEIQ_HOSTNAME, id=the_user.id),
@@ -144,6 +151,17 @@ def test_update_user_email_and_name(miq, miq_api_class, the_user, the_group):
     )
 
 
+def test_create_user_full_result_detail(miq, miq_api_class, the_group):
+    miq.result_detail = 'full'
+    miq_api_class.return_value.collections.groups = [the_group]
+    miq_api_class.return_value.collections.users = []
+    miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['created_user']
+
+    result = miq.create_or_update_user(USERID, USERNAME, PASSWORD, GROUP, EMAIL)
+    assert result['result'] == POST_RETURN_VALUES['created_user']['results']
+    assert result['msg'] == "Successfully created the user testuser"
+
+
 def test_delete_existing_user(miq, miq_api_class, the_user, the_group):
     miq_api_class.return_value.collections.users = [the_user]
     miq_api_class.return_value.collections.groups = [the_group]
@@ -188,3 +206,44 @@ def test_create_user_with_same_attributes(miq, miq_api_class, the_user, the_grou
         'changed': False,
         'msg': 'User testuser already exist, no need for updates'
     }
+
+
+def test_update_user_in_check_mode(miq, miq_api_class, miq_ansible_module, the_user, the_group):
+    miq_ansible_module.check_mode = True
+    miq_ansible_module._diff = True
+    miq_api_class.return_value.collections.users = [the_user]
+    miq_api_class.return_value.collections.groups = [the_group]
+    miq_api_class.return_value.get.return_value = GET_RETURN_VALUES['user_exist']
+
+    result = miq.create_or_update_user(USERID, USERNAME, PASSWORD, GROUP, "newname@example.com")
+    assert result == {
+        'changed': True,
+        'msg': 'User testuser would be updated',
+        'diff': {'before': {'email': EMAIL}, 'after': {'email': "newname@example.com"}}
+    }
+    assert not miq.client.post.called
+
+
+def test_delete_user_by_id_skips_lookup(miq, miq_api_class):
+    miq_api_class.return_value.collections.users = []
+    miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['deleted_user']
+
+    result = miq.delete_user(USERID, MANGEIQ_USER_ID)
+    assert result['changed']
+    miq.client.post.assert_called_once_with(
+        '{hostname}/api/users/{id}'.format(hostname=MANAGEIQ_HOSTNAME, id=MANGEIQ_USER_ID),
+        action='delete')
+
+
+def test_create_user_by_group_id_skips_group_lookup(miq, miq_api_class):
+    miq_api_class.return_value.collections.users = []
+    miq_api_class.return_value.collections.groups = []
+    miq_api_class.return_value.post.return_value = POST_RETURN_VALUES['created_user']
+
+    result = miq.create_or_update_user(USERID, USERNAME, PASSWORD, None, EMAIL, group_id=GROUP_ID)
+    assert result['changed']
+    miq.client.get.assert_called_once_with('{}/api/groups/{}?attributes=id'.format(MANAGEIQ_HOSTNAME, GROUP_ID))
+    miq.client.post.assert_called_once_with(
+        '{hostname}/api/users'.format(hostname=MANAGEIQ_HOSTNAME),
+        action='create',
+        resource={'userid': USERID, 'name': USERNAME, 'password': PASSWORD, 'group': {'id': GROUP_ID}, 'email': EMAIL})
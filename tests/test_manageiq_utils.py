@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+import glob
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from mock import Mock
+from requests import PreparedRequest, Response
+from requests.exceptions import ConnectionError
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+from ansible.module_utils import manageiq_transport, manageiq_utils
+
+
+MANAGEIQ_API_URL = "http://themanageiq.tld/api"
+
+
+def json_response(data, status_code=200, headers=None):
+    response = Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = json.dumps(data).encode('utf-8')
+    response._content_consumed = True
+    return response
+
+
+@pytest.fixture
+def limiter(tmpdir):
+    yield manageiq_utils.ConcurrencyLimiter(MANAGEIQ_API_URL, 2, str(tmpdir), poll_interval=0.01)
+
+
+def prepared_request(method='GET', body=None):
+    request = PreparedRequest()
+    request.method = method
+    request.body = body
+    return request
+
+
+@pytest.fixture
+def sleep(monkeypatch):
+    sleep = Mock()
+    monkeypatch.setattr(manageiq_utils.time, "sleep", sleep)
+    yield sleep
+
+
+@pytest.fixture
+def http_send(monkeypatch):
+    http_send = Mock(return_value=json_response({}))
+    monkeypatch.setattr(HTTPAdapter, "send", http_send)
+    yield http_send
+
+
+def test_limiter_hands_out_all_slots(limiter):
+    first, first_waited = limiter.acquire()
+    second, second_waited = limiter.acquire()
+    assert first != second
+    assert first_waited < 0.01 and second_waited < 0.01
+    limiter.release(first)
+    limiter.release(second)
+
+
+def test_limiter_is_keyed_by_url(limiter, tmpdir):
+    other = manageiq_utils.ConcurrencyLimiter("http://other.tld/api", 1, str(tmpdir))
+    slots = [limiter.acquire()[0], limiter.acquire()[0]]
+    slot, waited = other.acquire()
+    assert waited < 0.01
+    other.release(slot)
+    for s in slots:
+        limiter.release(s)
+
+
+def test_limiter_waits_for_a_released_slot(limiter):
+    slots = [limiter.acquire()[0], limiter.acquire()[0]]
+
+    def release():
+        time.sleep(0.1)
+        limiter.release(slots[0])
+
+    releaser = threading.Thread(target=release)
+    releaser.start()
+    slot, waited = limiter.acquire()
+    releaser.join()
+    assert waited >= 0.1
+    limiter.release(slot)
+    limiter.release(slots[1])
+
+
+def test_limiter_rejects_non_positive_concurrency(tmpdir):
+    with pytest.raises(ValueError):
+        manageiq_utils.ConcurrencyLimiter(MANAGEIQ_API_URL, 0, str(tmpdir))
+
+
+def test_adapter_counts_requests(http_send):
+    stats = manageiq_utils.new_client_stats()
+    adapter = manageiq_transport.ManageIQAdapter(stats)
+    assert adapter.send(PreparedRequest()) is http_send.return_value
+    assert adapter.send(PreparedRequest()) is http_send.return_value
+    assert stats['requests'] == 2
+
+
+def test_adapter_reports_limiter_wait(http_send):
+    limiter = Mock()
+    limiter.acquire.return_value = ("the slot", 1.5)
+    stats = manageiq_utils.new_client_stats()
+    adapter = manageiq_transport.ManageIQAdapter(stats, limiter=limiter)
+    adapter.send(PreparedRequest())
+    assert stats['concurrency_wait_seconds'] == 1.5
+    limiter.release.assert_called_once_with("the slot")
+
+
+def test_adapter_releases_slot_on_error(http_send):
+    http_send.side_effect = IOError("connection reset")
+    limiter = Mock()
+    limiter.acquire.return_value = ("the slot", 0.0)
+    adapter = manageiq_transport.ManageIQAdapter(manageiq_utils.new_client_stats(), limiter=limiter)
+    with pytest.raises(IOError):
+        adapter.send(PreparedRequest())
+    limiter.release.assert_called_once_with("the slot")
+
+
+def test_client_options_from_params():
+    params = {'miq_max_concurrency': 4, 'miq_lock_dir': '/tmp/locks', 'miq_retries': 2,
+              'miq_retry_backoff': 0.5, 'miq_circuit_breaker_threshold': 5,
+              'miq_circuit_breaker_cooldown': 30, 'miq_worker': True,
+              'miq_record_cassette': '/tmp/run.cassette', 'miq_replay_cassette': None, 'miq_replay_latency': 'none',
+              'miq_metrics_dir': None}
+    assert manageiq_utils.manageiq_client_options(params) == dict(
+        max_concurrency=4, lock_dir='/tmp/locks', retries=2, retry_backoff=0.5,
+        circuit_breaker_threshold=5, circuit_breaker_cooldown=30, worker=True,
+        record_cassette='/tmp/run.cassette', replay_cassette=None, replay_latency='none', metrics_dir=None)
+
+
+def test_client_sends_entry_point_through_adapter(http_send):
+    http_send.return_value = json_response({'name': 'API', 'collections': []})
+    client = manageiq_utils.ManageIQClient(MANAGEIQ_API_URL, ("user", "password"))
+    assert http_send.call_args[0][0].url == MANAGEIQ_API_URL
+    assert client.stats['requests'] == 1
+
+
+@pytest.mark.parametrize("method, body, allowed", [
+    ('GET', None, True),
+    ('POST', json.dumps({'action': 'assign', 'resources': []}), True),
+    ('POST', json.dumps({'action': 'create', 'resource': {}}), False),
+    ('POST', json.dumps({'name': 'provider'}), False),
+    ('DELETE', None, False),
+])
+def test_retry_policy_allows_safe_requests(method, body, allowed):
+    policy = manageiq_utils.RetryPolicy()
+    assert policy.allows(prepared_request(method, body)) == allowed
+
+
+def test_retry_policy_backoff_is_bounded():
+    policy = manageiq_utils.RetryPolicy(backoff=1.0, max_backoff=5.0)
+    assert 0 <= policy.delay(0) <= 1.0
+    assert 0 <= policy.delay(10) <= 5.0
+
+
+def test_retry_policy_honors_retry_after():
+    policy = manageiq_utils.RetryPolicy(backoff=1.0, max_backoff=30.0)
+    assert policy.delay(0, json_response({}, 503, {'Retry-After': '7'})) == 7.0
+    assert policy.delay(0, json_response({}, 503, {'Retry-After': '120'})) == 30.0
+
+
+def test_adapter_retries_transient_errors(http_send, sleep):
+    http_send.side_effect = [json_response({}, 503), ConnectionError("reset"), json_response({'id': 1})]
+    stats = manageiq_utils.new_client_stats()
+    adapter = manageiq_transport.ManageIQAdapter(stats, retry_policy=manageiq_utils.RetryPolicy(retries=3))
+    assert adapter.send(prepared_request()).json() == {'id': 1}
+    assert stats['requests'] == 3
+    assert stats['retries'] == 2
+    assert sleep.call_count == 2
+
+
+def test_adapter_returns_last_response_when_retries_exhausted(http_send, sleep):
+    http_send.side_effect = [json_response({}, 502), json_response({}, 502)]
+    stats = manageiq_utils.new_client_stats()
+    adapter = manageiq_transport.ManageIQAdapter(stats, retry_policy=manageiq_utils.RetryPolicy(retries=1))
+    assert adapter.send(prepared_request()).status_code == 502
+    assert stats['retries'] == 1
+
+
+def test_adapter_does_not_retry_unsafe_requests(http_send, sleep):
+    http_send.side_effect = ConnectionError("reset")
+    stats = manageiq_utils.new_client_stats()
+    adapter = manageiq_transport.ManageIQAdapter(stats, retry_policy=manageiq_utils.RetryPolicy(retries=3))
+    with pytest.raises(ConnectionError):
+        adapter.send(prepared_request('POST', json.dumps({'action': 'create'})))
+    assert stats['requests'] == 1
+    assert not sleep.called
+
+
+def test_circuit_breaker_opens_after_threshold(tmpdir):
+    breaker = manageiq_transport.CircuitBreaker(MANAGEIQ_API_URL, 2, 60, str(tmpdir))
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    with pytest.raises(manageiq_transport.CircuitOpenError):
+        breaker.check()
+
+
+def test_circuit_breaker_is_reset_by_success(tmpdir):
+    breaker = manageiq_transport.CircuitBreaker(MANAGEIQ_API_URL, 2, 60, str(tmpdir))
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.check()
+
+
+def test_circuit_breaker_is_shared_between_clients(tmpdir):
+    manageiq_transport.CircuitBreaker(MANAGEIQ_API_URL, 1, 60, str(tmpdir)).record_failure()
+    with pytest.raises(manageiq_transport.CircuitOpenError):
+        manageiq_transport.CircuitBreaker(MANAGEIQ_API_URL, 1, 60, str(tmpdir)).check()
+
+
+def test_adapter_fails_fast_when_circuit_open(http_send, sleep, tmpdir):
+    http_send.return_value = json_response({}, 503)
+    breaker = manageiq_transport.CircuitBreaker(MANAGEIQ_API_URL, 2, 60, str(tmpdir))
+    adapter = manageiq_transport.ManageIQAdapter(manageiq_utils.new_client_stats(),
+                                             retry_policy=manageiq_utils.RetryPolicy(retries=5),
+                                             breaker=breaker)
+    with pytest.raises(manageiq_transport.CircuitOpenError):
+        adapter.send(prepared_request())
+    assert http_send.call_count == 2
+
+
+def test_client_reads_gzipped_responses(http_send):
+    body = json.dumps({'name': 'API', 'version': '3.0.0', 'collections': []}).encode('utf-8')
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+        gzip_file.write(body)
+
+    def send(request, **kwargs):
+        assert request.headers['Accept-Encoding'] == 'gzip'
+        raw = HTTPResponse(body=io.BytesIO(compressed.getvalue()), headers={'Content-Encoding': 'gzip'},
+                           status=200, preload_content=False)
+        return HTTPAdapter().build_response(request, raw)
+    http_send.side_effect = send
+
+    client = manageiq_transport.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'smartvm'))
+    assert client.version == '3.0.0'
+    assert client.stats['response_bytes'] == len(body)
+    assert client.stats['received_bytes'] == len(compressed.getvalue())
+
+def test_client_records_and_replays_cassette(http_send, tmpdir):
+    cassette = str(tmpdir.join('run.cassette'))
+    http_send.side_effect = [json_response({'name': 'API', 'version': '3.0.0', 'collections': []},
+                                           headers={'X-Auth-Token': 'the token'}),
+                             json_response({'results': [{'id': '1', 'userid': 'dkorn', 'password': 'the password'}]})]
+    client = manageiq_transport.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'smartvm'), record_cassette=cassette)
+    created = client.post(MANAGEIQ_API_URL + '/users', action='create',
+                          resource={'userid': 'dkorn', 'password': 'the password'})
+    with open(cassette) as cassette_file:
+        content = cassette_file.read()
+    assert 'the password' not in content and 'the token' not in content
+    entries = [json.loads(line) for line in content.splitlines()]
+    assert [(entry['method'], entry['url']) for entry in entries] == [('GET', MANAGEIQ_API_URL),
+                                                                      ('POST', MANAGEIQ_API_URL + '/users')]
+    assert json.loads(entries[1]['request_body'])['resource'] == {'userid': 'dkorn', 'password': '********'}
+
+    http_send.reset_mock()
+    http_send.side_effect = ConnectionError("no appliance")
+    replayed = manageiq_transport.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'smartvm'), replay_cassette=cassette)
+    assert replayed.version == '3.0.0'
+    assert replayed.post(MANAGEIQ_API_URL + '/users', action='create',
+                         resource={'userid': 'dkorn'})['results'][0]['id'] == created['results'][0]['id']
+    assert not http_send.called
+    with pytest.raises(manageiq_transport.CassetteError):
+        replayed.get(MANAGEIQ_API_URL + '/users')
+
+def test_resource_id_from_params():
+    assert manageiq_utils.resource_id_from_params({'resource_id': 27, 'href': None}) == '27'
+    assert manageiq_utils.resource_id_from_params(
+        {'resource_id': None, 'href': 'http://themanageiq.tld/api/providers/27'}) == '27'
+    assert manageiq_utils.resource_id_from_params({'resource_id': None, 'href': None}) is None
+
+
+def test_resolve_names_queries_once_with_or_filter():
+    client = Mock()
+    client.get.return_value = {'subcount': 2, 'resources': [
+        {'name': 'a', 'href': MANAGEIQ_API_URL + '/providers/1'},
+        {'name': "b'c", 'href': MANAGEIQ_API_URL + '/providers/2'}]}
+    hrefs = manageiq_utils.resolve_names(client, MANAGEIQ_API_URL, 'providers', ['a', "b'c", 'missing'])
+    assert hrefs == {'a': MANAGEIQ_API_URL + '/providers/1', "b'c": MANAGEIQ_API_URL + '/providers/2'}
+    client.get.assert_called_once_with(
+        MANAGEIQ_API_URL + '/providers?expand=resources&attributes=name'
+        '&filter[]=name%3D%27a%27&filter[]=or%20name%3D%22b%27c%22&filter[]=or%20name%3D%27missing%27'
+        '&offset=0&limit=500')
+
+
+def test_resolve_names_uses_collection_name_attribute():
+    client = Mock()
+    client.get.return_value = {'subcount': 0, 'resources': []}
+    manageiq_utils.resolve_names(client, MANAGEIQ_API_URL, 'users', ['admin'])
+    assert '&attributes=userid&filter[]=userid%3D%27admin%27&' in client.get.call_args[0][0]
+
+
+def test_modules_import_client_lazily():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    modules = [os.path.basename(path)[:-3] for path in glob.glob(os.path.join(root, 'library', 'manageiq_*.py'))]
+    code = (
+        "import sys\n"
+        "import ansible.module_utils\n"
+        "ansible.module_utils.__path__.append({module_utils!r})\n"
+        "sys.path.insert(0, {library!r})\n"
+        "import {modules}\n"
+        "print(sorted(m for m in ('manageiq_client', 'requests') if m in sys.modules))\n"
+    ).format(module_utils=os.path.join(root, 'module_utils'), library=os.path.join(root, 'library'),
+             modules=', '.join(modules))
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.decode('utf-8').strip() == '[]'
+
+
+def test_load_snapshot_of_another_appliance_fails(tmpdir):
+    path = str(tmpdir.join('snapshot.jsonl.gz'))
+    with gzip.open(path, 'wb') as snapshot_file:
+        header = {'snapshot': {'miq_url': 'https://miq1.example.com', 'collections': ['users']}}
+        snapshot_file.write((json.dumps(header) + '\n').encode('utf-8'))
+    module = Mock()
+    module.check_mode = True
+    module.params = {'snapshot_path': path, 'miq_url': 'https://miq1.example.com/'}
+
+    def fail_json(**kwargs):
+        raise ModuleFailed(kwargs)
+    module.fail_json.side_effect = fail_json
+
+    assert manageiq_utils.load_snapshot(module, ['users']).header['miq_url'] == 'https://miq1.example.com'
+    module.params['miq_url'] = 'https://miq2.example.com'
+    with pytest.raises(ModuleFailed) as e:
+        manageiq_utils.load_snapshot(module, ['users'])
+    assert e.value.args[0]['msg'] == "Failed to load snapshot {path}: the snapshot was exported from " \
+        "https://miq1.example.com, not from https://miq2.example.com".format(path=path)
+
+
+def test_certificate_fingerprint_ignores_line_endings():
+    certificate = '-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----\n'
+    assert manageiq_utils.certificate_fingerprint(certificate.replace('\n', '\r\n') + '  \n') == \
+        manageiq_utils.certificate_fingerprint(certificate)
+    assert manageiq_utils.certificate_fingerprint(certificate.replace('MIIB', 'MIIC')) != \
+        manageiq_utils.certificate_fingerprint(certificate)
+    assert manageiq_utils.certificate_fingerprint(None) is None
+
+
+def test_fingerprint_store_in_check_mode_only_reads(tmpdir):
+    manageiq_utils.FingerprintStore(MANAGEIQ_API_URL, str(tmpdir)).record('alert', 'the alert', 'fingerprint', '1')
+    before = dict((path.basename, path.read()) for path in tmpdir.visit() if path.isfile())
+
+    store = manageiq_utils.FingerprintStore(MANAGEIQ_API_URL, str(tmpdir), check_mode=True)
+    assert store.lookup('alert', 'the alert', 'fingerprint') == '1'
+    store.record('alert', 'another alert', 'fingerprint', '2')
+    store.forget('alert', 'the alert')
+    assert dict((path.basename, path.read()) for path in tmpdir.visit() if path.isfile()) == before
+
+    manageiq_utils.FingerprintStore(MANAGEIQ_API_URL, str(tmpdir.join('missing')), check_mode=True)
+    assert not tmpdir.join('missing').exists()
+
+
+def test_read_certificate_caches_by_mtime(tmpdir, monkeypatch):
+    monkeypatch.setattr(manageiq_utils, 'CERTIFICATES', {})
+    ca_file = tmpdir.join('ca.crt')
+    ca_file.write('first\r\n')
+    assert manageiq_utils.read_certificate(str(ca_file)) == 'first\n'
+    assert len(manageiq_utils.CERTIFICATES) == 1
+    assert manageiq_utils.read_certificate(str(ca_file)) == 'first\n'
+    assert len(manageiq_utils.CERTIFICATES) == 1
+
+    ca_file.write('second\n')
+    os.utime(str(ca_file), (time.time() + 10, time.time() + 10))
+    assert manageiq_utils.read_certificate(str(ca_file)) == 'second\n'
+
+
+def test_parse_version():
+    assert manageiq_utils.parse_version('2.4.0') == (2, 4, 0)
+    assert manageiq_utils.parse_version('3.0.0-pre') == (3, 0, 0)
+    assert manageiq_utils.parse_version(None) is None
+    assert manageiq_utils.parse_version(Mock()) is None
+
+
+def test_capabilities_from_client_entry_point(tmpdir):
+    client = Mock(version='2.3.0', server_info={'version': '5.7.0.17'})
+    capabilities = manageiq_utils.Capabilities(client, MANAGEIQ_API_URL, str(tmpdir))
+    assert capabilities.supports('endpoint_certificate_authority') is False
+    assert capabilities.info['server_version'] == '5.7.0.17'
+    assert not client.get.called
+
+    # a client which didn't load the entry point uses the cached capabilities
+    cached = manageiq_utils.Capabilities(Mock(), MANAGEIQ_API_URL, str(tmpdir))
+    assert cached.api_version == (2, 3, 0)
+    expired = manageiq_utils.Capabilities(Mock(), MANAGEIQ_API_URL, str(tmpdir), ttl=0)
+    assert expired.supports('endpoint_certificate_authority') is None
+
+
+def test_refresh_queue(tmpdir):
+    queue = manageiq_utils.RefreshQueue(MANAGEIQ_API_URL, str(tmpdir))
+    queue.add(3)
+    queue.add('4')
+    queue.add('3')
+    assert queue.peek() == ['3', '4']
+    assert queue.drain() == ['3', '4']
+    assert queue.peek() == []
+
+
+def test_refresh_scheduler_releases_slot_of_failed_refresh(tmpdir):
+    client = Mock()
+    client.post.side_effect = [Exception("Not found"), {'success': True}]
+    scheduler = manageiq_utils.RefreshScheduler(MANAGEIQ_API_URL, 1, str(tmpdir), poll_interval=0)
+    refreshes = scheduler.refresh_all(client, MANAGEIQ_API_URL, ['1', '2'])
+    assert [(r['state'], r['message']) for r in refreshes] == [('Failed', 'Not found'), ('Queued', None)]
+    assert not client.get.called
+
+
+class ModuleFailed(Exception):
+    pass
+
+
+@pytest.fixture
+def appliances_module():
+    module = Mock()
+    module.params = {'miq_url': None, 'miq_username': 'admin', 'miq_password': 'smartvm', 'miq_verify_ssl': True,
+                     'ca_bundle_path': None, 'miq_appliances_concurrency': 4,
+                     'miq_appliances': [{'name': 'region1', 'miq_url': 'https://miq1.example.com'},
+                                        {'name': 'region2', 'miq_url': 'https://miq2.example.com',
+                                         'miq_password': 'other', 'miq_verify_ssl': 'no'}]}
+    module.no_log_values = set()
+
+    def fail_json(**kwargs):
+        raise ModuleFailed(kwargs)
+
+    module.fail_json.side_effect = fail_json
+    yield module
+
+
+def test_appliance_connections_default_to_module_params(appliances_module):
+    connections = manageiq_utils.appliance_connections(appliances_module)
+    assert [(c['name'], c['miq_username'], c['miq_password'], c['miq_verify_ssl']) for c in connections] == [
+        ('region1', 'admin', 'smartvm', True), ('region2', 'admin', 'other', False)]
+    assert appliances_module.no_log_values == {'other'}
+
+
+def test_appliance_connections_fail_on_missing_url(appliances_module):
+    appliances_module.params['miq_appliances'].append({'name': 'region3'})
+    with pytest.raises(ModuleFailed) as e:
+        manageiq_utils.appliance_connections(appliances_module)
+    assert e.value.args[0]['msg'] == "missing required argument: miq_url"
+
+
+def test_run_on_appliances_reports_per_region(appliances_module):
+    threads = set()
+
+    def apply(module, connection):
+        threads.add(threading.current_thread().name)
+        if connection['name'] == 'region2':
+            module.fail_json(msg="Failed to create alert")
+        return dict(changed=True, msg="Successfully created alert",
+                    api_stats=dict(manageiq_utils.new_client_stats(), requests=2))
+
+    with pytest.raises(ModuleFailed) as e:
+        manageiq_utils.run_on_appliances(appliances_module, apply)
+    result = e.value.args[0]
+    assert result['msg'] == "Failed on 1 of 2 appliances: region2"
+    assert result['changed']
+    assert result['regions']['region1']['msg'] == "Successfully created alert"
+    assert result['regions']['region2'] == {'failed': True, 'msg': "Failed to create alert"}
+    assert result['api_stats']['requests'] == 2
+    assert threading.current_thread().name not in threads
+
+    appliances_module.params['miq_appliances'].pop()
+    assert manageiq_utils.run_on_appliances(appliances_module, apply)['msg'] == "Applied to 1 appliances"
+
+
+def test_run_on_single_appliance(appliances_module):
+    appliances_module.params.update(miq_appliances=None, miq_url='https://miq.example.com')
+    result = manageiq_utils.run_on_appliances(appliances_module, lambda module, connection: dict(
+        changed=False, url=connection['miq_url'], module=module))
+    assert result == dict(changed=False, url='https://miq.example.com', module=appliances_module)
+
+
+
+def test_profiled_module_run(monkeypatch, tmpdir):
+    from ansible.module_utils.basic import AnsibleModule
+    monkeypatch.setenv('MIQ_PROFILE', 'cpu,memory')
+    monkeypatch.setenv('MIQ_PROFILE_DIR', str(tmpdir))
+    results = []
+
+    def exit_json(self, **kwargs):
+        results.append(kwargs)
+    monkeypatch.setattr(AnsibleModule, 'exit_json', exit_json)
+
+    def main():
+        json.loads(json.dumps([{'id': str(i)} for i in range(1000)]))
+        AnsibleModule.exit_json(None, changed=False)
+
+    manageiq_utils.profiled('manageiq_alert', main)()
+    assert results[0]['changed'] is False
+    assert results[0]['profile'].startswith('cpu ')
+    assert 'memory peak' in results[0]['profile']
+    assert sorted(path.ext for path in tmpdir.listdir()) == ['.pstats', '.txt']
+    assert AnsibleModule.exit_json is exit_json
+
+
+def test_module_run_not_profiled_by_default(monkeypatch):
+    monkeypatch.delenv('MIQ_PROFILE', raising=False)
+    assert manageiq_utils.profiled('manageiq_alert', lambda: 'the result')() == 'the result'
+
+
+def test_traced_module_run(monkeypatch, tmpdir, http_send):
+    from ansible.module_utils.basic import AnsibleModule
+    monkeypatch.delenv('MIQ_PROFILE', raising=False)
+    monkeypatch.setenv('MIQ_TRACE_DIR', str(tmpdir))
+    http_send.return_value = json_response({'name': 'API', 'collections': []})
+    results = []
+    monkeypatch.setattr(AnsibleModule, 'fail_json', lambda self, **kwargs: results.append(kwargs))
+
+    @manageiq_utils.traced
+    def find_zone_by_name(name):
+        manageiq_transport.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'smartvm'))
+
+    def main():
+        find_zone_by_name('default')
+        AnsibleModule.fail_json(None, msg="Failed")
+
+    manageiq_utils.profiled('manageiq_provider', main)()
+    with open(results[0]['trace']) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    assert [(event['name'], event['cat']) for event in events] == [
+        ('manageiq_provider', 'main'), ('find_zone_by_name', 'module'), ('GET /api', 'http'), ('decode json', 'json')]
+    assert events[2]['args']['status'] == 200
+    assert events[0]['ts'] <= events[1]['ts'] and events[1]['dur'] <= events[0]['dur']
+    assert not manageiq_utils.TRACER.enabled
+
+
+def test_metrics_endpoint():
+    assert manageiq_utils.metrics_endpoint('/api/providers/12/authentications/') == '/api/providers/:id/authentications'
+    assert manageiq_utils.metrics_endpoint('/api/providers') == '/api/providers'
+    assert manageiq_utils.metrics_endpoint('/api/') == '/api'
+
+
+def test_metrics_textfile_of_module_runs(monkeypatch, tmpdir, http_send):
+    from ansible.module_utils.basic import AnsibleModule
+    monkeypatch.delenv('MIQ_PROFILE', raising=False)
+    monkeypatch.delenv('MIQ_TRACE_DIR', raising=False)
+    http_send.return_value = json_response({'name': 'API', 'collections': []})
+    monkeypatch.setattr(AnsibleModule, 'exit_json', lambda self, **kwargs: None)
+    monkeypatch.setattr(AnsibleModule, 'fail_json', lambda self, **kwargs: None)
+
+    def main(changed):
+        client = manageiq_utils.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'smartvm'), metrics_dir=str(tmpdir))
+        client.get(MANAGEIQ_API_URL + '/providers/12')
+        manageiq_utils.METRICS.observe('manageiq_bulk_batch_size', 20, operation='tags_assign', collection='vms')
+        AnsibleModule.exit_json(None, changed=changed)
+
+    manageiq_utils.profiled('manageiq_provider', lambda: main(True))()
+    manageiq_utils.profiled('manageiq_provider', lambda: main(False))()
+    assert not manageiq_utils.METRICS.enabled
+    assert sorted(path.basename for path in tmpdir.listdir()) == ['manageiq_ansible.prom', 'manageiq_ansible.state.json']
+    lines = tmpdir.join('manageiq_ansible.prom').read().splitlines()
+    assert 'manageiq_module_runs_total{module="manageiq_provider",result="changed"} 1' in lines
+    assert 'manageiq_module_runs_total{module="manageiq_provider",result="ok"} 1' in lines
+    assert 'manageiq_module_requests_bucket{module="manageiq_provider",le="2"} 2' in lines
+    assert ('manageiq_api_request_duration_seconds_count{appliance="themanageiq.tld",endpoint="/api/providers/:id",'
+            'method="GET"} 2') in lines
+    assert 'manageiq_bulk_batch_size_bucket{collection="vms",operation="tags_assign",le="10"} 0' in lines
+    assert 'manageiq_bulk_batch_size_bucket{collection="vms",operation="tags_assign",le="25"} 2' in lines
+    assert 'manageiq_bulk_batch_size_sum{collection="vms",operation="tags_assign"} 40' in lines
+    assert '# TYPE manageiq_module_runs_total counter' in lines
+
+
+def test_metrics_of_concurrent_runs_add_up(tmpdir):
+    script = (
+        "import sys; import ansible.module_utils; ansible.module_utils.__path__.append(sys.argv[1]); "
+        "from ansible.module_utils.manageiq_utils import METRICS; "
+        "METRICS.start(sys.argv[2]); METRICS.count_requests(3); METRICS.write('manageiq_alert', 'ok', 1.0)")
+    module_utils = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils')
+    processes = [subprocess.Popen([sys.executable, '-c', script, module_utils, str(tmpdir)]) for _ in range(8)]
+    assert [process.wait() for process in processes] == [0] * 8
+    lines = tmpdir.join('manageiq_ansible.prom').read().splitlines()
+    assert 'manageiq_module_runs_total{module="manageiq_alert",result="ok"} 8' in lines
+    assert 'manageiq_module_requests_sum{module="manageiq_alert"} 24' in lines
+
+
+def test_resource_exists_only_false_on_not_found():
+    client = Mock()
+    client.get.return_value = {'id': '1'}
+    assert manageiq_utils.resource_exists(client, MANAGEIQ_API_URL, 'providers', '1')
+    client.get.side_effect = Exception("ActiveRecord::RecordNotFound: Couldn't find ExtManagementSystem with 'id'=1")
+    assert not manageiq_utils.resource_exists(client, MANAGEIQ_API_URL, 'providers', '1')
+    for error in (Exception("The request failed with HTTP status 403: Forbidden"),
+                  ConnectionError("Connection timed out"),
+                  manageiq_transport.CircuitOpenError("circuit open")):
+        client.get.side_effect = error
+        with pytest.raises(type(error)):
+            manageiq_utils.resource_exists(client, MANAGEIQ_API_URL, 'providers', '1')
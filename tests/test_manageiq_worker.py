@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from ansible.module_utils import manageiq_utils, manageiq_worker
+
+
+MANAGEIQ_API_URL = "http://themanageiq.tld/api"
+
+RESOURCES = {
+    'providers': [{'id': '1', 'name': 'OpenShift01', 'href': MANAGEIQ_API_URL + '/providers/1'}],
+}
+
+
+class FakeClient(object):
+    """ Answers like the appliance, and remembers the clients created
+    """
+
+    created = []
+
+    def __init__(self, entry_point, auth, **options):
+        if auth[1] != 'password':
+            raise Exception("Authentication failed")
+        self.entry_point = entry_point
+        self.options = options
+        self.stats = manageiq_utils.new_client_stats()
+        self.urls = []
+        FakeClient.created.append(self)
+
+    def get(self, url, **params):
+        self.stats['requests'] += 1
+        self.urls.append(url)
+        collection = url[len(self.entry_point) + 1:].split('?')[0]
+        resources = RESOURCES.get(collection, [])
+        return {'subcount': len(resources), 'resources': resources}
+
+    def post(self, url, **payload):
+        self.stats['requests'] += 1
+        self.urls.append(url)
+        return {'results': [{'success': True, 'payload': payload}]}
+
+
+@pytest.fixture
+def lock_dir(tmpdir):
+    yield str(tmpdir)
+
+
+@pytest.fixture
+def server(lock_dir):
+    FakeClient.created = []
+    server = manageiq_worker.WorkerServer(manageiq_worker.worker_socket_path(lock_dir), FakeClient,
+                                          idle_timeout=0.5, cache_ttl=60)
+    thread = threading.Thread(target=server.serve_until_idle, kwargs=dict(poll_interval=0.05))
+    thread.start()
+    yield server
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_sends_requests_through_worker(server, lock_dir):
+    client = manageiq_utils.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'password'), worker=True, lock_dir=lock_dir,
+                                           retries=2)
+    assert isinstance(client, manageiq_worker.WorkerClient)
+    assert client.get(MANAGEIQ_API_URL + '/zones?expand=resources')['subcount'] == 0
+    result = client.post(MANAGEIQ_API_URL + '/providers', action='create', name='OpenShift02')
+    assert result['results'][0]['payload'] == {'action': 'create', 'name': 'OpenShift02'}
+    assert client.stats['requests'] == 2
+    assert FakeClient.created[0].options == dict(lock_dir=lock_dir, retries=2)
+    client.close()
+
+
+def wait_for_disconnection(server):
+    """ Waits for the worker to release the clients of the closed connections
+    """
+    deadline = time.time() + 5
+    while server.connections and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_reuses_warm_clients_and_cached_collections(server, lock_dir):
+    for _ in range(2):
+        client = manageiq_worker.WorkerClient(manageiq_worker.worker_socket_path(lock_dir), MANAGEIQ_API_URL,
+                                              ('admin', 'password'))
+        assert [(p.id, p.name) for p in client.collections.providers] == [('1', 'OpenShift01')]
+        client.close()
+        wait_for_disconnection(server)
+    assert len(FakeClient.created) == 1
+    assert FakeClient.created[0].urls == [MANAGEIQ_API_URL + '/providers?expand=resources&offset=0&limit=1000']
+    assert client.stats['requests'] == 0
+
+
+def test_post_drops_cached_collections(server, lock_dir):
+    client = manageiq_worker.WorkerClient(manageiq_worker.worker_socket_path(lock_dir), MANAGEIQ_API_URL,
+                                          ('admin', 'password'))
+    list(client.collections.providers)
+    client.post(MANAGEIQ_API_URL + '/providers', action='create', name='OpenShift02')
+    list(client.collections.providers)
+    assert client.stats['requests'] == 3
+    client.close()
+
+
+def test_reports_client_errors(server, lock_dir):
+    with pytest.raises(manageiq_worker.WorkerError) as e:
+        manageiq_worker.WorkerClient(manageiq_worker.worker_socket_path(lock_dir), MANAGEIQ_API_URL,
+                                     ('admin', 'wrong'))
+    assert 'Authentication failed' in str(e.value)
+
+
+def test_falls_back_to_direct_client(lock_dir, monkeypatch):
+    from ansible.module_utils import manageiq_transport
+    monkeypatch.setattr(manageiq_transport, 'ManageIQClient', FakeClient)
+    client = manageiq_utils.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'password'), worker=True, lock_dir=lock_dir)
+    assert isinstance(client, FakeClient)
+
+
+def test_raises_appliance_errors_through_worker(server, lock_dir):
+    with pytest.raises(manageiq_worker.WorkerRequestError) as e:
+        manageiq_utils.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'wrong'), worker=True, lock_dir=lock_dir)
+    assert 'Authentication failed' in str(e.value)
+
+
+def test_falls_back_from_socket_of_another_user(server, lock_dir, monkeypatch):
+    from ansible.module_utils import manageiq_transport
+    monkeypatch.setattr(manageiq_transport, 'ManageIQClient', FakeClient)
+    uid = os.getuid()
+    monkeypatch.setattr(manageiq_worker.os, 'getuid', lambda: uid + 1)
+    client = manageiq_utils.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'password'), worker=True, lock_dir=lock_dir)
+    assert isinstance(client, FakeClient)
+
+
+def test_falls_back_from_worker_closing_the_connection(lock_dir, monkeypatch):
+    from ansible.module_utils import manageiq_transport
+    monkeypatch.setattr(manageiq_transport, 'ManageIQClient', FakeClient)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(manageiq_worker.worker_socket_path(lock_dir))
+    listener.listen(1)
+
+    def close_connection():
+        connection, _ = listener.accept()
+        connection.close()
+    thread = threading.Thread(target=close_connection)
+    thread.start()
+    try:
+        client = manageiq_utils.ManageIQClient(MANAGEIQ_API_URL, ('admin', 'password'), worker=True, lock_dir=lock_dir)
+    finally:
+        thread.join(5)
+        listener.close()
+    assert isinstance(client, FakeClient)
+
+
+def test_refuses_second_worker(server, lock_dir):
+    with pytest.raises(manageiq_worker.WorkerError):
+        manageiq_worker.WorkerServer(manageiq_worker.worker_socket_path(lock_dir), FakeClient)
+
+
+def test_refuses_socket_directory_writable_by_others(server, lock_dir):
+    os.chmod(lock_dir, 0o777)
+    try:
+        with pytest.raises(manageiq_worker.WorkerError) as e:
+            manageiq_worker.WorkerClient(manageiq_worker.worker_socket_path(lock_dir), MANAGEIQ_API_URL,
+                                         ('admin', 'password'))
+    finally:
+        os.chmod(lock_dir, 0o700)
+    assert 'not be writable by others' in str(e.value)
+    assert not FakeClient.created
+
+
+def test_refuses_socket_of_another_user(server, lock_dir, monkeypatch):
+    uid = os.getuid()
+    monkeypatch.setattr(manageiq_worker.os, 'getuid', lambda: uid + 1)
+    with pytest.raises(manageiq_worker.WorkerError):
+        manageiq_worker.WorkerClient(manageiq_worker.worker_socket_path(lock_dir), MANAGEIQ_API_URL,
+                                     ('admin', 'password'))
+    assert not FakeClient.created
+
+
+def test_socket_in_private_directory(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmpdir))
+    socket_path = manageiq_worker.worker_socket_path(manageiq_utils.DEFAULT_LOCK_DIR)
+    assert socket_path == os.path.join(str(tmpdir), 'manageiq-ansible', 'worker.sock')
+    assert manageiq_worker.worker_socket_path(str(tmpdir.join('locks'))) == str(tmpdir.join('locks', 'worker.sock'))
+    server = manageiq_worker.WorkerServer(socket_path, FakeClient)
+    server.server_close()
+    assert stat.S_IMODE(os.stat(os.path.dirname(socket_path)).st_mode) == 0o700
+
+
+def test_collection_read_during_post_is_not_cached(server):
+    class ReadDuringPost(FakeClient):
+        def get(self, url, **params):
+            server.invalidate('session')
+            return FakeClient.get(self, url, **params)
+
+    client = ReadDuringPost(MANAGEIQ_API_URL, ('admin', 'password'))
+    assert server.collection('session', client, MANAGEIQ_API_URL, 'providers') == RESOURCES['providers']
+    assert ('session', 'providers') not in server.collections
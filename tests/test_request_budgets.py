@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+""" Request budgets of the module scenarios: each scenario runs a module
+through the real ManageIQ client and transport against a fake appliance,
+and asserts the number of API requests it sent, so that an extra request per
+item (e.g. a GET per tag or a POST per custom attribute) fails a test instead
+of slowing down production runs.
+"""
+import json
+
+import pytest
+from mock import Mock
+from requests import Response
+from requests.adapters import HTTPAdapter
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.six.moves.urllib.parse import parse_qs, urlsplit
+
+import manageiq_alert
+import manageiq_alert_profile
+import manageiq_custom_attributes
+import manageiq_provider
+import manageiq_tag_assignment
+import manageiq_user
+
+
+MANAGEIQ_HOSTNAME = "http://themanageiq.tld"
+API_URL = MANAGEIQ_HOSTNAME + "/api"
+PROVIDER_HOSTNAME = "some-provider-hostname.tld"
+AUTHENTICATION = {'authtype': 'bearer', 'status': 'Valid', 'status_details': 'Ok',
+                  'last_valid_on': '2020-09-22T11:00:30Z'}
+ALERT_EXPRESSION = {'eval_method': 'dwh_generic', 'mode': 'internal', 'options': {}}
+ALERT_OPTIONS = {'notifications': {'delay_next_evaluation': 600, 'evm_event': {}}}
+
+
+def resource(collection, resource_id, **attributes):
+    return dict(attributes, id=str(resource_id), href='{api_url}/{collection}/{id}'.format(
+        api_url=API_URL, collection=collection, id=resource_id))
+
+
+class FakeAppliance(object):
+    """ Answers the requests of the client from the resources of each
+    collection, and every POST with a successful action, recording the
+    requests it answered.
+
+    collections - the resources of each collection, by collection name
+    """
+
+    def __init__(self, collections):
+        self.collections = collections
+        self.requests    = []
+        self.on_post     = None
+
+    def respond(self, request, data):
+        response = Response()
+        response.status_code = 200
+        response._content = json.dumps(data).encode('utf-8')
+        response._content_consumed = True
+        response.request = request
+        response.url = request.url
+        return response
+
+    def find(self, collection, resource_id):
+        return next(r for r in self.collections[collection] if r['id'] == str(resource_id))
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        path = url.path.rstrip('/').split('/')[2:]
+        self.requests.append((request.method, url.path))
+        if request.method == 'POST':
+            payload = json.loads(request.body.decode('utf-8') if isinstance(request.body, bytes) else request.body)
+            if self.on_post:
+                self.on_post(path, payload)
+            resources = payload.get('resources') or [payload.get('resource', {})]
+            return self.respond(request, dict(success=True, message="{0} done".format(payload.get('action')),
+                                              results=[dict(r, success=True, id=str(i)) for i, r in enumerate(resources)]))
+        query = parse_qs(url.query)
+        if not path:
+            return self.respond(request, {'name': 'API', 'version': '3.0.0', 'server_info': {'version': 'master'},
+                                          'collections': [{'name': name, 'href': API_URL + '/' + name, 'description': name}
+                                                          for name in self.collections]})
+        if len(path) == 1:
+            resources = self.collections[path[0]]
+            if 'resources' not in query.get('expand', [''])[0]:
+                resources = [{'href': r['href']} for r in resources]
+            return self.respond(request, {'name': path[0], 'count': len(resources), 'subcount': len(resources),
+                                          'resources': resources})
+        found = self.find(path[0], path[1])
+        if len(path) == 3:
+            subresources = found.get(path[2], [])
+            return self.respond(request, {'name': path[2], 'count': len(subresources), 'subcount': len(subresources),
+                                          'resources': subresources})
+        return self.respond(request, found)
+
+
+@pytest.fixture
+def appliance(monkeypatch):
+    appliance = FakeAppliance({
+        'zones': [resource('zones', 1, name='default')],
+        'providers': [resource('providers', 134, name='openshift01', zone_id='1',
+                               endpoints=[{'role': 'default', 'hostname': PROVIDER_HOSTNAME, 'port': 8443,
+                                           'verify_ssl': False, 'certificate_authority': None,
+                                           'security_protocol': 'ssl-without-validation'}],
+                               authentications=[dict(AUTHENTICATION)],
+                               tags=[{'name': '/managed/environment/prod', 'id': '1'}],
+                               custom_attributes=[])],
+        'alert_definitions': [resource('alert_definitions', i, description='Alert {0}'.format(i), db='ContainerNode',
+                                       enabled=True, expression_type='miq_expression',
+                                       expression={'exp': ALERT_EXPRESSION, 'context_type': None},
+                                       options=ALERT_OPTIONS) for i in range(50)],
+        'alert_definition_profiles': [resource('alert_definition_profiles', 1, description='Node Alerts', mode='ContainerNode',
+                                               alert_definitions=[])],
+        'vms': [resource('vms', i, name='vm{0}'.format(i), custom_attributes=[
+            {'name': 'cost_center', 'value': '1001' if i % 2 else '2002', 'section': 'metadata', 'id': str(i),
+             'href': API_URL + '/vms/{0}/custom_attributes/{0}'.format(i)}]) for i in range(20)],
+        'groups': [resource('groups', 2, description='EvmGroup-user')],
+        'users': [resource('users', 3, userid='bob', name='Bob', email='bob@example.com', current_group_id='2')],
+    })
+    monkeypatch.setattr(HTTPAdapter, 'send', Mock(side_effect=appliance.send))
+    yield appliance
+
+
+@pytest.fixture
+def miq_ansible_module():
+    miq_ansible_module = Mock(spec=AnsibleModule)
+    miq_ansible_module.check_mode = False
+    miq_ansible_module._diff = False
+
+    def fail(msg, **kwargs):
+        raise AssertionError(msg)
+    miq_ansible_module.fail_json = fail
+    yield miq_ansible_module
+
+
+@pytest.fixture
+def client_options(tmpdir):
+    yield dict(lock_dir=str(tmpdir), retries=0)
+
+
+def assert_requests(manageiq, appliance, budget):
+    assert manageiq.client.stats['requests'] == len(appliance.requests)
+    assert len(appliance.requests) <= budget, appliance.requests
+
+
+@pytest.fixture
+def provider(appliance, miq_ansible_module, client_options):
+    yield manageiq_provider.ManageIQProvider(miq_ansible_module, MANAGEIQ_HOSTNAME, 'admin', 'smartvm',
+                                             False, None, client_options)
+
+
+def openshift_endpoints(provider, hostname):
+    return [provider.generate_auth_key_config('default', 'bearer', hostname, 8443, 'token', False, None)]
+
+
+def test_provider_unchanged(provider, appliance):
+    result = provider.add_or_update_provider('openshift01', 'openshift', openshift_endpoints(provider, PROVIDER_HOSTNAME),
+                                             'default', None)
+    assert not result['changed']
+    # the entry point, the zones, the providers and the provider endpoints
+    assert_requests(provider, appliance, 4)
+
+
+def test_provider_update(provider, appliance):
+    def validate(path, payload):
+        if payload.get('action') == 'edit':
+            appliance.find('providers', 134)['authentications'] = [dict(AUTHENTICATION, last_valid_on='2020-09-23T11:00:30Z')]
+    appliance.on_post = validate
+    result = provider.add_or_update_provider('openshift01', 'openshift', openshift_endpoints(provider, 'other-hostname.tld'),
+                                             'default', None)
+    assert result['changed']
+    # besides the reads, the authentications before and after the edit, the
+    # edit and the refresh
+    assert_requests(provider, appliance, 8)
+
+
+@pytest.fixture
+def tag_assignment(appliance, miq_ansible_module, client_options):
+    yield manageiq_tag_assignment.ManageIQTagAssignment(miq_ansible_module, MANAGEIQ_HOSTNAME, 'admin', 'smartvm',
+                                                        False, None, client_options)
+
+
+def test_tag_already_assigned(tag_assignment, appliance):
+    result = tag_assignment.assign_or_unassign_tag([{'category': 'environment', 'name': 'prod'}],
+                                                   'provider', 'openshift01', 'present')
+    assert not result['changed']
+    # the entry point, the providers and the provider tags
+    assert_requests(tag_assignment, appliance, 3)
+
+
+def test_many_tags_assigned(tag_assignment, appliance):
+    tags = [{'category': 'environment', 'name': 'tag{0}'.format(i)} for i in range(50)]
+    result = tag_assignment.assign_or_unassign_tag(tags, 'provider', 'openshift01', 'present')
+    assert result['changed']
+    # all the tags are assigned in a single POST
+    assert_requests(tag_assignment, appliance, 4)
+
+
+@pytest.fixture
+def custom_attributes(appliance, miq_ansible_module, client_options):
+    yield manageiq_custom_attributes.ManageIQCustomAttributes(miq_ansible_module, MANAGEIQ_HOSTNAME, 'admin', 'smartvm',
+                                                              False, None, client_options)
+
+
+def test_20_custom_attributes_added(custom_attributes, appliance):
+    cas = [{'name': 'ca{0}'.format(i), 'value': str(i), 'section': 'metadata'} for i in range(20)]
+    result = custom_attributes.add_or_update_custom_attributes('provider', 'openshift01', cas)
+    assert result['changed']
+    assert len(result['updates']['Added']) == 20
+    # the entry point, the providers, the custom attributes and a single add
+    assert_requests(custom_attributes, appliance, 4)
+
+
+def test_20_custom_attributes_updated(custom_attributes, appliance):
+    appliance.find('providers', 134)['custom_attributes'] = [
+        {'name': 'ca{0}'.format(i), 'value': 'old', 'section': 'metadata', 'id': str(i),
+         'href': API_URL + '/providers/134/custom_attributes/{0}'.format(i)} for i in range(20)]
+    cas = [{'name': 'ca{0}'.format(i), 'value': str(i), 'section': 'metadata'} for i in range(20)]
+    result = custom_attributes.add_or_update_custom_attributes('provider', 'openshift01', cas)
+    assert len(result['updates']['Updated']) == 20
+    assert_requests(custom_attributes, appliance, 4)
+
+
+def test_20_custom_attributes_deleted(custom_attributes, appliance):
+    appliance.find('providers', 134)['custom_attributes'] = [
+        {'name': 'ca{0}'.format(i), 'value': str(i), 'section': 'metadata', 'id': str(i),
+         'href': API_URL + '/providers/134/custom_attributes/{0}'.format(i)} for i in range(20)]
+    cas = [{'name': 'ca{0}'.format(i), 'section': 'metadata'} for i in range(20)]
+    result = custom_attributes.delete_custom_attributes('provider', 'openshift01', cas)
+    assert result['changed']
+    # the entry point, the providers, the custom attributes and a single delete
+    assert_requests(custom_attributes, appliance, 4)
+
+
+def test_custom_attributes_of_20_entities(custom_attributes, appliance):
+    entities = [{'name': 'vm{0}'.format(i), 'custom_attributes': [{'name': 'cost_center', 'value': '1001', 'section': 'metadata'}]}
+                for i in range(20)]
+    result = custom_attributes.set_entities_custom_attributes('vm', entities, None, None, 'present')
+    assert len(result['entities']) == 10
+    # the entry point, the vms with their custom attributes and an edit of each
+    # vm whose cost center differs
+    assert_requests(custom_attributes, appliance, 12)
+
+
+@pytest.fixture
+def alert(appliance, miq_ansible_module, client_options):
+    yield manageiq_alert.ManageIQAlert(miq_ansible_module, MANAGEIQ_HOSTNAME, 'admin', 'smartvm',
+                                       False, None, client_options)
+
+
+def test_alert_unchanged(alert, appliance):
+    result = alert.create_or_update_alert('Alert 42', ALERT_EXPRESSION, 'miq_expression', 'container_node',
+                                          ALERT_OPTIONS, True)
+    assert not result['changed']
+    # the entry point, the alert definitions and the alert
+    assert_requests(alert, appliance, 3)
+
+
+def test_alert_unchanged_by_id(alert, appliance):
+    result = alert.create_or_update_alert('Alert 42', ALERT_EXPRESSION, 'miq_expression', 'container_node',
+                                          ALERT_OPTIONS, True, alert_id='42')
+    assert not result['changed']
+    assert_requests(alert, appliance, 2)
+
+
+@pytest.fixture
+def alert_profile(appliance, miq_ansible_module, client_options):
+    yield manageiq_alert_profile.ManageIQAlertProfile(miq_ansible_module, MANAGEIQ_HOSTNAME, 'admin', 'smartvm',
+                                                      False, None, client_options)
+
+
+def test_alert_profile_many_alerts_assigned(alert_profile, appliance):
+    alerts = ['Alert {0}'.format(i) for i in range(50)]
+    result = alert_profile.create_or_update_profile('Node Alerts', None, alerts, False, None)
+    assert len(result['assigned']) == 50
+    # the entry point, the profile with its alerts, the alerts and a single assign
+    assert_requests(alert_profile, appliance, 4)
+
+
+def test_alert_profile_unchanged(alert_profile, appliance):
+    appliance.find('alert_definition_profiles', 1)['alert_definitions'] = appliance.collections['alert_definitions']
+    alerts = ['Alert {0}'.format(i) for i in range(50)]
+    result = alert_profile.create_or_update_profile('Node Alerts', None, alerts, True, None)
+    assert not result['changed']
+    # the entry point and the profile with its alerts
+    assert_requests(alert_profile, appliance, 2)
+
+
+@pytest.fixture
+def user(appliance, miq_ansible_module, client_options):
+    yield manageiq_user.ManageIQUser(miq_ansible_module, MANAGEIQ_HOSTNAME, 'admin', 'smartvm',
+                                     False, None, client_options)
+
+
+def test_user_unchanged(user, appliance):
+    result = user.create_or_update_user('bob', 'Bob', None, 'EvmGroup-user', 'bob@example.com')
+    assert not result['changed']
+    # the entry point, the groups, the users and the user
+    assert_requests(user, appliance, 4)